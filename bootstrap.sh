@@ -204,6 +204,15 @@ else
     python ./setup.py install --prefix=$cbson_dist
 fi
 
+# install cvhash
+cvhash_dist=$VTROOT/dist/py-cvhash
+if [ -d $cvhash_dist ]; then
+  echo "skipping cvhash python build"
+else
+  cd $VTTOP/py/cvhash && \
+    python ./setup.py install --prefix=$cvhash_dist
+fi
+
 # create pre-commit hooks
 echo "creating git pre-commit hooks"
 ln -sf $VTTOP/misc/git/pre-commit $VTTOP/.git/hooks/pre-commit
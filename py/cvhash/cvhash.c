@@ -0,0 +1,203 @@
+/* Copyright 2015, Google Inc. All rights reserved.
+ * Use of this source code is governed by a BSD-style license that can
+ * be found in the LICENSE file.
+ */
+
+/* Fast keyspace id hashing for Python */
+
+/* This is the batch version of vhash/vunhash from
+   go/vt/vtgate/vindexes/hash.go: every 8-byte block of the input is
+   encrypted (or decrypted) with 3DES and a null key, which is the same
+   as a single DES pass with a null key. py/vtdb/vhash.py uses it when it
+   is installed.
+
+  >>> cvhash.encrypt('\x00\x00\x00\x00\x00\x00\x00\x01')
+  '\x16k@\xb4J\xbaK\xd6'
+  >>> cvhash.decrypt('\x16k@\xb4J\xbaK\xd6')
+  '\x00\x00\x00\x00\x00\x00\x00\x01'
+*/
+
+#define PY_SSIZE_T_CLEAN
+#include "Python.h"
+
+#if PY_VERSION_HEX < 0x02050000
+typedef int Py_ssize_t;
+#endif
+
+typedef unsigned long long uint64;
+typedef unsigned int uint32;
+
+/* DES tables, see FIPS 46-3. Bit positions are 1-based from the most
+   significant bit. */
+static const unsigned char IP[64] = {
+  58, 50, 42, 34, 26, 18, 10, 2, 60, 52, 44, 36, 28, 20, 12, 4,
+  62, 54, 46, 38, 30, 22, 14, 6, 64, 56, 48, 40, 32, 24, 16, 8,
+  57, 49, 41, 33, 25, 17, 9, 1, 59, 51, 43, 35, 27, 19, 11, 3,
+  61, 53, 45, 37, 29, 21, 13, 5, 63, 55, 47, 39, 31, 23, 15, 7};
+
+static const unsigned char FP[64] = {
+  40, 8, 48, 16, 56, 24, 64, 32, 39, 7, 47, 15, 55, 23, 63, 31,
+  38, 6, 46, 14, 54, 22, 62, 30, 37, 5, 45, 13, 53, 21, 61, 29,
+  36, 4, 44, 12, 52, 20, 60, 28, 35, 3, 43, 11, 51, 19, 59, 27,
+  34, 2, 42, 10, 50, 18, 58, 26, 33, 1, 41, 9, 49, 17, 57, 25};
+
+static const unsigned char P[32] = {
+  16, 7, 20, 21, 29, 12, 28, 17, 1, 15, 23, 26, 5, 18, 31, 10,
+  2, 8, 24, 14, 32, 27, 3, 9, 19, 13, 30, 6, 22, 11, 4, 25};
+
+static const unsigned char SBOXES[8][64] = {
+  {14, 4, 13, 1, 2, 15, 11, 8, 3, 10, 6, 12, 5, 9, 0, 7,
+   0, 15, 7, 4, 14, 2, 13, 1, 10, 6, 12, 11, 9, 5, 3, 8,
+   4, 1, 14, 8, 13, 6, 2, 11, 15, 12, 9, 7, 3, 10, 5, 0,
+   15, 12, 8, 2, 4, 9, 1, 7, 5, 11, 3, 14, 10, 0, 6, 13},
+  {15, 1, 8, 14, 6, 11, 3, 4, 9, 7, 2, 13, 12, 0, 5, 10,
+   3, 13, 4, 7, 15, 2, 8, 14, 12, 0, 1, 10, 6, 9, 11, 5,
+   0, 14, 7, 11, 10, 4, 13, 1, 5, 8, 12, 6, 9, 3, 2, 15,
+   13, 8, 10, 1, 3, 15, 4, 2, 11, 6, 7, 12, 0, 5, 14, 9},
+  {10, 0, 9, 14, 6, 3, 15, 5, 1, 13, 12, 7, 11, 4, 2, 8,
+   13, 7, 0, 9, 3, 4, 6, 10, 2, 8, 5, 14, 12, 11, 15, 1,
+   13, 6, 4, 9, 8, 15, 3, 0, 11, 1, 2, 12, 5, 10, 14, 7,
+   1, 10, 13, 0, 6, 9, 8, 7, 4, 15, 14, 3, 11, 5, 2, 12},
+  {7, 13, 14, 3, 0, 6, 9, 10, 1, 2, 8, 5, 11, 12, 4, 15,
+   13, 8, 11, 5, 6, 15, 0, 3, 4, 7, 2, 12, 1, 10, 14, 9,
+   10, 6, 9, 0, 12, 11, 7, 13, 15, 1, 3, 14, 5, 2, 8, 4,
+   3, 15, 0, 6, 10, 1, 13, 8, 9, 4, 5, 11, 12, 7, 2, 14},
+  {2, 12, 4, 1, 7, 10, 11, 6, 8, 5, 3, 15, 13, 0, 14, 9,
+   14, 11, 2, 12, 4, 7, 13, 1, 5, 0, 15, 10, 3, 9, 8, 6,
+   4, 2, 1, 11, 10, 13, 7, 8, 15, 9, 12, 5, 6, 3, 0, 14,
+   11, 8, 12, 7, 1, 14, 2, 13, 6, 15, 0, 9, 10, 4, 5, 3},
+  {12, 1, 10, 15, 9, 2, 6, 8, 0, 13, 3, 4, 14, 7, 5, 11,
+   10, 15, 4, 2, 7, 12, 9, 5, 6, 1, 13, 14, 0, 11, 3, 8,
+   9, 14, 15, 5, 2, 8, 12, 3, 7, 0, 4, 10, 1, 13, 11, 6,
+   4, 3, 2, 12, 9, 5, 15, 10, 11, 14, 1, 7, 6, 0, 8, 13},
+  {4, 11, 2, 14, 15, 0, 8, 13, 3, 12, 9, 7, 5, 10, 6, 1,
+   13, 0, 11, 7, 4, 9, 1, 10, 14, 3, 5, 12, 2, 15, 8, 6,
+   1, 4, 11, 13, 12, 3, 7, 14, 10, 15, 6, 8, 0, 5, 9, 2,
+   6, 11, 13, 8, 1, 4, 10, 7, 9, 5, 0, 15, 14, 2, 3, 12},
+  {13, 2, 8, 4, 6, 15, 11, 1, 10, 9, 3, 14, 5, 0, 12, 7,
+   1, 15, 13, 8, 10, 3, 7, 4, 12, 5, 6, 11, 0, 14, 9, 2,
+   7, 11, 4, 1, 9, 12, 14, 2, 0, 6, 10, 13, 15, 3, 5, 8,
+   2, 1, 14, 7, 4, 10, 8, 13, 15, 12, 9, 0, 3, 5, 6, 11}};
+
+/* The 64-bit permutations, split in one lookup table per input byte. */
+static uint64 ip_tables[8][256];
+static uint64 fp_tables[8][256];
+/* Each S-box merged with the P permutation that follows it. */
+static uint32 sp_tables[8][64];
+
+/* With a null key, the key schedule yields 16 null subkeys, so the rounds
+   below do not mix in any key material. */
+
+static uint64 permute(uint64 value, const unsigned char *table, int out_bits,
+                      int in_bits) {
+  uint64 out = 0;
+  int i;
+  for (i = 0; i < out_bits; i++) {
+    out = (out << 1) | ((value >> (in_bits - table[i])) & 1);
+  }
+  return out;
+}
+
+static void init_tables(void) {
+  int i, j;
+  for (i = 0; i < 8; i++) {
+    for (j = 0; j < 256; j++) {
+      uint64 block = ((uint64) j) << (56 - 8 * i);
+      ip_tables[i][j] = permute(block, IP, 64, 64);
+      fp_tables[i][j] = permute(block, FP, 64, 64);
+    }
+    for (j = 0; j < 64; j++) {
+      int row = ((j >> 4) & 2) | (j & 1);
+      int column = (j >> 1) & 15;
+      uint64 s = ((uint64) SBOXES[i][row * 16 + column]) << (28 - 4 * i);
+      sp_tables[i][j] = (uint32) permute(s, P, 32, 32);
+    }
+  }
+}
+
+static uint64 permute_bytes(uint64 block, uint64 tables[8][256]) {
+  return tables[0][block >> 56] | tables[1][(block >> 48) & 0xFF] |
+      tables[2][(block >> 40) & 0xFF] | tables[3][(block >> 32) & 0xFF] |
+      tables[4][(block >> 24) & 0xFF] | tables[5][(block >> 16) & 0xFF] |
+      tables[6][(block >> 8) & 0xFF] | tables[7][block & 0xFF];
+}
+
+/* Encryption and decryption only differ by the order of the subkeys,
+   which are all null here. */
+static uint64 des_block(uint64 block) {
+  uint32 left, right, tmp;
+  uint64 x;
+  int round;
+
+  block = permute_bytes(block, ip_tables);
+  left = (uint32) (block >> 32);
+  right = (uint32) block;
+  for (round = 0; round < 16; round++) {
+    /* The E expansion: chunk i is bits 4i..4i+5 of the right half with
+       the bits on both ends wrapped around. */
+    x = (((uint64) (right & 1)) << 33) | (((uint64) right) << 1) |
+        (right >> 31);
+    tmp = sp_tables[0][(x >> 28) & 0x3F] | sp_tables[1][(x >> 24) & 0x3F] |
+        sp_tables[2][(x >> 20) & 0x3F] | sp_tables[3][(x >> 16) & 0x3F] |
+        sp_tables[4][(x >> 12) & 0x3F] | sp_tables[5][(x >> 8) & 0x3F] |
+        sp_tables[6][(x >> 4) & 0x3F] | sp_tables[7][x & 0x3F];
+    tmp ^= left;
+    left = right;
+    right = tmp;
+  }
+  block = (((uint64) right) << 32) | left;
+  return permute_bytes(block, fp_tables);
+}
+
+static PyObject *des_blocks(PyObject *self, PyObject *args) {
+  const unsigned char *data;
+  unsigned char *out;
+  Py_ssize_t len, offset;
+  PyObject *result;
+  uint64 block;
+  int i;
+
+  if (!PyArg_ParseTuple(args, "s#", &data, &len))
+    return NULL;
+  if (len % 8 != 0) {
+    PyErr_SetString(PyExc_ValueError, "length must be a multiple of 8");
+    return NULL;
+  }
+  result = PyString_FromStringAndSize(NULL, len);
+  if (result == NULL)
+    return NULL;
+  out = (unsigned char *) PyString_AS_STRING(result);
+  for (offset = 0; offset < len; offset += 8) {
+    block = 0;
+    for (i = 0; i < 8; i++)
+      block = (block << 8) | data[offset + i];
+    block = des_block(block);
+    for (i = 7; i >= 0; i--) {
+      out[offset + i] = (unsigned char) (block & 0xFF);
+      block >>= 8;
+    }
+  }
+  return result;
+}
+
+PyDoc_STRVAR(encrypt__doc__,
+"encrypt(s) -> str\n"
+"\n"
+"Hashes every 8-byte big-endian sharding key of s into a keyspace id.");
+
+PyDoc_STRVAR(decrypt__doc__,
+"decrypt(s) -> str\n"
+"\n"
+"Returns the 8-byte big-endian sharding key of every keyspace id of s.");
+
+static struct PyMethodDef cvhash_functions[] = {
+  {"encrypt", (PyCFunction) des_blocks, METH_VARARGS, encrypt__doc__},
+  {"decrypt", (PyCFunction) des_blocks, METH_VARARGS, decrypt__doc__},
+  {NULL, NULL}
+};
+
+PyMODINIT_FUNC
+initcvhash(void) {
+  init_tables();
+  Py_InitModule("cvhash", cvhash_functions);
+}
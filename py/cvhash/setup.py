@@ -0,0 +1,9 @@
+from distutils.core import setup, Extension
+
+cvhash = Extension('cvhash',
+                   sources = ['cvhash.c'])
+
+setup(name = 'cvhash',
+      version = '0.1',
+      description = 'Fast keyspace id hashing via C',
+      ext_modules = [cvhash])
@@ -161,6 +161,16 @@ class _GoRpcConn(object):
         return True
     return False
 
+  # has_pending_data returns True if a read wouldn't block.
+  def has_pending_data(self):
+    if self.conn is None:
+      return False
+    if isinstance(self.conn, ssl.SSLSocket) and self.conn.pending():
+      return True
+    poll = select.poll()
+    poll.register(self.conn.fileno())
+    return bool(poll.poll(0))
+
 
 class GoRpcClient(object):
   def __init__(self, uri, timeout, certfile=None, keyfile=None, socket_file=None):
@@ -203,6 +213,15 @@ class GoRpcClient(object):
       return self.conn.is_closed()
     return True
 
+  # stream_has_pending returns True if stream_next can start decoding the
+  # next response without waiting for the server.
+  def stream_has_pending(self):
+    if self.data:
+      return True
+    if self.conn:
+      return self.conn.has_pending_data()
+    return False
+
   __del__ = close
 
   def next_sequence_id(self):
@@ -18,6 +18,8 @@ management.
 import contextlib
 import functools
 import logging
+import Queue
+import threading
 
 from vtdb import dbexceptions
 from vtdb import shard_constants
@@ -28,12 +30,155 @@ from vtdb import vtgatev2
 #TODO: verify that these values make sense.
 DEFAULT_CONNECTION_TIMEOUT = 5.0
 
+# Number of idle vtgate connections kept by the pool of a DatabaseContext.
+DEFAULT_MAX_IDLE_CONNECTIONS = 8
+
+# Number of threads running the operations of execute_parallel_reads.
+DEFAULT_PARALLEL_READ_WORKERS = 8
+
 __app_read_only_mode_method = lambda:False
 __vtgate_connect_method = vtgatev2.connect
 #TODO: perhaps make vtgate addrs also a registeration mechanism ?
 #TODO: add mechansim to refresh vtgate addrs.
 
 
+class _ThreadState(threading.local):
+  """Db operation and transaction state of a thread of a DatabaseContext."""
+  # Tablet type of the db operation in progress, None outside of them.
+  tablet_type = None
+  # Depth of the nested write transactions in progress.
+  transaction_stack_depth = 0
+  # Connection pinned by the transaction in progress.
+  vtgate_connection = None
+
+
+class VTGateConnectionPool(object):
+  """Pool of vtgate connections shared by the threads of a DatabaseContext.
+
+  Connections are created on demand, so the pool never blocks. Returned
+  connections are kept for reuse, up to max_idle of them.
+  """
+
+  def __init__(self, connect_method, max_idle=DEFAULT_MAX_IDLE_CONNECTIONS):
+    self.connect_method = connect_method
+    self.max_idle = max_idle
+    self._idle = []
+    self._lock = threading.Lock()
+
+  def get(self):
+    with self._lock:
+      while self._idle:
+        conn = self._idle.pop()
+        if not conn.is_closed():
+          return conn
+    return self.connect_method()
+
+  def put(self, conn):
+    if conn.is_closed():
+      return
+    with self._lock:
+      if len(self._idle) < self.max_idle:
+        self._idle.append(conn)
+        return
+    conn.close()
+
+  def close(self):
+    with self._lock:
+      idle, self._idle = self._idle, []
+    for conn in idle:
+      conn.close()
+
+
+class PooledVTGateConnection(object):
+  """Connection of the cursors of the db operations outside transactions.
+
+  Each RPC borrows a connection of the pool for its own duration. A
+  streaming query keeps its connection until the end of the stream.
+  Connections that raise an OperationalError are closed rather than
+  returned to the pool.
+  """
+
+  def __init__(self, pool):
+    self.pool = pool
+    self._stream_conn = None
+
+  def _call(self, method_name, *pargs, **kwargs):
+    conn = self.pool.get()
+    try:
+      return getattr(conn, method_name)(*pargs, **kwargs)
+    except dbexceptions.OperationalError:
+      conn.close()
+      raise
+    finally:
+      self.pool.put(conn)
+
+  def _execute(self, *pargs, **kwargs):
+    return self._call('_execute', *pargs, **kwargs)
+
+  def _execute_entity_ids(self, *pargs, **kwargs):
+    return self._call('_execute_entity_ids', *pargs, **kwargs)
+
+  def _execute_batch(self, *pargs, **kwargs):
+    return self._call('_execute_batch', *pargs, **kwargs)
+
+  def _stream_execute(self, *pargs, **kwargs):
+    # A stream that wasn't read to the end can't be reused.
+    self._release_stream_conn(close=True)
+    self._stream_conn = self.pool.get()
+    try:
+      return self._stream_conn._stream_execute(*pargs, **kwargs)
+    except:
+      self._release_stream_conn(close=True)
+      raise
+
+  def _stream_next(self):
+    if self._stream_conn is None:
+      return None
+    try:
+      row = self._stream_conn._stream_next()
+    except:
+      self._release_stream_conn(close=True)
+      raise
+    if row is None:
+      self._release_stream_conn()
+    return row
+
+  def _release_stream_conn(self, close=False):
+    conn = self._stream_conn
+    if conn is None:
+      return
+    self._stream_conn = None
+    if close:
+      conn.close()
+    else:
+      self.pool.put(conn)
+
+  def begin(self):
+    raise dbexceptions.ProgrammingError(
+        "Transactions must use a WriteTransaction.")
+
+  commit = rollback = begin
+
+  def is_closed(self):
+    return False
+
+  def close(self):
+    self._release_stream_conn(close=True)
+
+
+class ParallelReadResult(object):
+  """Outcome of one operation of DatabaseContext.execute_parallel_reads.
+
+  Attributes:
+    result: return value of the operation, None if it failed.
+    error: exception raised by the operation, None if it succeeded.
+  """
+
+  def __init__(self, result=None, error=None):
+    self.result = result
+    self.error = error
+
+
 class DatabaseContext(object):
   """Global Database Context for client db operations via VTGate.
 
@@ -43,6 +188,12 @@ class DatabaseContext(object):
   * Manages the database transaction.
   * Error logging and handling.
 
+  A context can be shared by the threads of a process. The db operation
+  and transaction state is kept per thread, and the threads draw their
+  vtgate connections from a shared VTGateConnectionPool. A connection is
+  pinned to a thread for the duration of its transaction only; outside
+  transactions each RPC borrows a connection for its own duration.
+
   Attributes:
     lag_tolerant_mode: This directs all replica traffic to batch replicas.
     This is done for applications that have a OLAP workload and also higher tolerance
@@ -53,69 +204,112 @@ class DatabaseContext(object):
     event_logger: Logs events and errors of note. Defaults to vtdb_logger.
     transaction_stack_depth: This allows nesting of transactions and makes
     commit rpc to VTGate when the outer-most commits.
-    vtgate_connection: Connection to VTGate.
+    vtgate_connection: Connection to VTGate pinned by the transaction of the
+    current thread, None outside transactions.
+    connection_pool: VTGateConnectionPool of the context.
+    result_cache: Cache for reads of tables with a result_cache_ttl, see
+    result_cache.py. It is never used for master reads or in transactions.
   """
 
-  def __init__(self, vtgate_addrs=None, lag_tolerant_mode=False, master_access_disabled=False):
+  def __init__(self, vtgate_addrs=None, lag_tolerant_mode=False, master_access_disabled=False,
+               result_cache=None,
+               max_idle_connections=DEFAULT_MAX_IDLE_CONNECTIONS):
     self.vtgate_addrs = vtgate_addrs
+    self.result_cache = result_cache
     self.lag_tolerant_mode = lag_tolerant_mode
     self.master_access_disabled = master_access_disabled
-    self.vtgate_connection = None
     self.change_master_read_to_replica = False
-    self._transaction_stack_depth = 0
     self.event_logger = vtdb_logger.get_logger()
     self.connection_timeout = DEFAULT_CONNECTION_TIMEOUT
-    self._tablet_type = None
+    self.connection_pool = VTGateConnectionPool(self.connect,
+                                                max_idle_connections)
+    self._thread_state = _ThreadState()
 
   @property
   def tablet_type(self):
-    return self._tablet_type
+    return self._thread_state.tablet_type
 
   @property
   def in_transaction(self):
-    return self._transaction_stack_depth > 0
+    return self._thread_state.transaction_stack_depth > 0
 
   @property
   def in_db_operation(self):
-    return (self._tablet_type is not None)
+    return (self._thread_state.tablet_type is not None)
+
+  def _get_vtgate_connection_attr(self):
+    return self._thread_state.vtgate_connection
+
+  def _set_vtgate_connection_attr(self, vtgate_connection):
+    self._thread_state.vtgate_connection = vtgate_connection
+
+  vtgate_connection = property(_get_vtgate_connection_attr,
+                               _set_vtgate_connection_attr)
+
+  def connect(self):
+    """Creates a new connection to vtgate."""
+    #TODO: the connect method needs to be extended to include query n txn timeouts as well
+    #FIXME: what is the best way of passing other params ?
+    connect_method = get_vtgate_connect_method()
+    return connect_method(self.vtgate_addrs, self.connection_timeout)
 
   def get_vtgate_connection(self):
-    """Returns the cached vtgate connection or creates a new one.
+    """Returns the connection for the cursors of the current thread.
 
     Transactions and some of the consistency guarantees rely on vtgate
-    connections being sticky hence this class caches the connection.
+    connections being sticky, hence the transaction in progress keeps its
+    connection. Outside transactions, this is a PooledVTGateConnection that
+    only holds a connection of the pool during each RPC.
     """
     if self.vtgate_connection is not None and not self.vtgate_connection.is_closed():
       return self.vtgate_connection
-
-    #TODO: the connect method needs to be extended to include query n txn timeouts as well
-    #FIXME: what is the best way of passing other params ?
-    connect_method = get_vtgate_connect_method()
-    self.vtgate_connection = connect_method(self.vtgate_addrs, self.connection_timeout)
-    return self.vtgate_connection
+    return PooledVTGateConnection(self.connection_pool)
 
   def degrade_master_read_to_replica(self):
     self.change_master_read_to_replica = True
 
-  def start_transaction(self):
-    conn = self.get_vtgate_connection()
-    if self._transaction_stack_depth == 0:
-      conn.begin()
-    self._transaction_stack_depth += 1
+  def start_transaction(self, write_behind=False):
+    """Begins a transaction unless one is in progress.
+
+    Args:
+      write_behind: buffer the DMLs of the transaction, see
+      vtgatev2.VTGateConnection.begin. Nested transactions keep the mode of
+      the outer-most one.
+    """
+    state = self._thread_state
+    if state.transaction_stack_depth == 0:
+      conn = self.connection_pool.get()
+      try:
+        if write_behind:
+          conn.begin(write_behind=True)
+        else:
+          conn.begin()
+      except:
+        self.connection_pool.put(conn)
+        raise
+      state.vtgate_connection = conn
+    state.transaction_stack_depth += 1
 
   def commit(self):
-    if self._transaction_stack_depth:
-      self._transaction_stack_depth -= 1
+    state = self._thread_state
+    if state.transaction_stack_depth:
+      state.transaction_stack_depth -= 1
 
-    if self._transaction_stack_depth != 0:
+    if state.transaction_stack_depth != 0:
       return
 
     if self.vtgate_connection is None:
       return
-    self.vtgate_connection.commit()
+    try:
+      self.vtgate_connection.commit()
+    except dbexceptions.OperationalError:
+      self.vtgate_connection.close()
+      raise
+    finally:
+      self._release_vtgate_connection()
 
   def rollback(self):
-    self._transaction_stack_depth = 0
+    self._thread_state.transaction_stack_depth = 0
     try:
       if self.vtgate_connection is not None:
         self.vtgate_connection.rollback()
@@ -124,36 +318,47 @@ class DatabaseContext(object):
       self.vtgate_connection = None
     except Exception as e:
       raise
+    finally:
+      self._release_vtgate_connection()
+
+  def _release_vtgate_connection(self):
+    """Returns the connection pinned by the transaction to the pool."""
+    conn = self.vtgate_connection
+    if conn is not None:
+      self.vtgate_connection = None
+      self.connection_pool.put(conn)
 
   def close(self):
-    if self._transaction_stack_depth:
+    if self._thread_state.transaction_stack_depth:
       self.rollback()
-    self.vtgate_connection.close()
+    self.connection_pool.close()
 
   def read_from_master_setup(self):
-    self._tablet_type = shard_constants.TABLET_TYPE_MASTER
+    state = self._thread_state
+    state.tablet_type = shard_constants.TABLET_TYPE_MASTER
     if self.master_access_disabled:
       raise dbexceptions.Error("Master access is disabled.")
     if app_read_only_mode() and self.change_master_read_to_replica:
-      self._tablet_type = shard_constants.TABLET_TYPE_REPLICA
+      state.tablet_type = shard_constants.TABLET_TYPE_REPLICA
 
   def read_from_replica_setup(self):
-    self._tablet_type = shard_constants.TABLET_TYPE_REPLICA
+    state = self._thread_state
+    state.tablet_type = shard_constants.TABLET_TYPE_REPLICA
 
     # During a write transaction, all reads are promoted to
     # read from master.
-    if self._transaction_stack_depth > 0:
-      self._tablet_type = shard_constants.TABLET_TYPE_MASTER
+    if state.transaction_stack_depth > 0:
+      state.tablet_type = shard_constants.TABLET_TYPE_MASTER
     elif self.lag_tolerant_mode:
-      self._tablet_type = shard_constants.TABLET_TYPE_BATCH
+      state.tablet_type = shard_constants.TABLET_TYPE_BATCH
 
   def write_transaction_setup(self):
     if self.master_access_disabled:
       raise dbexceptions.Error("Cannot write, master access is disabled.")
-    self._tablet_type = shard_constants.TABLET_TYPE_MASTER
+    self._thread_state.tablet_type = shard_constants.TABLET_TYPE_MASTER
 
   def close_db_operation(self):
-    self._tablet_type = None
+    self._thread_state.tablet_type = None
 
   def create_cursor(self, writable, table_class, **cursor_kargs):
     if not self.in_db_operation:
@@ -164,9 +369,136 @@ class DatabaseContext(object):
                                               self.tablet_type,
                                               writable,
                                               **cursor_kargs)
+    if self.use_result_cache(writable, table_class):
+      cursor.result_cache = self.result_cache
+      cursor.result_cache_ttl = table_class.result_cache_ttl
 
     return cursor
 
+  def execute_parallel_reads(self, operations, read_from_master=False,
+                             max_workers=DEFAULT_PARALLEL_READ_WORKERS):
+    """Runs read operations concurrently and returns all their outcomes.
+
+    Every operation runs in its own ReadFromReplica, or ReadFromMaster,
+    on a worker thread, so the operations on different tables and
+    keyspaces overlap instead of adding up. Their RPCs are sent over
+    connections of the pool.
+
+    Args:
+      operations: list of callables, called with the db operation context
+      to create cursors with, e.g.
+      lambda context: VtUser.select_by_columns(context.get_cursor(), ...)
+      read_from_master: run the operations in ReadFromMaster contexts.
+      max_workers: maximum number of operations running at once.
+
+    Returns:
+      list of ParallelReadResult, in the order of operations. An error of
+      one operation doesn't affect the others.
+
+    Raises:
+      dbexceptions.ProgrammingError if called in a transaction, whose reads
+      must all use the connection of the transaction.
+    """
+    if self.in_transaction:
+      raise dbexceptions.ProgrammingError(
+          "Parallel reads are not allowed in a transaction.")
+    if read_from_master:
+      operation_class = ReadFromMaster
+    else:
+      operation_class = ReadFromReplica
+
+    results = [None] * len(operations)
+    pending = Queue.Queue()
+    for i, operation in enumerate(operations):
+      pending.put((i, operation))
+
+    def run_operations():
+      while True:
+        try:
+          i, operation = pending.get_nowait()
+        except Queue.Empty:
+          return
+        try:
+          with operation_class(self) as context:
+            results[i] = ParallelReadResult(result=operation(context))
+        except Exception as e:
+          results[i] = ParallelReadResult(error=e)
+
+    workers = [threading.Thread(target=run_operations)
+               for _ in xrange(min(max_workers, len(operations)))]
+    for worker in workers:
+      worker.daemon = True
+      worker.start()
+    for worker in workers:
+      worker.join()
+    return results
+
+  def use_result_cache(self, writable, table_class):
+    """Cached results are only served for replica reads outside transactions."""
+    return (self.result_cache is not None and
+            table_class.result_cache_ttl and
+            not writable and
+            not self.in_transaction and
+            self.tablet_type != shard_constants.TABLET_TYPE_MASTER)
+
+
+class EntityLookupBatch(object):
+  """Resolves the lookup entity ids of a db operation in batches.
+
+  Entity ids are queued with add. The first cursor created for one of
+  them resolves all queued ids with one chunked IN query per lookup
+  table, and the cursors created afterwards route from those rows without
+  querying the lookup table again.
+  """
+
+  def __init__(self, cursor_method):
+    # cursor_method creates the cursors used to read the lookup tables.
+    self.cursor_method = cursor_method
+    # (lookup_class, lookup column) -> entity ids to resolve.
+    self.pending = {}
+    # (lookup_class, lookup column) -> {entity id: list of rows}.
+    self.resolved = {}
+
+  def add(self, table_class, entity_id_column, entity_ids):
+    lookup = table_class.get_entity_lookup(entity_id_column)
+    resolved_rows = self.resolved.get(lookup, {})
+    pending_ids = self.pending.setdefault(lookup, set())
+    for entity_id in entity_ids:
+      if entity_id not in resolved_rows:
+        pending_ids.add(entity_id)
+
+  def resolve(self):
+    for lookup, entity_ids in self.pending.iteritems():
+      if not entity_ids:
+        continue
+      lookup_class, lookup_column = lookup
+      resolved_rows = self.resolved.setdefault(lookup, {})
+      for entity_id in entity_ids:
+        resolved_rows[entity_id] = []
+      for row in lookup_class.get_many(self.cursor_method, lookup_column,
+                                       entity_ids):
+        resolved_rows.setdefault(row[lookup_column], []).append(row)
+    self.pending = {}
+
+  def get_rows(self, table_class, entity_id_column, entity_id):
+    """Returns the lookup rows of the entity ids, or None if not queued."""
+    # db_object imports this module, it can't be imported at the top.
+    from vtdb import db_object
+    if db_object._is_iterable_container(entity_id):
+      entity_ids = entity_id
+    else:
+      entity_ids = [entity_id,]
+    lookup = table_class.get_entity_lookup(entity_id_column)
+    if self.pending.get(lookup):
+      self.resolve()
+    resolved_rows = self.resolved.get(lookup, {})
+    rows = []
+    for en_id in entity_ids:
+      if en_id not in resolved_rows:
+        return None
+      rows.extend(resolved_rows[en_id])
+    return rows
+
 
 class DBOperationBase(object):
   """Base class for database read and write operations.
@@ -174,17 +506,39 @@ class DBOperationBase(object):
   Attributes:
    dc: database context object.
    writable: Indicates whether this is part of write transaction.
+   entity_lookup_batch: EntityLookupBatch of the entity ids queued with
+   add_entity_lookups, None if there are none.
   """
   def __init__(self, db_context):
     self.dc = db_context
     self.writable = False
+    self.entity_lookup_batch = None
 
   def get_cursor(self, **cursor_kargs):
     """This returns the create_cursor method of DatabaseContext with
     the writable attribute from the instance of DBOperationBase's
     derived classes."""
+    if self.entity_lookup_batch is not None:
+      cursor_kargs['entity_lookup_batch'] = self.entity_lookup_batch
     return functools.partial(self.dc.create_cursor, self.writable, **cursor_kargs)
 
+  def add_entity_lookups(self, table_class, entity_id_column, entity_ids):
+    """Queues lookup entity ids to be resolved together.
+
+    The cursors later created by get_cursor with an entity_id_map on these
+    ids are routed without a lookup query of their own.
+
+    Args:
+      table_class: range-sharded table class the ids will be routed for.
+      entity_id_column: lookup based entity column of table_class.
+      entity_ids: entity ids.
+    """
+    if self.entity_lookup_batch is None:
+      # In a write transaction, the lookups see the rows it wrote.
+      self.entity_lookup_batch = EntityLookupBatch(
+          functools.partial(self.dc.create_cursor, self.writable))
+    self.entity_lookup_batch.add(table_class, entity_id_column, entity_ids)
+
 
 class ReadFromMaster(DBOperationBase):
   """Context Manager for reading from master."""
@@ -219,11 +573,21 @@ class ReadFromReplica(DBOperationBase):
 
 
 class WriteTransaction(DBOperationBase):
-  """Context Manager for write transactions."""
+  """Context Manager for write transactions.
+
+  With write_behind, the DMLs routed by keyspace_id are sent in batches
+  before the next read and at commit instead of one RPC each. Their
+  rowcount and lastrowid are not known, so inserts that need the generated
+  id shouldn't use it.
+  """
+  def __init__(self, db_context, write_behind=False):
+    super(WriteTransaction, self).__init__(db_context)
+    self.write_behind = write_behind
+
   def __enter__(self):
     self.writable = True
     self.dc.write_transaction_setup()
-    self.dc.start_transaction()
+    self.dc.start_transaction(write_behind=self.write_behind)
     return self
 
   def __exit__(self, exc_type, exc_value, traceback):
@@ -124,12 +124,15 @@ def create_stream_cursor_from_cursor(original_cursor):
   return stream_cursor
 
 
-def create_batch_cursor_from_cursor(original_cursor, writable=False):
+def create_batch_cursor_from_cursor(original_cursor, writable=False,
+                                    **batch_kwargs):
   """
   This method creates a batch cursor from a regular cursor.
 
   Args:
     original_cursor: Cursor of VTGateCursor type
+    batch_kwargs: flush thresholds and pipelined mode of the batch cursor,
+    see BatchVTGateCursor.
 
   Returns:
     Returns BatchVTGateCursor that has same attributes as original_cursor.
@@ -141,7 +144,7 @@ def create_batch_cursor_from_cursor(original_cursor, writable=False):
       original_cursor._conn, original_cursor.keyspace,
       original_cursor.tablet_type,
       keyspace_ids=original_cursor.keyspace_ids,
-      writable=writable)
+      writable=writable, **batch_kwargs)
   return batch_cursor
 
 
@@ -294,6 +297,9 @@ class DBObjectBase(object):
   id_column_name = None
   is_mysql_view = False
   utf8_columns = None
+  # Seconds for which replica reads of this table may be served from the
+  # result cache of the DatabaseContext. None disables caching.
+  result_cache_ttl = None
 
 
   @classmethod
@@ -352,6 +358,37 @@ class DBObjectBase(object):
                                     class_.columns_list,
                                     **bind_vars)
 
+  @classmethod
+  def create_insert_many_query(class_, rows):
+    for row in rows:
+      class_._validate_column_value_pairs_for_write(**row)
+    return sql_builder.insert_many_query(class_.table_name,
+                                         class_.columns_list,
+                                         rows)
+
+  @classmethod
+  def insert_many_rowids(class_, rows, lastrowid):
+    """Returns the lastrowid of every row of a multi-row insert.
+
+    Rows that set id_column_name get their own id. Otherwise MySQL returns
+    the auto-increment id of the first row, and the ids of the other rows
+    follow it. This assumes auto_increment_increment is 1 and
+    innodb_autoinc_lock_mode is not 2 (interleaved).
+
+    Args:
+      rows: rows inserted by one statement.
+      lastrowid: lastrowid of the statement.
+
+    Returns:
+      list of ids in the order of rows, None where the id is not known.
+    """
+    id_column = class_.id_column_name
+    if id_column is not None and [row for row in rows if id_column in row]:
+      return [row.get(id_column) for row in rows]
+    if not lastrowid:
+      return [None] * len(rows)
+    return range(lastrowid, lastrowid + len(rows))
+
   @classmethod
   def create_update_query(class_, where_column_value_pairs,
                           update_column_value_pairs):
@@ -393,6 +430,32 @@ class DBObjectBase(object):
     cursor.execute(query, bind_vars)
     return cursor.lastrowid
 
+  @write_db_class_method
+  def insert_many(class_, cursor, rows,
+                  max_rows_per_statement=sql_builder.MAX_INSERT_ROWS):
+    """Inserts rows with multi-row INSERT statements.
+
+    Args:
+      cursor: cursor of the table.
+      rows: list of dicts of column values, all setting the same columns.
+      max_rows_per_statement: maximum number of rows of one statement.
+
+    Returns:
+      list of the lastrowid of every row, see insert_many_rowids.
+    """
+    if class_.columns_list is None:
+      raise dbexceptions.ProgrammingError("DB class should define columns_list")
+
+    rows = list(rows)
+    rowids = []
+    for i in xrange(0, len(rows), max_rows_per_statement):
+      statement_rows = rows[i:i + max_rows_per_statement]
+      query, bind_vars = class_.create_insert_many_query(statement_rows)
+      cursor.execute(query, bind_vars)
+      rowids.extend(class_.insert_many_rowids(statement_rows,
+                                              cursor.lastrowid))
+    return rowids
+
   @write_db_class_method
   def update_columns(class_, cursor, where_column_value_pairs,
                      update_column_value_pairs):
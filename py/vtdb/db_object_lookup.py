@@ -18,23 +18,99 @@ from vtdb import shard_constants
 from vtdb import vtgate_cursor
 
 
+# Maximum number of entity ids resolved by a single IN query.
+LOOKUP_IN_CLAUSE_SIZE = 500
+
+
 class LookupDBObject(db_object_unsharded.DBObjectUnsharded):
   """This is an example implementation of lookup class where it is stored
   in unsharded db.
   """
+  # lookup_cache is a lookup_cache.LookupCache that serves the rows of get
+  # for replica reads. Setting it on LookupDBObject shares it between all
+  # lookup classes. None disables caching.
+  lookup_cache = None
+
   @classmethod
   def get(class_, cursor, entity_id_column, entity_id):
-    where_column_value_pairs = [(entity_id_column, entity_id),]
-    rows =  class_.select_by_columns(cursor, where_column_value_pairs)
-    return [row.__dict__ for row in rows]
+    if class_.lookup_cache is None:
+      where_column_value_pairs = [(entity_id_column, entity_id),]
+      rows =  class_.select_by_columns(cursor, where_column_value_pairs)
+      return [row.__dict__ for row in rows]
+
+    lookup_cursor = cursor(class_)
+    reuse_cursor = lambda table_class: lookup_cursor
+    if (lookup_cursor.is_writable() or
+        lookup_cursor.tablet_type == shard_constants.TABLET_TYPE_MASTER):
+      where_column_value_pairs = [(entity_id_column, entity_id),]
+      rows =  class_.select_by_columns(reuse_cursor, where_column_value_pairs)
+      return [row.__dict__ for row in rows]
+
+    if db_object._is_iterable_container(entity_id):
+      entity_ids = list(entity_id)
+    else:
+      entity_ids = [entity_id,]
+    result = []
+    missing_ids = []
+    for en_id in entity_ids:
+      cached_rows = class_.lookup_cache.get(class_.table_name,
+                                            entity_id_column, en_id)
+      if cached_rows is None:
+        missing_ids.append(en_id)
+      else:
+        result.extend(dict(row) for row in cached_rows)
+    if not missing_ids:
+      return result
+
+    if len(missing_ids) == 1:
+      where_column_value_pairs = [(entity_id_column, missing_ids[0]),]
+    else:
+      where_column_value_pairs = [(entity_id_column, missing_ids),]
+    rows = [row.__dict__ for row in
+            class_.select_by_columns(reuse_cursor, where_column_value_pairs)]
+    rows_by_id = {}
+    for row in rows:
+      rows_by_id.setdefault(row[entity_id_column], []).append(row)
+    for en_id, id_rows in rows_by_id.iteritems():
+      # Missing entities are not cached, they may be created any time.
+      class_.lookup_cache.set(class_.table_name, entity_id_column, en_id,
+                              [dict(row) for row in id_rows])
+    result.extend(rows)
+    return result
+
+  @classmethod
+  def get_many(class_, cursor, entity_id_column, entity_ids,
+               chunk_size=LOOKUP_IN_CLAUSE_SIZE):
+    """Returns the lookup rows of many entity ids.
+
+    The ids are resolved with one IN query per chunk_size ids.
+    """
+    entity_ids = list(entity_ids)
+    rows = []
+    for i in xrange(0, len(entity_ids), chunk_size):
+      rows.extend(class_.get(cursor, entity_id_column,
+                             entity_ids[i:i + chunk_size]))
+    return rows
+
+  @classmethod
+  def invalidate_lookup_cache(class_, column_value_pairs):
+    """Drops the cached rows affected by a write of these column values."""
+    if class_.lookup_cache is None:
+      return
+    for column, value in column_value_pairs:
+      class_.lookup_cache.invalidate(class_.table_name, column, value)
 
   @classmethod
   def create(class_, cursor, **bind_vars):
+    class_.invalidate_lookup_cache(bind_vars.iteritems())
     return class_.insert(cursor, **bind_vars)
 
   @classmethod
   def update(class_, cursor, sharding_key_column_name, sharding_key,
              entity_id_column, new_entity_id):
+    class_.invalidate_lookup_cache(
+        [(sharding_key_column_name, sharding_key),
+         (entity_id_column, new_entity_id)])
     where_column_value_pairs = [(sharding_key_column_name, sharding_key),]
     update_column_value_pairs = [(entity_id_column,new_entity_id),]
     return class_.update_columns(cursor, where_column_value_pairs,
@@ -42,5 +118,7 @@ class LookupDBObject(db_object_unsharded.DBObjectUnsharded):
 
   @classmethod
   def delete(class_, cursor, sharding_key_column_name, sharding_key):
+    class_.invalidate_lookup_cache(
+        [(sharding_key_column_name, sharding_key),])
     where_column_value_pairs = [(sharding_key_column_name, sharding_key),]
     return class_.delete_by_columns(cursor, where_column_value_pairs)
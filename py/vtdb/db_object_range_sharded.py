@@ -8,6 +8,7 @@ and also create new lookup relationships.
 This module also contains helper methods for cursor creation for accessing lookup tables
 and methods for dml and select for the above mentioned base classes.
 """
+import collections
 import functools
 import struct
 
@@ -17,6 +18,7 @@ from vtdb import keyrange
 from vtdb import keyrange_constants
 from vtdb import shard_constants
 from vtdb import sql_builder
+from vtdb import topology
 from vtdb import vtgate_cursor
 
 
@@ -69,6 +71,12 @@ class DBObjectRangeSharded(db_object.DBObjectBase):
   # conjunction with sharding_key_column_name and entity_id_lookup_map.
   column_lookup_name_map = None
 
+  # sharding_key_vindex is a functional vindex (vindexes.Hash or
+  # vindexes.Numeric) that maps sharding keys to keyspace ids. When it is set
+  # sharding_key_to_keyspace_id doesn't need to be implemented, and lists of
+  # sharding keys are mapped in one batch.
+  sharding_key_vindex = None
+
   @classmethod
   def create_shard_routing(class_, *pargs,  **kargs):
     """This creates the ShardRouting object based on the kargs.
@@ -122,8 +130,17 @@ class DBObjectRangeSharded(db_object.DBObjectBase):
     else:
       # Routing using lookup based entity.
       routing.entity_column_name = entity_id_col
-      routing.entity_id_sharding_key_map = class_.lookup_sharding_key_from_entity_id(
-          lookup_cursor_method, entity_id_col, entity_id)
+      # Entity ids queued on the db operation are resolved in one batch.
+      entity_lookup_batch = kargs.get("entity_lookup_batch", None)
+      rows = None
+      if entity_lookup_batch is not None:
+        rows = entity_lookup_batch.get_rows(class_, entity_id_col, entity_id)
+      if rows is None:
+        routing.entity_id_sharding_key_map = class_.lookup_sharding_key_from_entity_id(
+            lookup_cursor_method, entity_id_col, entity_id)
+      else:
+        routing.entity_id_sharding_key_map = class_.entity_id_sharding_key_map_from_rows(
+            entity_id_col, rows)
 
     return routing
 
@@ -140,18 +157,15 @@ class DBObjectRangeSharded(db_object.DBObjectBase):
     keyspace_ids = None
     keyranges = None
     if routing.sharding_key is not None:
-      keyspace_ids = []
       if db_object._is_iterable_container(routing.sharding_key):
-        for sk in routing.sharding_key:
-          kid = class_.sharding_key_to_keyspace_id(sk)
-          keyspace_ids.append(pack_keyspace_id(kid))
+        keyspace_ids = class_.sharding_keys_to_packed_keyspace_ids(
+            list(routing.sharding_key))
       else:
-        kid = class_.sharding_key_to_keyspace_id(routing.sharding_key)
-        keyspace_ids = [pack_keyspace_id(kid),]
+        keyspace_ids = class_.sharding_keys_to_packed_keyspace_ids(
+            [routing.sharding_key,])
     elif routing.entity_id_sharding_key_map is not None:
-      keyspace_ids = []
-      for sharding_key in routing.entity_id_sharding_key_map.values():
-        keyspace_ids.append(pack_keyspace_id(class_.sharding_key_to_keyspace_id(sharding_key)))
+      keyspace_ids = class_.sharding_keys_to_packed_keyspace_ids(
+          routing.entity_id_sharding_key_map.values())
     elif routing.keyrange:
       keyranges = [routing.keyrange,]
 
@@ -184,10 +198,28 @@ class DBObjectRangeSharded(db_object.DBObjectBase):
     Returns:
       sharding key to be used for routing.
     """
-    entity_lookup_column = class_.get_lookup_column_name(entity_id_column)
-    lookup_class = class_.entity_id_lookup_map[entity_id_column]
+    lookup_class, entity_lookup_column = class_.get_entity_lookup(entity_id_column)
     rows = lookup_class.get(cursor_method, entity_lookup_column, entity_id)
+    return class_.entity_id_sharding_key_map_from_rows(entity_id_column, rows)
+
+  @classmethod
+  def get_entity_lookup(class_, entity_id_column):
+    """Returns the lookup class and lookup column name for an entity column."""
+    return (class_.entity_id_lookup_map[entity_id_column],
+            class_.get_lookup_column_name(entity_id_column))
+
+  @classmethod
+  def entity_id_sharding_key_map_from_rows(class_, entity_id_column, rows):
+    """Maps entity ids to sharding keys using the rows of their lookup table.
 
+    Args:
+      entity_id_column: Non-sharding key indexes that can be used for query routing.
+      rows: lookup rows, as dicts, of the entity ids.
+
+    Returns:
+      dict of entity id to sharding key.
+    """
+    entity_lookup_column = class_.get_lookup_column_name(entity_id_column)
     entity_id_sharding_key_map = {}
     if len(rows) == 0:
       #return entity_id_sharding_key_map
@@ -202,7 +234,7 @@ class DBObjectRangeSharded(db_object.DBObjectBase):
       if len(lookup_column_names) != 2:
         raise dbexceptions.ProgrammingError(
             "lookup table has more than two columns.")
-      sk_lookup_column = list(set(lookup_column_names) - set(list(entity_lookup_column)))[0]
+      sk_lookup_column = list(set(lookup_column_names) - set([entity_lookup_column]))[0]
     for row in rows:
       en_id = row[entity_lookup_column]
       sk = row[sk_lookup_column]
@@ -237,16 +269,21 @@ class DBObjectRangeSharded(db_object.DBObjectBase):
       # If the in-clause is based on sharding key
       entity_col_name = class_.sharding_key_column_name
       if db_object._is_iterable_container(cursor.routing.sharding_key):
-        for sk in list(cursor.routing.sharding_key):
-          entity_id_keyspace_id_map[sk] = pack_keyspace_id(class_.sharding_key_to_keyspace_id(sk))
+        sharding_keys = list(cursor.routing.sharding_key)
       else:
-        sk = cursor.routing.sharding_key
-        entity_id_keyspace_id_map[sk] = pack_keyspace_id(class_.sharding_key_to_keyspace_id(sk))
+        sharding_keys = [cursor.routing.sharding_key,]
+      entity_id_keyspace_id_map = dict(zip(
+          sharding_keys,
+          class_.sharding_keys_to_packed_keyspace_ids(sharding_keys)))
     elif cursor.routing.entity_id_sharding_key_map is not None:
       # If the in-clause is based on entity column
       entity_col_name = cursor.routing.entity_column_name
-      for en_id, sk in cursor.routing.entity_id_sharding_key_map.iteritems():
-        entity_id_keyspace_id_map[en_id] = pack_keyspace_id(class_.sharding_key_to_keyspace_id(sk))
+      entity_ids = cursor.routing.entity_id_sharding_key_map.keys()
+      sharding_keys = [cursor.routing.entity_id_sharding_key_map[en_id]
+                       for en_id in entity_ids]
+      entity_id_keyspace_id_map = dict(zip(
+          entity_ids,
+          class_.sharding_keys_to_packed_keyspace_ids(sharding_keys)))
     else:
       dbexceptions.ProgrammingError("Invalid routing method used.")
 
@@ -279,8 +316,29 @@ class DBObjectRangeSharded(db_object.DBObjectBase):
     Returns:
       keyspace_id
     """
+    if class_.sharding_key_vindex is not None:
+      return unpack_keyspace_id(
+          class_.sharding_key_vindex.map(None, [sharding_key,])[0])
     raise NotImplementedError
 
+  @classmethod
+  def sharding_keys_to_packed_keyspace_ids(class_, sharding_keys):
+    """Method to create packed keyspace_ids for a list of sharding keys.
+
+    This maps the whole list in one call to sharding_key_vindex if the class
+    has one, and calls sharding_key_to_keyspace_id for every key otherwise.
+
+    Args:
+      sharding_keys: list of sharding keys.
+
+    Returns:
+      list of packed keyspace_ids, in the order of sharding_keys.
+    """
+    if class_.sharding_key_vindex is not None:
+      return class_.sharding_key_vindex.map(None, sharding_keys)
+    return [pack_keyspace_id(class_.sharding_key_to_keyspace_id(sk))
+            for sk in sharding_keys]
+
   @db_object.db_class_method
   def insert(class_, cursor, **bind_vars):
     if class_.columns_list is None:
@@ -297,6 +355,97 @@ class DBObjectRangeSharded(db_object.DBObjectBase):
     cursor.execute(query, bind_vars)
     return cursor.lastrowid
 
+  @classmethod
+  def insert_many(class_, cursor_method, rows,
+                  max_rows_per_statement=sql_builder.MAX_INSERT_ROWS):
+    """Inserts rows of many sharding keys with multi-row INSERT statements.
+
+    Rows without a keyspace_id get the keyspace_id of their sharding key.
+    The rows are grouped by shard when the keyspace is in the topology
+    cache, and by keyspace_id otherwise. Each group is inserted by one
+    batch call, with at most max_rows_per_statement rows per statement.
+
+    Args:
+      cursor_method: cursor method of a write transaction.
+      rows: list of dicts of column values, all setting the same columns.
+      max_rows_per_statement: maximum number of rows of one statement.
+
+    Returns:
+      list of the lastrowid of every row, see insert_many_rowids.
+    """
+    if class_.columns_list is None:
+      raise dbexceptions.ProgrammingError("DB class should define columns_list")
+
+    rows = [dict(row) for row in rows]
+    class_._set_keyspace_ids(rows)
+    # This cursor only provides the connection and tablet type of the
+    # batches, routing it by keyrange doesn't query any lookup table.
+    cursor = cursor_method(class_,
+                           keyrange=keyrange_constants.NON_PARTIAL_KEYRANGE)
+    if not cursor.is_writable():
+      raise dbexceptions.ProgrammingError(
+          "Executing dmls on a non-writable cursor is not allowed.")
+
+    rowids = [None] * len(rows)
+    for row_indexes in class_._group_rows_by_shard(rows, cursor.tablet_type):
+      group_rows = [rows[i] for i in row_indexes]
+      keyspace_ids = sorted(set([pack_keyspace_id(row['keyspace_id'])
+                                 for row in group_rows]))
+      batch_cursor = vtgate_cursor.BatchVTGateCursor(
+          cursor._conn, class_.keyspace, cursor.tablet_type,
+          keyspace_ids=keyspace_ids, writable=True)
+      statements_rows = []
+      for i in xrange(0, len(group_rows), max_rows_per_statement):
+        statement_rows = group_rows[i:i + max_rows_per_statement]
+        query, bind_vars = class_.create_insert_many_query(statement_rows)
+        batch_cursor.execute(query, bind_vars)
+        statements_rows.append(statement_rows)
+      batch_cursor.flush()
+
+      group_rowids = []
+      # rowset is of the type (results, rowcount, lastrowid, fields)
+      for statement_rows, rowset in zip(statements_rows, batch_cursor.rowsets):
+        group_rowids.extend(class_.insert_many_rowids(statement_rows,
+                                                      rowset[2]))
+      for i, rowid in zip(row_indexes, group_rowids):
+        rowids[i] = rowid
+    return rowids
+
+  @classmethod
+  def _set_keyspace_ids(class_, rows):
+    """Sets the keyspace_id of the rows without one from their sharding key."""
+    missing_rows = [row for row in rows if not row.get('keyspace_id')]
+    if not missing_rows:
+      return
+    sharding_key_column = class_.sharding_key_column_name
+    if (sharding_key_column is None or
+        [row for row in missing_rows if sharding_key_column not in row]):
+      raise dbexceptions.ProgrammingError(
+          "Rows need a keyspace_id or the sharding key column %s" %
+          sharding_key_column)
+    keyspace_ids = class_.sharding_keys_to_packed_keyspace_ids(
+        [row[sharding_key_column] for row in missing_rows])
+    for row, kid in zip(missing_rows, keyspace_ids):
+      row['keyspace_id'] = unpack_keyspace_id(kid)
+
+  @classmethod
+  def _group_rows_by_shard(class_, rows, tablet_type):
+    """Returns the lists of indexes of the rows that go to the same shard.
+
+    Without the keyspace in the topology cache, the rows are only grouped
+    by keyspace_id.
+    """
+    keyspace_object = topology.get_keyspace(class_.keyspace)
+    groups = collections.OrderedDict()
+    for i, row in enumerate(rows):
+      if keyspace_object is None:
+        group_key = row['keyspace_id']
+      else:
+        group_key = keyspace_object.keyspace_id_to_shard_name_for_db_type(
+            row['keyspace_id'], tablet_type)
+      groups.setdefault(group_key, []).append(i)
+    return groups.values()
+
   @classmethod
   def _add_keyspace_id(class_, keyspace_id, where_column_value_pairs):
     where_col_dict = dict(where_column_value_pairs)
@@ -419,6 +568,43 @@ class DBObjectEntityRangeSharded(DBObjectRangeSharded):
     2. Entity table that creates a new entity and needs to create a lookup between
     that entity and sharding key.
     """
+    new_inserted_key, entity_id_map = class_._create_entity_lookup(
+        cursor_method, bind_vars)
+
+    # entity_id_map is used for routing and hence passed to cursor_method
+    new_cursor = functools.partial(cursor_method, entity_id_map=entity_id_map)
+    class_.insert_primary(new_cursor, **bind_vars)
+    return new_inserted_key
+
+  @classmethod
+  def insert_many(class_, cursor_method, rows,
+                  max_rows_per_statement=sql_builder.MAX_INSERT_ROWS):
+    """Creates the lookup relationships of the rows and inserts them in bulk.
+
+    The lookup entries are created one by one like in insert, since each
+    of them generates a key of its row. The rows of the primary table are
+    then inserted with DBObjectRangeSharded.insert_many.
+
+    Returns:
+      list of the new inserted key of every row, like insert.
+    """
+    rows = [dict(row) for row in rows]
+    new_inserted_keys = [class_._create_entity_lookup(cursor_method, row)[0]
+                         for row in rows]
+    super(DBObjectEntityRangeSharded, class_).insert_many(
+        cursor_method, rows, max_rows_per_statement=max_rows_per_statement)
+    return new_inserted_keys
+
+  @classmethod
+  def _create_entity_lookup(class_, cursor_method, bind_vars):
+    """Creates the lookup entry of a new row of the primary table.
+
+    This sets the new entity id or sharding key, and the keyspace_id, in
+    bind_vars.
+
+    Returns:
+      the new inserted key and the entity_id_map routing the row.
+    """
     if class_.sharding_key_column_name is None:
       raise dbexceptions.ProgrammingError(
           "sharding_key_column_name empty for DBObjectEntityRangeSharded")
@@ -462,10 +648,7 @@ class DBObjectEntityRangeSharded(DBObjectRangeSharded):
       keyspace_id = class_.sharding_key_to_keyspace_id(sharding_key)
       bind_vars['keyspace_id'] = keyspace_id
 
-    # entity_id_map is used for routing and hence passed to cursor_method
-    new_cursor = functools.partial(cursor_method, entity_id_map=entity_id_map)
-    class_.insert_primary(new_cursor, **bind_vars)
-    return new_inserted_key
+    return new_inserted_key, entity_id_map
 
   @db_object.write_db_class_method
   def update_columns(class_, cursor, where_column_value_pairs,
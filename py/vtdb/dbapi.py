@@ -1,3 +1,6 @@
+import itertools
+import threading
+
 from vtdb import dbexceptions
 
 # A simple class to trap and re-export only variables referenced from
@@ -11,7 +14,6 @@ class BindVarsProxy(object):
 
   def __getitem__(self, name):
     var = self.bind_vars[name]
-    self.bind_vars[name]
     self.accessed_keys.add(name)
     if isinstance(var, (list, set, tuple)):
       return '::%s' % name
@@ -22,13 +24,80 @@ class BindVarsProxy(object):
     return dict([(k, self.bind_vars[k]) for k in self.accessed_keys])
 
 
+# Number of query texts whose conversion is cached.
+MAX_PREPARED_QUERIES = 5000
+
+
+class _PreparedQuery(object):
+  """Conversions of a query text.
+
+  The converted text only depends on which of the referenced variables
+  are lists, so it is cached per list/scalar pattern of those variables.
+  """
+
+  def __init__(self, bind_names):
+    # Names of the bind variables referenced by the query.
+    self.bind_names = bind_names
+    # pattern -> converted query, a pattern having one bool per bind name.
+    self.queries = {}
+    self.last_used = next(_use_counter)
+
+
+# Lookups don't take a lock: they only stamp the entry with a use counter.
+# When the cache is full, the least recently used quarter is evicted at once.
+_prepared_queries = {}
+_prepared_queries_lock = threading.Lock()
+_use_counter = itertools.count()
+
+
+def _get_prepared_query(query):
+  prepared_query = _prepared_queries.get(query)
+  if prepared_query is not None:
+    prepared_query.last_used = next(_use_counter)
+  return prepared_query
+
+
+def _cache_prepared_query(query, prepared_query):
+  with _prepared_queries_lock:
+    if len(_prepared_queries) >= MAX_PREPARED_QUERIES:
+      by_use = sorted(_prepared_queries.iteritems(),
+                      key=lambda item: item[1].last_used)
+      for evicted_query, _ in by_use[:max(1, len(by_use) // 4)]:
+        del _prepared_queries[evicted_query]
+    _prepared_queries[query] = prepared_query
+
+
+def clear_prepared_queries():
+  with _prepared_queries_lock:
+    _prepared_queries.clear()
+
+
 # convert bind style from %(name)s to :name and export only the
 # variables bound.
 def prepare_query_bind_vars(query, bind_vars):
+  prepared_query = _get_prepared_query(query)
+  if prepared_query is not None:
+    bind_names = prepared_query.bind_names
+    try:
+      values = [bind_vars[k] for k in bind_names]
+    except KeyError as e:
+      raise dbexceptions.InterfaceError(e[0], query, bind_vars)
+    pattern = tuple([isinstance(v, (list, set, tuple)) for v in values])
+    prepared_text = prepared_query.queries.get(pattern)
+    if prepared_text is not None:
+      return prepared_text, dict(zip(bind_names, values))
+
   bind_vars_proxy = BindVarsProxy(bind_vars)
   try:
-    query = query % bind_vars_proxy
+    prepared_text = query % bind_vars_proxy
   except KeyError as e:
     raise dbexceptions.InterfaceError(e[0], query, bind_vars)
+  exported_bind_vars = bind_vars_proxy.export_bind_vars()
 
-  return query, bind_vars_proxy.export_bind_vars()
+  if prepared_query is None:
+    prepared_query = _PreparedQuery(tuple(exported_bind_vars))
+    _cache_prepared_query(query, prepared_query)
+  pattern = tuple([isinstance(bind_vars[k], (list, set, tuple))
+                   for k in prepared_query.bind_names])
+  prepared_query.queries[pattern] = prepared_text
+  return prepared_text, exported_bind_vars
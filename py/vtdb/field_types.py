@@ -1,6 +1,7 @@
 from array import array
 import datetime
 from decimal import Decimal
+import types
 from vtdb import times
 
 # These numbers should exactly match values defined in dist/mysql-5.1.52/include/mysql/mysql_com.h
@@ -82,26 +83,84 @@ NoneType = type(None)
 # That doesn't seem dramatically better than __sql_literal__ but it might
 # be move self-documenting.
 
+def _convert_bind_var(val):
+  """Converts a bind variable value, checking its attributes and type."""
+  if hasattr(val, '__sql_literal__'):
+    return val.__sql_literal__()
+  return _type_converter(type(val))(val)
+
+
+def _unchanged(val):
+  return val
+
+
+def _type_converter(type_):
+  """Returns the converter of the values of a type without __sql_literal__."""
+  if issubclass(type_, datetime.datetime):
+    return times.DateTimeToString
+  if issubclass(type_, datetime.date):
+    return times.DateToString
+  if issubclass(type_, set):
+    return sorted
+  if issubclass(type_, tuple):
+    return list
+  if issubclass(type_, (int, long, float, str, list, NoneType)):
+    return _unchanged
+  # NOTE(msolomon) begrudgingly I allow this - we just have too much code
+  # that relies on this.
+  # This accidentally solves our hideous dependency on mx.DateTime.
+  return str
+
+
+_HEAPTYPE_FLAG = 1 << 9
+
+
+def _make_converter(type_):
+  """Returns the converter for all values of a type.
+
+  The value itself only needs to be inspected when it may have a
+  __sql_literal__: the type has one, or its instances have a __dict__, are
+  old-style instances, or have a custom attribute lookup.
+  """
+  if (hasattr(type_, '__sql_literal__') or type_.__dictoffset__ or
+      type_ is types.InstanceType):
+    return _convert_bind_var
+  for class_ in type_.__mro__:
+    if (class_.__flags__ & _HEAPTYPE_FLAG and
+        ('__getattr__' in vars(class_) or '__getattribute__' in vars(class_))):
+      return _convert_bind_var
+  return _type_converter(type_)
+
+
+# type -> converter of its values, filled on first use of each type.
+_converters = {}
+
+# Values of these exact types are passed through unchanged.
+_PLAIN_TYPES = frozenset([int, long, str, float, NoneType])
+
+
 def convert_bind_vars(bind_variables):
-  new_vars = {}
   if bind_variables is None:
-    return new_vars
+    return {}
+  # Fast path: most bind variables are plain ids and strings.
+  plain_types = _PLAIN_TYPES
+  for val in bind_variables.itervalues():
+    if type(val) not in plain_types:
+      break
+  else:
+    return dict(bind_variables)
+
+  new_vars = {}
+  converters = _converters
   for key, val in bind_variables.iteritems():
-    if hasattr(val, '__sql_literal__'):
-      new_vars[key] = val.__sql_literal__()
-    elif isinstance(val, datetime.datetime):
-      new_vars[key] = times.DateTimeToString(val)
-    elif isinstance(val, datetime.date):
-      new_vars[key] = times.DateToString(val)
-    elif isinstance(val, set):
-      new_vars[key] = sorted(val)
-    elif isinstance(val, tuple):
-      new_vars[key] = list(val)
-    elif isinstance(val, (int, long, float, str, list, NoneType)):
+    type_ = type(val)
+    if type_ in plain_types:
       new_vars[key] = val
-    else:
-      # NOTE(msolomon) begrudgingly I allow this - we just have too much code
-      # that relies on this.
-      # This accidentally solves our hideous dependency on mx.DateTime.
-      new_vars[key] = str(val)
+      continue
+    try:
+      converter = converters[type_]
+    except KeyError:
+      converter = _make_converter(type_)
+      converters[type_] = converter
+    new_vars[key] = converter(val)
   return new_vars
@@ -2,6 +2,7 @@
 # Use of this source code is governed by a BSD-style license that can
 # be found in the LICENSE file.
 
+import bisect
 import struct
 
 from vtdb import dbexceptions
@@ -26,6 +27,8 @@ class Keyspace(object):
     self.sharding_col_name = data.get('ShardingColumnName', "")
     self.sharding_col_type = data.get('ShardingColumnType', keyrange_constants.KIT_UNSET)
     self.served_from = data.get('ServedFrom', None)
+    # db_type -> _ShardIndex, built on first use.
+    self._shard_indexes = {}
 
   def get_shards(self, db_type):
     if not db_type:
@@ -47,20 +50,67 @@ class Keyspace(object):
     shards = self.get_shards(db_type)
     return [shard['Name'] for shard in shards]
 
+  def _get_shard_index(self, db_type):
+    try:
+      return self._shard_indexes[db_type]
+    except KeyError:
+      shard_index = _ShardIndex(self.get_shards(db_type))
+      self._shard_indexes[db_type] = shard_index
+      return shard_index
+
   def keyspace_id_to_shard_name_for_db_type(self, keyspace_id, db_type):
     if not keyspace_id:
       raise ValueError('keyspace_id is not set')
     if not db_type:
       raise ValueError('db_type is not set')
+    return self._get_shard_index(db_type).find_shard_name(keyspace_id)
+
+  def keyspace_ids_to_shard_names_for_db_type(self, keyspace_ids, db_type):
+    """Groups keyspace ids by the shard that contains them.
+
+    Args:
+      keyspace_ids: list of keyspace ids.
+      db_type: tablet type whose shard map is used.
+
+    Returns:
+      Dict of shard name to the list of its keyspace ids, in the order of
+      keyspace_ids. Shards without any of the keyspace ids are not included.
+    """
+    if not db_type:
+      raise ValueError('db_type is not set')
+    shard_index = self._get_shard_index(db_type)
+    shard_kids = {}
+    for keyspace_id in keyspace_ids:
+      shard_name = shard_index.find_shard_name(keyspace_id)
+      try:
+        shard_kids[shard_name].append(keyspace_id)
+      except KeyError:
+        shard_kids[shard_name] = [keyspace_id]
+    return shard_kids
+
+
+class _ShardIndex(object):
+  """Shards of a db_type sorted by the start of their key range.
+
+  Shard key ranges don't overlap, so the only shard that can contain a
+  keyspace id is the last one starting at or before it, which is found by
+  bisection.
+  """
+
+  def __init__(self, shards):
+    self.shards = shards
+    sorted_shards = sorted(shards, key=lambda shard: shard['KeyRange']['Start'])
+    self.starts = [shard['KeyRange']['Start'] for shard in sorted_shards]
+    self.ends = [shard['KeyRange']['End'] for shard in sorted_shards]
+    self.names = [shard['Name'] for shard in sorted_shards]
+
+  def find_shard_name(self, keyspace_id):
     # Pack this into big-endian and do a byte-wise comparison.
     pkid = pack_keyspace_id(keyspace_id)
-    shards = self.get_shards(db_type)
-    for shard in shards:
-      if _shard_contain_kid(pkid,
-                            shard['KeyRange']['Start'],
-                            shard['KeyRange']['End']):
-        return shard['Name']
-    raise ValueError('cannot find shard for keyspace_id %s in %s' % (keyspace_id, shards))
+    i = bisect.bisect_right(self.starts, pkid) - 1
+    if i >= 0 and _shard_contain_kid(pkid, self.starts[i], self.ends[i]):
+      return self.names[i]
+    raise ValueError('cannot find shard for keyspace_id %s in %s' % (keyspace_id, self.shards))
 
 
 def _shard_contain_kid(pkid, start, end):
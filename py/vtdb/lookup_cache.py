@@ -0,0 +1,117 @@
+"""Cache of lookup table rows for entity routing.
+
+Routing a query by a lookup based entity id first reads the lookup table
+to find the sharding key of the entity. When LookupDBObject.lookup_cache is
+set, LookupDBObject.get serves those rows from this cache for replica reads
+and skips the round trip to the lookup keyspace.
+
+Writes through LookupDBObject.create, update and delete invalidate the
+affected entries. Reads from master bypass the cache entirely. A replica
+read can still cache a row that is older than the last write, for at most
+ttl seconds.
+"""
+
+import collections
+import threading
+import time
+
+from vtdb import vtgate_utils
+
+
+class LookupCache(object):
+  """LRU cache of lookup rows by (table, column, value), with expiration.
+
+  Besides the entries themselves, the cache indexes every entry by the
+  other column values of its rows, so that invalidating a sharding key
+  also drops the entries of all entity ids that were mapped to it.
+
+  Attributes:
+    ttl: seconds for which an entry is served.
+    max_entries: upper bound on the number of cached entries.
+    hits, misses, invalidations: usage counters.
+  """
+
+  def __init__(self, ttl=60, max_entries=100000):
+    self.ttl = ttl
+    self.max_entries = max_entries
+    self.hits = 0
+    self.misses = 0
+    self.invalidations = 0
+    # key -> (expiry time, rows), oldest first.
+    self._entries = collections.OrderedDict()
+    # (table, column, value) -> set of keys whose rows contain that value.
+    self._references = {}
+    self._lock = threading.Lock()
+
+  @staticmethod
+  def make_key(table_name, column, value):
+    return (table_name, column, vtgate_utils.canonical_value(value))
+
+  def get(self, table_name, column, value):
+    """Returns the cached rows for column = value, or None."""
+    key = self.make_key(table_name, column, value)
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is None or entry[0] <= time.time():
+        if entry is not None:
+          self._remove(key)
+        self.misses += 1
+        return None
+      # Re-inserting makes this the most recently used entry.
+      del self._entries[key]
+      self._entries[key] = entry
+      self.hits += 1
+      return entry[1]
+
+  def set(self, table_name, column, value, rows):
+    """Caches the lookup rows, as dicts, for column = value."""
+    key = self.make_key(table_name, column, value)
+    with self._lock:
+      self._remove(key)
+      self._entries[key] = (time.time() + self.ttl, rows)
+      for ref in self._row_references(key, rows):
+        self._references.setdefault(ref, set()).add(key)
+      while len(self._entries) > self.max_entries:
+        self._remove(next(iter(self._entries)))
+
+  def invalidate(self, table_name, column, value):
+    """Drops the entries for column = value and the rows containing it."""
+    key = self.make_key(table_name, column, value)
+    with self._lock:
+      self.invalidations += 1
+      self._remove(key)
+      for referencing_key in self._references.pop(key, ()):
+        self._remove(referencing_key)
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+      self._references.clear()
+
+  def get_stats(self):
+    with self._lock:
+      return {'Hits': self.hits,
+              'Misses': self.misses,
+              'Invalidations': self.invalidations,
+              'Entries': len(self._entries)}
+
+  def _row_references(self, key, rows):
+    table_name, column, _ = key
+    refs = set()
+    for row in rows:
+      for other_column, other_value in row.iteritems():
+        if other_column != column:
+          refs.add(self.make_key(table_name, other_column, other_value))
+    return refs
+
+  def _remove(self, key):
+    """Removes an entry and its references. Must be called with the lock."""
+    entry = self._entries.pop(key, None)
+    if entry is None:
+      return
+    for ref in self._row_references(key, entry[1]):
+      referencing_keys = self._references.get(ref)
+      if referencing_keys is not None:
+        referencing_keys.discard(key)
+        if not referencing_keys:
+          del self._references[ref]
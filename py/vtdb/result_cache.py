@@ -0,0 +1,116 @@
+"""Result cache for replica reads.
+
+Read-mostly tables can declare a result_cache_ttl on their DBObjectBase
+subclass. When the DatabaseContext has a result cache, cursors created for
+such tables outside of write transactions and off the master tablet type
+serve repeated identical queries from the cache for that many seconds.
+
+Any object with get(key) and set(key, value, ttl) methods can be used as
+the cache. LRUResultCache is the in-process implementation.
+"""
+
+import collections
+import threading
+import time
+
+from vtdb import vtgate_utils
+
+
+def make_key(keyspace, tablet_type, routing, sql, bind_variables):
+  """Returns the cache key for a query.
+
+  Args:
+    keyspace: keyspace of the query.
+    tablet_type: tablet type of the query.
+    routing: keyspace_ids, keyranges or entity map the query is sent to.
+    sql: query text.
+    bind_variables: bind variables of the query.
+
+  Returns:
+    Hashable key.
+  """
+  return (keyspace, tablet_type, vtgate_utils.canonical_value(routing), sql,
+          vtgate_utils.canonical_value(bind_variables))
+
+
+def _estimate_size(value):
+  """Returns a rough estimate of the memory used by a cached value."""
+  if isinstance(value, basestring):
+    return 40 + len(value)
+  if isinstance(value, (list, tuple)):
+    return 64 + 8 * len(value) + sum(_estimate_size(v) for v in value)
+  if isinstance(value, dict):
+    return 280 + sum(_estimate_size(k) + _estimate_size(v)
+                     for k, v in value.iteritems())
+  return 24
+
+
+class LRUResultCache(object):
+  """Memory-bounded LRU cache with per-entry expiration.
+
+  Attributes:
+    max_bytes: upper bound on the estimated size of all cached values.
+    max_entries: upper bound on the number of cached values.
+    hits, misses, expirations, evictions: usage counters.
+  """
+
+  def __init__(self, max_bytes=64 * 1024 * 1024, max_entries=100000):
+    self.max_bytes = max_bytes
+    self.max_entries = max_entries
+    self.size = 0
+    self.hits = 0
+    self.misses = 0
+    self.expirations = 0
+    self.evictions = 0
+    # key -> (expiry time, size, value), oldest first.
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key):
+    """Returns the cached value for key, or None."""
+    with self._lock:
+      entry = self._entries.pop(key, None)
+      if entry is None:
+        self.misses += 1
+        return None
+      expiry, size, value = entry
+      if expiry <= time.time():
+        self.size -= size
+        self.expirations += 1
+        self.misses += 1
+        return None
+      # Re-inserting makes this the most recently used entry.
+      self._entries[key] = entry
+      self.hits += 1
+      return value
+
+  def set(self, key, value, ttl):
+    """Caches value for ttl seconds."""
+    size = _estimate_size(value)
+    if size > self.max_bytes:
+      return
+    with self._lock:
+      old_entry = self._entries.pop(key, None)
+      if old_entry is not None:
+        self.size -= old_entry[1]
+      self._entries[key] = (time.time() + ttl, size, value)
+      self.size += size
+      while (self.size > self.max_bytes or
+             len(self._entries) > self.max_entries):
+        _, (_, evicted_size, _) = self._entries.popitem(last=False)
+        self.size -= evicted_size
+        self.evictions += 1
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+      self.size = 0
+
+  def get_stats(self):
+    with self._lock:
+      return {'Hits': self.hits,
+              'Misses': self.misses,
+              'Expirations': self.expirations,
+              'Evictions': self.evictions,
+              'Entries': len(self._entries),
+              'Size': self.size}
@@ -5,6 +5,7 @@ Helper classes and fucntions for building queries.
 
 import itertools
 import pprint
+import time
 
 #TODO: add unit-tests for the methods and classes.
 #TODO: integration with SQL Alchemy ?
@@ -183,10 +184,152 @@ def build_where_clause(column_value_pairs):
   return where_clause, bind_vars
 
 
+# Query templates, keyed by the shape of the builder call: the table, the
+# columns, the where columns with the operator and IN-list length of each,
+# and the order by, group by and limit clauses. The SQL text only depends
+# on that shape, so only the bind variables are computed for a cached shape.
+# Calls with values that generate their own SQL (SQLOperator, Flag,
+# MySQLFunction...) are not cached.
+MAX_QUERY_TEMPLATES = 10000
+_query_templates = {}
+
+
+class QueryTemplate(object):
+  """SQL text of a query shape and the bind variable names it uses.
+
+  Attributes:
+    sql: query text with %(name)s placeholders.
+    where_bind_names: for every where column value pair, the bind variable
+    name of a scalar value, or the tuple of names of an IN-list.
+    update_bind_names: bind variable names of the update values.
+  """
+
+  def __init__(self, sql, where_bind_names=(), update_bind_names=()):
+    self.sql = sql
+    self.where_bind_names = where_bind_names
+    self.update_bind_names = update_bind_names
+
+  def where_bind_vars(self, column_value_pairs):
+    bind_vars = {}
+    for bind_names, (_, value) in zip(self.where_bind_names,
+                                      column_value_pairs):
+      if isinstance(bind_names, tuple):
+        bind_vars.update(zip(bind_names, value))
+      else:
+        bind_vars[bind_names] = value
+    if not bind_vars:
+      bind_vars = dict(column_value_pairs)
+    return bind_vars
+
+  def update_bind_vars(self, update_column_value_pairs):
+    return dict((bind_name, value) for bind_name, (_, value) in
+                zip(self.update_bind_names, update_column_value_pairs))
+
+
+def clear_query_templates():
+  _query_templates.clear()
+
+
+def _cache_query_template(key, template):
+  if len(_query_templates) >= MAX_QUERY_TEMPLATES:
+    _query_templates.clear()
+  _query_templates[key] = template
+
+
+def _where_shape(column_value_pairs):
+  """Returns the where columns with their IN-list lengths, or None.
+
+  Scalar values have a length of None. None is returned if a value builds
+  its own SQL.
+  """
+  if not column_value_pairs:
+    return ()
+  shape = []
+  for column, value in column_value_pairs:
+    if isinstance(value, (Flag, SQLOperator, NullSafeNotValue)):
+      return None
+    if isinstance(value, (tuple, list, set)):
+      shape.append((column, len(value)))
+    else:
+      shape.append((column, None))
+  return tuple(shape)
+
+
+def _where_bind_names(where_shape):
+  """Returns the bind variable names build_where_clause uses for a shape."""
+  counter = itertools.count(1)
+  bind_names = []
+  for column, length in where_shape:
+    if length is None:
+      bind_names.append(choose_bind_name(column, counter=counter))
+    else:
+      bind_names.append(tuple(choose_bind_name(column, counter=counter)
+                              for _ in xrange(length)))
+  return tuple(bind_names)
+
+
+def _clause_shape(clause):
+  """Returns a hashable form of an order by or group by clause."""
+  if type(clause) in (tuple, list):
+    return tuple(_clause_shape(subclause) for subclause in clause)
+  return clause
+
+
+def _limit_shape(limit):
+  if not limit:
+    return None
+  if isinstance(limit, tuple):
+    return len(limit)
+  return 1
+
+
+def _get_query_template(key):
+  """Returns the cached template for key, None if key is None or unhashable."""
+  if key is None:
+    return None
+  try:
+    return _query_templates.get(key)
+  except TypeError:
+    return None
+
+
 def select_by_columns_query(select_column_list, table_name, column_value_pairs=None,
                             order_by=None, group_by=None, limit=None,
                             for_update=False,client_aggregate=False,
                             vt_routing_info=None):
+  key = None
+  where_shape = _where_shape(column_value_pairs)
+  if (where_shape is not None and vt_routing_info is None and
+      not [column for column in select_column_list
+           if not isinstance(column, basestring)]):
+    key = ('select', tuple(select_column_list), table_name, where_shape,
+           _clause_shape(order_by), _clause_shape(group_by),
+           _limit_shape(limit), bool(for_update), bool(client_aggregate))
+  template = _get_query_template(key)
+  if template is None:
+    query, bind_vars = _build_select_by_columns_query(
+        select_column_list, table_name, column_value_pairs=column_value_pairs,
+        order_by=order_by, group_by=group_by, limit=limit,
+        for_update=for_update, client_aggregate=client_aggregate,
+        vt_routing_info=vt_routing_info)
+    if key is not None:
+      _cache_query_template(key, QueryTemplate(
+          query, where_bind_names=_where_bind_names(where_shape)))
+    return query, bind_vars
+
+  if column_value_pairs:
+    bind_vars = template.where_bind_vars(column_value_pairs)
+  else:
+    bind_vars = {}
+  if limit:
+    bind_vars.update(build_limit_clause(limit)[1])
+  return template.sql, bind_vars
+
+
+def _build_select_by_columns_query(select_column_list, table_name,
+                                   column_value_pairs=None, order_by=None,
+                                   group_by=None, limit=None, for_update=False,
+                                   client_aggregate=False, vt_routing_info=None):
 
   if client_aggregate:
     clause_list = [select_clause(select_column_list, table_name,
@@ -222,6 +365,38 @@ def select_by_columns_query(select_column_list, table_name, column_value_pairs=N
 def update_columns_query(table_name, where_column_value_pairs=None,
                          update_column_value_pairs=None, limit=None,
                          order_by=None):
+  key = None
+  where_shape = _where_shape(where_column_value_pairs)
+  if (where_shape and update_column_value_pairs and
+      not [value for _, value in update_column_value_pairs
+           if isinstance(value, (Flag, Increment, MySQLFunction))]):
+    key = ('update', table_name,
+           tuple(column for column, _ in update_column_value_pairs),
+           where_shape, _clause_shape(order_by), _limit_shape(limit))
+  template = _get_query_template(key)
+  if template is None:
+    query, bind_vals = _build_update_columns_query(
+        table_name, where_column_value_pairs=where_column_value_pairs,
+        update_column_value_pairs=update_column_value_pairs, limit=limit,
+        order_by=order_by)
+    if key is not None:
+      _cache_query_template(key, QueryTemplate(
+          query, where_bind_names=_where_bind_names(where_shape),
+          update_bind_names=tuple(
+              'update_set_%s' % i
+              for i in xrange(len(update_column_value_pairs)))))
+    return query, bind_vals
+
+  bind_vals = template.update_bind_vars(update_column_value_pairs)
+  bind_vals.update(template.where_bind_vars(where_column_value_pairs))
+  if limit:
+    bind_vals.update(build_limit_clause(limit)[1])
+  return template.sql, bind_vals
+
+
+def _build_update_columns_query(table_name, where_column_value_pairs=None,
+                                update_column_value_pairs=None, limit=None,
+                                order_by=None):
   if not update_column_value_pairs:
     raise dbexceptions.ProgrammingError("No update values specified.")
 
@@ -272,6 +447,27 @@ def update_columns_query(table_name, where_column_value_pairs=None,
 
 def delete_by_columns_query(table_name, where_column_value_pairs=None,
                             limit=None):
+  key = None
+  where_shape = _where_shape(where_column_value_pairs)
+  if where_shape:
+    key = ('delete', table_name, where_shape, _limit_shape(limit))
+  template = _get_query_template(key)
+  if template is None:
+    query, bind_vars = _build_delete_by_columns_query(
+        table_name, where_column_value_pairs=where_column_value_pairs,
+        limit=limit)
+    if key is not None:
+      _cache_query_template(key, QueryTemplate(
+          query, where_bind_names=_where_bind_names(where_shape)))
+    return query, bind_vars
+
+  bind_vars = template.where_bind_vars(where_column_value_pairs)
+  bind_vars.update(build_limit_clause(limit)[1])
+  return template.sql, bind_vars
+
+
+def _build_delete_by_columns_query(table_name, where_column_value_pairs=None,
+                                   limit=None):
   where_clause, bind_vars = build_where_clause(where_column_value_pairs)
   limit_clause, limit_bind_vars = build_limit_clause(limit)
   bind_vars.update(limit_bind_vars)
@@ -284,6 +480,27 @@ def delete_by_columns_query(table_name, where_column_value_pairs=None,
 
 
 def insert_query(table_name, columns_list, **bind_variables):
+  key = None
+  # build_values_clause fills in the time columns and expands functions.
+  if not [column for column in columns_list
+          if (column in ('time_created', 'time_updated') and
+              column not in bind_variables) or
+          type(bind_variables.get(column)) == MySQLFunction]:
+    key = ('insert', table_name, tuple(columns_list),
+           tuple(column for column in columns_list
+                 if column in bind_variables))
+  template = _get_query_template(key)
+  if template is not None:
+    return template.sql, bind_variables
+
+  query, bind_variables = _build_insert_query(table_name, columns_list,
+                                              **bind_variables)
+  if key is not None:
+    _cache_query_template(key, QueryTemplate(query))
+  return query, bind_variables
+
+
+def _build_insert_query(table_name, columns_list, **bind_variables):
   values_clause, bind_list = build_values_clause(columns_list,
                                                  bind_variables)
 
@@ -295,6 +512,67 @@ def insert_query(table_name, columns_list, **bind_variables):
   return query, bind_variables
 
 
+# Maximum number of rows inserted by one multi-row INSERT statement.
+MAX_INSERT_ROWS = 500
+
+
+def insert_many_query(table_name, columns_list, rows):
+  """Builds an INSERT statement with one VALUES tuple per row.
+
+  Args:
+    table_name: table to insert into.
+    columns_list: columns of the table.
+    rows: list of dicts of column values. All rows must set the same
+    columns, time_created and time_updated default to the current time.
+
+  Returns:
+    query, bind_variables. The value of column c in row i is bound as c_i.
+
+  Raises:
+    ValueError: if rows is empty, the rows set different columns or a value
+    is a MySQLFunction.
+  """
+  if not rows:
+    raise ValueError('Called with empty "rows"')
+  now = None
+  insert_columns = None
+  bind_variables = {}
+  for i, row in enumerate(rows):
+    row_columns = []
+    for column in columns_list:
+      if column in row:
+        value = row[column]
+        if type(value) == MySQLFunction:
+          raise ValueError('MySQLFunction values are not supported', column)
+      elif column in ('time_created', 'time_updated'):
+        if now is None:
+          now = int(time.time())
+        value = now
+      else:
+        continue
+      row_columns.append(column)
+      bind_variables['%s_%d' % (column, i)] = value
+    if insert_columns is None:
+      insert_columns = row_columns
+    elif row_columns != insert_columns:
+      raise ValueError('rows set different columns', insert_columns,
+                       row_columns)
+
+  key = ('insert_many', table_name, tuple(insert_columns), len(rows))
+  template = _get_query_template(key)
+  if template is not None:
+    return template.sql, bind_variables
+
+  values_clauses = []
+  for i in xrange(len(rows)):
+    values_clauses.append('(%s)' % ', '.join(
+        ['%%(%s_%d)s' % (column, i) for column in insert_columns]))
+  query = 'INSERT INTO %s (%s) VALUES %s' % (
+      table_name, colstr(insert_columns), ', '.join(values_clauses))
+  _cache_query_template(key, QueryTemplate(query))
+  return query, bind_variables
+
+
 def build_aggregate_query(table_name, id_column_name, sort_func='min'):
   query_clause = 'SELECT %(id_col)s FROM %(table_name)s ORDER BY %(id_col)s'
   if sort_func == 'max':
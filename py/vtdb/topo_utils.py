@@ -4,6 +4,8 @@
 
 import logging
 import random
+import threading
+import time
 
 from zk import zkocc
 from vtdb import topology
@@ -31,6 +33,121 @@ class VTConnParams(object):
     self.password = password
 
 
+# Seconds the endpoints of a (keyspace, shard, db_type) are cached.
+__end_points_ttl = 5
+# Seconds a failed or empty endpoints read is cached.
+__end_points_negative_ttl = 1
+# Seconds an endpoint that failed stays at the back of the candidate list.
+__end_point_failure_penalty = 30
+
+# (keyspace, shard, db_type) -> (EndPoints data or None, time of the read)
+__end_points_cache = {}
+# (keyspace, shard, db_type) -> threading.Event set when its read is done,
+# so concurrent callers share a single GetEndPoints call.
+__end_points_reads = {}
+# 'host:port' -> time of its last failure
+__failed_end_points = {}
+__end_points_lock = threading.Lock()
+
+
+def set_end_points_cache_ttl(ttl, negative_ttl):
+  global __end_points_ttl
+  global __end_points_negative_ttl
+  __end_points_ttl = ttl
+  __end_points_negative_ttl = negative_ttl
+
+
+def invalidate_end_points(keyspace_name, shard, db_type):
+  with __end_points_lock:
+    __end_points_cache.pop((keyspace_name, shard, db_type), None)
+
+
+# mark_end_point_failed moves addr to the back of the candidate lists
+# for a while. mark_end_point_healthy cancels it.
+def mark_end_point_failed(addr):
+  with __end_points_lock:
+    __failed_end_points[addr] = time.time()
+
+
+def mark_end_point_healthy(addr):
+  with __end_points_lock:
+    __failed_end_points.pop(addr, None)
+
+
+def is_end_point_failed(addr):
+  """Returns True if addr failed less than the failure penalty ago."""
+  failure_time = __failed_end_points.get(addr)
+  return (failure_time is not None and
+          failure_time >= time.time() - __end_point_failure_penalty)
+
+
+def _get_cached_end_points(key, now):
+  try:
+    data, read_time = __end_points_cache[key]
+  except KeyError:
+    return False, None
+  if data is None or not data.get('Entries'):
+    ttl = __end_points_negative_ttl
+  else:
+    ttl = __end_points_ttl
+  if read_time + ttl < now:
+    return False, None
+  return True, data
+
+
+# _get_end_points returns the EndPoints data of a shard, or None if
+# it couldn't be read.
+def _get_end_points(topo_client, keyspace_name, shard, db_type, db_key):
+  key = (keyspace_name, shard, db_type)
+  while True:
+    with __end_points_lock:
+      found, data = _get_cached_end_points(key, time.time())
+      if found:
+        return data
+      read_done = __end_points_reads.get(key)
+      if read_done is None:
+        read_done = threading.Event()
+        __end_points_reads[key] = read_done
+        break
+    read_done.wait()
+
+  data = None
+  try:
+    data = topo_client.get_end_points('local', keyspace_name, shard, db_type)
+  except zkocc.ZkOccError as e:
+    vtdb_logger.get_logger().topo_zkocc_error('do data', db_key, e)
+  except Exception as e:
+    vtdb_logger.get_logger().topo_exception('failed to get or parse topo data', db_key, e)
+  finally:
+    with __end_points_lock:
+      if data is None or 'Entries' in data:
+        __end_points_cache[key] = (data, time.time())
+      del __end_points_reads[key]
+    read_done.set()
+  return data
+
+
+# _order_by_failures shuffles host_port_list, with the endpoints that
+# failed recently at the end, oldest failure first.
+def _order_by_failures(host_port_list):
+  random.shuffle(host_port_list)
+  if not __failed_end_points:
+    return host_port_list
+  penalty_end = time.time() - __end_point_failure_penalty
+  with __end_points_lock:
+    failure_times = [__failed_end_points.get('%s:%s' % (host, port))
+                     for host, port, _ in host_port_list]
+  healthy = []
+  failed = []
+  for host_port, failure_time in zip(host_port_list, failure_times):
+    if failure_time is None or failure_time < penalty_end:
+      healthy.append(host_port)
+    else:
+      failed.append((failure_time, host_port))
+  failed.sort()
+  return healthy + [host_port for _, host_port in failed]
+
+
 def get_db_params_for_tablet_conn(topo_client, keyspace_name, shard, db_type, timeout, encrypted, user, password):
   db_params_list = []
   encrypted_service = 'vts'
@@ -50,13 +167,9 @@ def get_db_params_for_tablet_conn(topo_client, keyspace_name, shard, db_type, ti
     if new_keyspace is not None:
       keyspace_name = new_keyspace
 
-  try:
-    end_points_data = topo_client.get_end_points('local', keyspace_name, shard, db_type)
-  except zkocc.ZkOccError as e:
-    vtdb_logger.get_logger().topo_zkocc_error('do data', db_key, e)
-    return []
-  except Exception as e:
-    vtdb_logger.get_logger().topo_exception('failed to get or parse topo data', db_key, e)
+  end_points_data = _get_end_points(topo_client, keyspace_name, shard,
+                                    db_type, db_key)
+  if end_points_data is None:
     return []
 
   end_points_list = []
@@ -75,11 +188,9 @@ def get_db_params_for_tablet_conn(topo_client, keyspace_name, shard, db_type, ti
                    True)
       encrypted_host_port_list.append(host_port)
   if encrypted and len(encrypted_host_port_list) > 0:
-    random.shuffle(encrypted_host_port_list)
-    end_points_list = encrypted_host_port_list
+    end_points_list = _order_by_failures(encrypted_host_port_list)
   else:
-    random.shuffle(host_port_list)
-    end_points_list = host_port_list
+    end_points_list = _order_by_failures(host_port_list)
 
 
   for host, port, encrypted in end_points_list:
@@ -14,9 +14,18 @@
 #
 
 import logging
+import os
+import Queue
 import random
+import threading
 import time
 
+try:
+  # use optimized cbson when available
+  import cbson as _bson
+except ImportError:
+  import bson as _bson
+
 from vtdb import dbexceptions
 from vtdb import keyrange
 from vtdb import keyrange_constants
@@ -41,9 +50,27 @@ def set_keyspace_fetch_throttle(throttle):
   __keyspace_fetch_throttle = throttle
 
 
+# TopologyCache registered with set_topology_cache, it takes precedence
+# over __keyspace_map.
+__topology_cache = None
+
+
+def set_topology_cache(topology_cache):
+  global __topology_cache
+  __topology_cache = topology_cache
+
+
+def get_topology_cache():
+  return __topology_cache
+
+
 # This returns the keyspace object for the keyspace name
 # from the cached topology map or None if not found.
 def get_keyspace(name):
+  if __topology_cache is not None:
+    ks = __topology_cache.get_keyspace(name)
+    if ks is not None:
+      return ks
   try:
     return __keyspace_map[name][0]
   except KeyError:
@@ -70,6 +97,11 @@ def __set_keyspace(ks):
 def refresh_keyspace(zkocc_client, name):
   global __keyspace_fetch_throttle
 
+  # With a topology cache, the refresh happens in its background thread.
+  if __topology_cache is not None:
+    __topology_cache.request_refresh()
+    return
+
   time_last_fetch = get_time_last_fetch(name)
   if time_last_fetch is None:
     return
@@ -86,41 +118,448 @@ def refresh_keyspace(zkocc_client, name):
   vtdb_logger.get_logger().topo_keyspace_fetch(name, topo_rtt)
 
 
+# Default seconds between two refreshes of a TopologyCache.
+DEFAULT_TOPOLOGY_REFRESH_INTERVAL = 30
+# Default minimum seconds between two refreshes of a TopologyCache.
+DEFAULT_TOPOLOGY_MIN_REFRESH_INTERVAL = 5
+
+
+class TopologySnapshot(object):
+  """SrvKeyspaces of all the keyspaces, as of one refresh.
+
+  Snapshots are never modified: a refresh that finds a change swaps in a
+  new one, which shares the Keyspace objects of the unchanged keyspaces.
+
+  Attributes:
+    version: number of changes found before this snapshot.
+    keyspaces: dict of keyspace name to keyspace.Keyspace.
+    srv_keyspaces: dict of keyspace name to its SrvKeyspace data.
+  """
+
+  def __init__(self, version, keyspaces, srv_keyspaces):
+    self.version = version
+    self.keyspaces = keyspaces
+    self.srv_keyspaces = srv_keyspaces
+
+
+class TopologyCache(object):
+  """Topology of a topo client, refreshed by a background thread.
+
+  Readers get the current snapshot without locking or waiting for the
+  topo server. refresh_keyspace and request_refresh only wake up the
+  refresh thread. A requested refresh starts at least
+  min_refresh_interval after the previous refresh, periodic ones every
+  refresh_interval.
+
+  Attributes:
+    topo_client: zkocc client the SrvKeyspaces are read from.
+    refresh_interval: seconds between two periodic refreshes.
+    min_refresh_interval: minimum seconds between a refresh and a
+    requested one.
+  """
+
+  def __init__(self, topo_client, refresh_interval=DEFAULT_TOPOLOGY_REFRESH_INTERVAL,
+               min_refresh_interval=DEFAULT_TOPOLOGY_MIN_REFRESH_INTERVAL,
+               cell='local'):
+    self.topo_client = topo_client
+    self.refresh_interval = refresh_interval
+    self.min_refresh_interval = min_refresh_interval
+    self.cell = cell
+    self._snapshot = TopologySnapshot(0, {}, {})
+    self._refresh_event = threading.Event()
+    self._stop_event = threading.Event()
+    self._thread = None
+    # Serializes refreshes, readers don't take it.
+    self._refresh_lock = threading.Lock()
+    self.refreshes = 0
+    self.refresh_errors = 0
+    self.last_refresh_time = None
+
+  def start(self):
+    """Starts the refresh thread, which refreshes right away."""
+    if self._thread is not None:
+      return
+    self._stop_event.clear()
+    self._refresh_event.set()
+    self._thread = threading.Thread(target=self._refresh_loop,
+                                    name='TopologyCache')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def stop(self):
+    self._stop_event.set()
+    self._refresh_event.set()
+    if self._thread is not None:
+      self._thread.join()
+      self._thread = None
+
+  def request_refresh(self):
+    self._refresh_event.set()
+
+  def get_snapshot(self):
+    return self._snapshot
+
+  def get_keyspace(self, name):
+    return self._snapshot.keyspaces.get(name)
+
+  def get_stats(self):
+    if self.last_refresh_time is None:
+      staleness = None
+    else:
+      staleness = time.time() - self.last_refresh_time
+    return {'Version': self._snapshot.version,
+            'Keyspaces': len(self._snapshot.keyspaces),
+            'Refreshes': self.refreshes,
+            'RefreshErrors': self.refresh_errors,
+            'StalenessSeconds': staleness}
+
+  def refresh(self):
+    """Reads all the SrvKeyspaces and swaps in a snapshot if any changed.
+
+    Returns:
+      True if the topology changed.
+    """
+    with self._refresh_lock:
+      old_snapshot = self._snapshot
+      keyspace_names = self.topo_client.get_srv_keyspace_names(self.cell)
+      if not keyspace_names:
+        vtdb_logger.get_logger().topo_empty_keyspace_list()
+        raise dbexceptions.OperationalError('topo server returned no keyspaces')
+      changed = set(keyspace_names) != set(old_snapshot.srv_keyspaces)
+      keyspaces = {}
+      srv_keyspaces = {}
+      for name in keyspace_names:
+        start_time = time.time()
+        data = self.topo_client.get_srv_keyspace(self.cell, name)
+        vtdb_logger.get_logger().topo_keyspace_fetch(name,
+                                                     time.time() - start_time)
+        if not data:
+          raise dbexceptions.OperationalError('invalid empty keyspace', name)
+        srv_keyspaces[name] = data
+        if old_snapshot.srv_keyspaces.get(name) == data:
+          # Keeps the shard indexes already built for this keyspace.
+          keyspaces[name] = old_snapshot.keyspaces[name]
+        else:
+          keyspaces[name] = keyspace.Keyspace(name, data)
+          changed = True
+      if changed:
+        self._snapshot = TopologySnapshot(old_snapshot.version + 1, keyspaces,
+                                          srv_keyspaces)
+      self.refreshes += 1
+      self.last_refresh_time = time.time()
+      return changed
+
+  def _refresh_loop(self):
+    last_attempt_time = None
+    while True:
+      requested = self._refresh_event.wait(self.refresh_interval)
+      if self._stop_event.is_set():
+        return
+      if requested and last_attempt_time is not None:
+        # Requested refreshes are throttled like refresh_keyspace, the
+        # periodic ones are not.
+        delay = last_attempt_time + self.min_refresh_interval - time.time()
+        if delay > 0:
+          self._stop_event.wait(delay)
+          if self._stop_event.is_set():
+            return
+      self._refresh_event.clear()
+      last_attempt_time = time.time()
+      try:
+        self.refresh()
+      except Exception as e:
+        self.refresh_errors += 1
+        vtdb_logger.get_logger().topo_exception(
+            'topology cache refresh failed', self.cell, e)
+
+
 # read all the keyspaces, populates __keyspace_map, can call get_keyspace
 # after this step
 def read_keyspaces(zkocc_client):
   read_topology(zkocc_client, read_fqdb_keys=False)
 
 
+# Default number of concurrent topo server reads in read_topology.
+DEFAULT_TOPOLOGY_READ_PARALLELISM = 8
+
+
+def _run_topo_tasks(topo_clients, max_parallelism, tasks):
+  """Runs task(topo_client) for all the tasks, returns their results in order.
+
+  Up to max_parallelism worker threads run the tasks, and share
+  topo_clients in turn: a ZkOccConnection serves concurrent calls over
+  its pool of connections. Tasks handle and log their own errors.
+  """
+  results = [None] * len(tasks)
+  worker_count = min(max_parallelism, len(tasks))
+  if worker_count <= 1:
+    for i, task in enumerate(tasks):
+      results[i] = task(topo_clients[0])
+    return results
+
+  task_queue = Queue.Queue()
+  for item in enumerate(tasks):
+    task_queue.put(item)
+
+  def work(topo_client):
+    while True:
+      try:
+        i, task = task_queue.get_nowait()
+      except Queue.Empty:
+        return
+      results[i] = task(topo_client)
+
+  workers = [threading.Thread(target=work,
+                              args=(topo_clients[i % len(topo_clients)],))
+             for i in xrange(worker_count)]
+  for worker in workers:
+    worker.start()
+  for worker in workers:
+    worker.join()
+  return results
+
+
+def _keyspace_task(keyspace_name):
+  def read(topo_client):
+    start_time = time.time()
+    try:
+      ks = keyspace.read_keyspace(topo_client, keyspace_name)
+    except Exception:
+      vtdb_logger.get_logger().topo_bad_keyspace_data(keyspace_name)
+      return None
+    vtdb_logger.get_logger().topo_keyspace_fetch(keyspace_name,
+                                                 time.time() - start_time)
+    return ks
+  return read
+
+
+def _end_points_task(db_key):
+  def read(topo_client):
+    try:
+      return len(get_host_port_by_name(topo_client, db_key))
+    except Exception:
+      vtdb_logger.get_logger().topo_bad_keyspace_data(db_key.split('.')[0])
+      return 0
+  return read
+
+
 # read_topology returns:
 # - a list of all the existing <keyspace>.<shard>.<db_type>
 # - optionally, a list of all existing endpoints:
 #   <keyspace>.<shard>.<db_type>.<instance_id>
-def read_topology(zkocc_client, read_fqdb_keys=True):
+#
+# The keyspaces and endpoints are read by up to max_parallelism threads,
+# sharing zkocc_client and the optional extra topo_clients in turn.
+def read_topology(zkocc_client, read_fqdb_keys=True, topo_clients=None,
+                  max_parallelism=DEFAULT_TOPOLOGY_READ_PARALLELISM):
+  topo_clients = [zkocc_client] + list(topo_clients or [])
   fqdb_keys = []
   db_keys = []
+  start_time = time.time()
   keyspace_list = zkocc_client.get_srv_keyspace_names('local')
   # validate step
   if len(keyspace_list) == 0:
     vtdb_logger.get_logger().topo_empty_keyspace_list()
     raise Exception('zkocc returned empty keyspace list')
-  for keyspace_name in keyspace_list:
+  vtdb_logger.get_logger().topo_bootstrap_phase(
+      'keyspace_names', len(keyspace_list), time.time() - start_time)
+
+  start_time = time.time()
+  keyspaces = _run_topo_tasks(
+      topo_clients, max_parallelism,
+      [_keyspace_task(keyspace_name) for keyspace_name in keyspace_list])
+  keyspaces = [ks for ks in keyspaces if ks is not None]
+  vtdb_logger.get_logger().topo_bootstrap_phase(
+      'keyspaces', len(keyspaces), time.time() - start_time)
+
+  db_key_parts_list = []
+  for ks in keyspaces:
+    __set_keyspace(ks)
+    for db_type, partition in ks.partitions.iteritems():
+      for shard_reference in partition['ShardReferences']:
+        db_key_parts = [ks.name, shard_reference['Name'], db_type]
+        db_keys.append('.'.join(db_key_parts))
+        db_key_parts_list.append(db_key_parts)
+  if not read_fqdb_keys:
+    return db_keys, fqdb_keys
+
+  start_time = time.time()
+  instance_counts = _run_topo_tasks(
+      topo_clients, max_parallelism,
+      [_end_points_task(db_key) for db_key in db_keys])
+  for db_key_parts, db_instances in zip(db_key_parts_list, instance_counts):
+    for db_i in xrange(db_instances):
+      fqdb_keys.append('.'.join(db_key_parts + [str(db_i)]))
+  vtdb_logger.get_logger().topo_bootstrap_phase(
+      'end_points', len(db_keys), time.time() - start_time)
+  return db_keys, fqdb_keys
+
+
+# Format version of the topology snapshot files.
+TOPOLOGY_SNAPSHOT_VERSION = 1
+
+
+def save_topology_snapshot(snapshot_path, snapshot):
+  """Writes a snapshot dict as BSON, replacing the file atomically."""
+  tmp_path = '%s.tmp.%d' % (snapshot_path, os.getpid())
+  with open(tmp_path, 'wb') as f:
+    f.write(_bson.dumps(snapshot))
+  os.rename(tmp_path, snapshot_path)
+
+
+def load_topology_snapshot(snapshot_path):
+  """Returns the snapshot dict saved at snapshot_path.
+
+  Returns None if there is no such file, or if it can't be used.
+  """
+  try:
+    with open(snapshot_path, 'rb') as f:
+      snapshot = _bson.loads(f.read())
+  except IOError:
+    return None
+  except Exception as e:
+    vtdb_logger.get_logger().topo_exception('invalid topology snapshot',
+                                            snapshot_path, e)
+    return None
+  if snapshot.get('Version') != TOPOLOGY_SNAPSHOT_VERSION:
+    logging.warning('ignoring topology snapshot %s with version %s',
+                    snapshot_path, snapshot.get('Version'))
+    return None
+  return snapshot
+
+
+class TopologySnapshotClient(object):
+  """Topo client that keeps a snapshot file of what it reads.
+
+  Calls go to topo_client, and their answers are recorded. When
+  topo_client fails, the last answer to the same call is returned
+  instead, starting with the ones loaded from snapshot_path. save writes
+  the recorded answers back to snapshot_path.
+
+  Attributes:
+    topo_client: the topo client calls go to.
+    snapshot_path: file the snapshot is loaded from and saved to.
+    snapshot_time: time of the snapshot loaded from snapshot_path, or None.
+  """
+
+  def __init__(self, topo_client, snapshot_path):
+    self.topo_client = topo_client
+    self.snapshot_path = snapshot_path
+    self.snapshot_time = None
+    # cell -> list of keyspace names
+    self._srv_keyspace_names = {}
+    # (cell, keyspace name) -> SrvKeyspace
+    self._srv_keyspaces = {}
+    # (cell, keyspace name, shard, tablet type) -> EndPoints
+    self._end_points = {}
+    self._lock = threading.Lock()
+    snapshot = load_topology_snapshot(snapshot_path)
+    if snapshot is not None:
+      self.snapshot_time = snapshot['Time']
+      for entry in snapshot['SrvKeyspaceNames']:
+        self._srv_keyspace_names[entry['Cell']] = entry['Names']
+      for entry in snapshot['SrvKeyspaces']:
+        self._srv_keyspaces[(entry['Cell'], entry['Keyspace'])] = entry['Data']
+      for entry in snapshot['EndPoints']:
+        self._end_points[(entry['Cell'], entry['Keyspace'], entry['Shard'],
+                          entry['TabletType'])] = entry['Data']
+
+  def _call(self, method, answers, key, *args):
     try:
-      ks = keyspace.read_keyspace(zkocc_client, keyspace_name)
-      __set_keyspace(ks)
-      for db_type, partition in ks.partitions.iteritems():
-        for shard_reference in partition['ShardReferences']:
-          db_key_parts = [ks.name, shard_reference['Name'], db_type]
-          db_key = '.'.join(db_key_parts)
-          db_keys.append(db_key)
-
-          if read_fqdb_keys:
-            db_instances = len(get_host_port_by_name(zkocc_client, db_key))
-            for db_i in xrange(db_instances):
-              fqdb_keys.append('.'.join(db_key_parts + [str(db_i)]))
+      answer = getattr(self.topo_client, method)(*args)
+    except Exception as e:
+      with self._lock:
+        if key not in answers:
+          raise
+        vtdb_logger.get_logger().topo_exception(
+            'serving %s from topology snapshot' % method, key, e)
+        return answers[key]
+    with self._lock:
+      answers[key] = answer
+    return answer
+
+  def get_srv_keyspace_names(self, cell):
+    return self._call('get_srv_keyspace_names', self._srv_keyspace_names,
+                      cell, cell)
+
+  def get_srv_keyspace(self, cell, keyspace_name):
+    return self._call('get_srv_keyspace', self._srv_keyspaces,
+                      (cell, keyspace_name), cell, keyspace_name)
+
+  def get_end_points(self, cell, keyspace_name, shard, tablet_type):
+    return self._call('get_end_points', self._end_points,
+                      (cell, keyspace_name, shard, tablet_type),
+                      cell, keyspace_name, shard, tablet_type)
+
+  def get_recorded_srv_keyspaces(self, cell):
+    """Returns (keyspace name, SrvKeyspace) for the keyspaces of a cell."""
+    with self._lock:
+      return [(keyspace_name, data)
+              for (ks_cell, keyspace_name), data
+              in self._srv_keyspaces.iteritems() if ks_cell == cell]
+
+  def get_snapshot(self):
+    """Returns the recorded answers as a snapshot dict."""
+    with self._lock:
+      return {
+          'Version': TOPOLOGY_SNAPSHOT_VERSION,
+          'Time': time.time(),
+          'SrvKeyspaceNames': [
+              {'Cell': cell, 'Names': names}
+              for cell, names in self._srv_keyspace_names.iteritems()],
+          'SrvKeyspaces': [
+              {'Cell': cell, 'Keyspace': keyspace_name, 'Data': data}
+              for (cell, keyspace_name), data
+              in self._srv_keyspaces.iteritems()],
+          'EndPoints': [
+              {'Cell': cell, 'Keyspace': keyspace_name, 'Shard': shard,
+               'TabletType': tablet_type, 'Data': data}
+              for (cell, keyspace_name, shard, tablet_type), data
+              in self._end_points.iteritems()],
+      }
+
+  def save(self):
+    save_topology_snapshot(self.snapshot_path, self.get_snapshot())
+
+  def dial(self):
+    self.topo_client.dial()
+
+  def close(self):
+    self.topo_client.close()
+
+
+def _reconcile_topology(snapshot_client, read_fqdb_keys):
+  try:
+    read_topology(snapshot_client, read_fqdb_keys=read_fqdb_keys)
+    snapshot_client.save()
+  except Exception as e:
+    vtdb_logger.get_logger().topo_exception('topology reconcile failed',
+                                            snapshot_client.snapshot_path, e)
+
+
+# warm_start_topology loads the keyspaces of the snapshot file at
+# snapshot_path, so get_keyspace works right away, then re-reads the
+# topology from zkocc_client in a background thread and saves the
+# snapshot again. It returns a TopologySnapshotClient to use as the topo
+# client afterwards, it falls back to the snapshot when zkocc fails.
+def warm_start_topology(zkocc_client, snapshot_path, read_fqdb_keys=True):
+  snapshot_client = TopologySnapshotClient(zkocc_client, snapshot_path)
+  for keyspace_name, data in snapshot_client.get_recorded_srv_keyspaces('local'):
+    if keyspace_name in __keyspace_map:
+      continue
+    try:
+      ks = keyspace.Keyspace(keyspace_name, data)
     except Exception:
       vtdb_logger.get_logger().topo_bad_keyspace_data(keyspace_name)
-  return db_keys, fqdb_keys
+      continue
+    # A fetch time of 0 lets refresh_keyspace re-read it right away.
+    __keyspace_map[keyspace_name] = (ks, 0)
+  reconcile_thread = threading.Thread(
+      target=_reconcile_topology, args=(snapshot_client, read_fqdb_keys),
+      name='TopologyReconcile')
+  reconcile_thread.daemon = True
+  reconcile_thread.start()
+  return snapshot_client
 
 
 # db_key is <keyspace>.<shard_name>.<db_type>[:<service>]
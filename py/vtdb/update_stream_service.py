@@ -1,11 +1,18 @@
 #! /usr/bin/python
 
 from itertools import izip
+import json
+import collections
 import logging
+import os
+import threading
+import time
 
 from net import gorpc
 from net import bsonrpc
 from vtdb import dbexceptions
+from vtdb import keyrange
+from vtdb import topology
 
 class Coord(object):
   Position = None
@@ -40,6 +47,73 @@ class EventData(object):
       pk_row = [(col_name, col_value) for col_name, col_value in izip(raw_response['PKColNames'], pkList)]
       self.PkRows.append(pk_row)
 
+class StreamEvent(object):
+  """An update stream event, lighter than EventData.
+
+  The fields of the raw event are kept as is, and PkRows is only built
+  when it is read.
+  """
+  __slots__ = ('Category', 'TableName', 'PKColNames', 'PKValues', 'Sql',
+               'Timestamp', 'GTIDField', '_pk_rows')
+
+  def __init__(self, raw_response):
+    get = raw_response.get
+    self.Category = get('Category')
+    self.TableName = get('TableName')
+    self.PKColNames = get('PKColNames')
+    self.PKValues = get('PKValues')
+    self.Sql = get('Sql')
+    self.Timestamp = get('Timestamp')
+    self.GTIDField = get('GTIDField')
+    self._pk_rows = None
+
+  @property
+  def PkRows(self):
+    if self._pk_rows is None:
+      pk_rows = []
+      if self.PKColNames:
+        col_names = self.PKColNames
+        for pkList in self.PKValues:
+          if pkList:
+            pk_rows.append(zip(col_names, pkList))
+      self._pk_rows = pk_rows
+    return self._pk_rows
+
+
+# Statement categories of a BinlogTransaction, as in
+# go/vt/binlog/proto/binlog_transaction.go.
+BL_UNRECOGNIZED = 0
+BL_BEGIN = 1
+BL_COMMIT = 2
+BL_ROLLBACK = 3
+BL_DML = 4
+BL_DDL = 5
+BL_SET = 6
+
+
+BinlogStatement = collections.namedtuple('BinlogStatement',
+                                         ('category', 'charset', 'sql'))
+
+
+class BinlogTransaction(object):
+  """A transaction of a filtered binlog stream.
+
+  Attributes:
+    statements: list of BinlogStatement.
+    timestamp: time of the transaction, in seconds since the epoch.
+    GTIDField: GTID of the transaction.
+  """
+  __slots__ = ('statements', 'timestamp', 'GTIDField')
+
+  def __init__(self, raw_response):
+    self.statements = [
+        BinlogStatement(statement['Category'], statement.get('Charset'),
+                        statement['Sql'])
+        for statement in raw_response['Statements'] or ()]
+    self.timestamp = raw_response['Timestamp']
+    self.GTIDField = raw_response['GTIDField']
+
+
 class UpdateStreamConnection(object):
   def __init__(self, addr, timeout, user=None, password=None, encrypted=False, keyfile=None, certfile=None):
     self.client = bsonrpc.BsonRpcClient(addr, timeout, user, password, encrypted, keyfile, certfile)
@@ -63,6 +137,62 @@ class UpdateStreamConnection(object):
       logging.exception('gorpc low-level error')
       raise
 
+  # _stream_events starts streaming from replPos, and returns a generator
+  # of StreamEvent. It stops at the end of the stream.
+  def _stream_events(self, replPos):
+    return self._stream('UpdateStream.ServeUpdateStream',
+                        {"Position": replPos}, StreamEvent)
+
+  def stream_key_range(self, replPos, key_range, keyspace_id_type,
+                       charset=None):
+    """Returns a generator of the BinlogTransaction of a keyrange.
+
+    Only the statements of the keyspace ids in key_range are streamed,
+    the filtering being done by the tablet.
+
+    Args:
+      replPos: position to start streaming from.
+      key_range: keyrange.KeyRange, or its string form like '80-c0'.
+      keyspace_id_type: keyrange_constants.KIT_UINT64 or KIT_BYTES.
+      charset: optional dict of 'Client', 'Conn' and 'Server' charset ids
+      to convert the statements to.
+    """
+    if not isinstance(key_range, keyrange.KeyRange):
+      key_range = keyrange.KeyRange(key_range)
+    req = {'Position': replPos, 'KeyspaceIdType': keyspace_id_type,
+           'KeyRange': key_range, 'Charset': charset}
+    return self._stream('UpdateStream.StreamKeyRange', req, BinlogTransaction)
+
+  def stream_tables(self, replPos, tables, charset=None):
+    """Returns a generator of the BinlogTransaction of some tables.
+
+    Args:
+      replPos: position to start streaming from.
+      tables: list of the names of the tables to stream.
+      charset: same as for stream_key_range.
+    """
+    req = {'Position': replPos, 'Tables': list(tables), 'Charset': charset}
+    return self._stream('UpdateStream.StreamTables', req, BinlogTransaction)
+
+  def _stream(self, method, req, reply_class):
+    try:
+      self.client.stream_call(method, req)
+    except gorpc.GoRpcError as e:
+      raise dbexceptions.OperationalError(*e.args)
+    while True:
+      try:
+        response = self.client.stream_next()
+      except gorpc.AppError as e:
+        raise dbexceptions.DatabaseError(*e.args)
+      except gorpc.GoRpcError as e:
+        raise dbexceptions.OperationalError(*e.args)
+      if response is None:
+        return
+      yield reply_class(response.reply)
+
+  def has_pending_event(self):
+    return self.client.stream_has_pending()
+
   def stream_next(self):
     try:
       response = self.client.stream_next()
@@ -76,3 +206,382 @@ class UpdateStreamConnection(object):
     except:
       logging.exception('gorpc low-level error')
       raise
+
+
+# Maximum number of events in a batch of UpdateStreamConsumer.
+DEFAULT_EVENT_BATCH_SIZE = 500
+# Minimum seconds between two writes of the checkpoint file.
+DEFAULT_CHECKPOINT_INTERVAL = 5
+# Number of reconnections in a row before UpdateStreamConsumer gives up.
+DEFAULT_MAX_RECONNECT_ATTEMPTS = 5
+# Seconds to wait before reconnecting.
+DEFAULT_RECONNECT_DELAY = 1.0
+
+
+def _gtid_position(position, gtid):
+  return gtid
+
+
+def read_checkpoint(checkpoint_path):
+  """Returns the position saved in checkpoint_path, None if there is none."""
+  try:
+    with open(checkpoint_path) as f:
+      return json.load(f)['Position']
+  except IOError:
+    return None
+
+
+def write_checkpoint(checkpoint_path, position):
+  tmp_path = '%s.tmp.%d' % (checkpoint_path, os.getpid())
+  with open(tmp_path, 'w') as f:
+    json.dump({'Position': position}, f)
+  os.rename(tmp_path, checkpoint_path)
+
+
+class UpdateStreamConsumer(object):
+  """Reads an update stream in batches, reconnecting as needed.
+
+  stream_batches yields lists of StreamEvent. A batch ends at a
+  transaction boundary (a POS event) when no more events are waiting on
+  the connection, or when it reaches batch_size events.
+
+  The position is committed at the POS events of a batch when the next
+  batch is requested, so a batch is only committed once processed. A
+  caller that stops iterating calls commit to commit the last batch. The
+  committed position is written to checkpoint_path at most every
+  checkpoint_interval seconds. After a connection error, streaming
+  resumes from the committed position, so the events of an uncommitted
+  batch can be delivered again.
+
+  Attributes:
+    addr: address of the tablet streamed from.
+    position: last committed position.
+    position_append: function(position, gtid) returning the position
+    after the transaction of a POS event. The default keeps the GTID as
+    position, which is right for MariaDB GTIDs.
+    resolve_addr: optional function returning the address to connect
+    to, called before each connection.
+    stop_event: optional threading.Event. Once it is set, stream_batches
+    ends instead of reconnecting.
+  """
+
+  def __init__(self, addr, timeout, position=None, checkpoint_path=None,
+               batch_size=DEFAULT_EVENT_BATCH_SIZE,
+               checkpoint_interval=DEFAULT_CHECKPOINT_INTERVAL,
+               position_append=_gtid_position,
+               max_reconnect_attempts=DEFAULT_MAX_RECONNECT_ATTEMPTS,
+               reconnect_delay=DEFAULT_RECONNECT_DELAY, user=None,
+               password=None, encrypted=False, keyfile=None, certfile=None,
+               resolve_addr=None, stop_event=None):
+    self.addr = addr
+    self.resolve_addr = resolve_addr
+    self.stop_event = stop_event
+    self.timeout = timeout
+    self.checkpoint_path = checkpoint_path
+    if position is None and checkpoint_path:
+      position = read_checkpoint(checkpoint_path)
+    if position is None:
+      raise dbexceptions.ProgrammingError('no position to start streaming from')
+    self.position = position
+    self.batch_size = batch_size
+    self.checkpoint_interval = checkpoint_interval
+    self.position_append = position_append
+    self.max_reconnect_attempts = max_reconnect_attempts
+    self.reconnect_delay = reconnect_delay
+    self.user = user
+    self.password = password
+    self.encrypted = encrypted
+    self.keyfile = keyfile
+    self.certfile = certfile
+    self.conn = None
+    self._last_checkpoint_time = time.time()
+    self._checkpointed_position = position
+    # position at the end of the last batch yielded, not committed yet.
+    self._batch_position = None
+
+  def _connect(self):
+    if self.resolve_addr:
+      self.addr = self.resolve_addr()
+    self.conn = UpdateStreamConnection(self.addr, self.timeout, self.user,
+                                       self.password, self.encrypted,
+                                       self.keyfile, self.certfile)
+    try:
+      self.conn.dial()
+    except gorpc.GoRpcError as e:
+      raise dbexceptions.OperationalError(*e.args)
+    return self._open_stream()
+
+  def _open_stream(self):
+    return self.conn._stream_events(self.position)
+
+  def _ends_transaction(self, event):
+    return event.Category == 'POS'
+
+  def _stopped(self):
+    return self.stop_event is not None and self.stop_event.is_set()
+
+  def close(self):
+    if self.conn:
+      self.conn.close()
+      self.conn = None
+    self.checkpoint()
+
+  def checkpoint(self):
+    """Writes the committed position to checkpoint_path if it changed."""
+    if self.checkpoint_path and self._checkpointed_position != self.position:
+      write_checkpoint(self.checkpoint_path, self.position)
+      self._checkpointed_position = self.position
+    self._last_checkpoint_time = time.time()
+
+  def commit(self):
+    """Commits the position of the last batch returned."""
+    if self._batch_position is None:
+      return
+    self.position = self._batch_position
+    self._batch_position = None
+    if self._last_checkpoint_time + self.checkpoint_interval < time.time():
+      self.checkpoint()
+
+  def stream_batches(self):
+    """Yields lists of StreamEvent, see the class documentation."""
+    attempt = 0
+    batch = []
+    while True:
+      if self._stopped():
+        return
+      batch_position = self.position
+      try:
+        if self.conn is None:
+          events = self._connect()
+          if self._stopped():
+            # Stopped while dialing, the connection was not closed.
+            self.conn.close()
+            self.conn = None
+            return
+        for event in events:
+          attempt = 0
+          batch.append(event)
+          if self._ends_transaction(event):
+            batch_position = self.position_append(batch_position,
+                                                  event.GTIDField)
+            if self.conn.has_pending_event():
+              if len(batch) < self.batch_size:
+                continue
+          elif len(batch) < self.batch_size:
+            continue
+          self._batch_position = batch_position
+          yield batch
+          batch = []
+          self.commit()
+      except dbexceptions.OperationalError as e:
+        logging.warning('update stream from %s failed: %s', self.addr, e)
+        error = e
+      else:
+        error = dbexceptions.OperationalError('update stream ended', self.addr)
+      # Events after the committed position are streamed again.
+      batch = []
+      if self.conn:
+        self.conn.close()
+        self.conn = None
+      if self._stopped():
+        return
+      attempt += 1
+      if attempt > self.max_reconnect_attempts:
+        raise error
+      if self.stop_event is not None:
+        self.stop_event.wait(self.reconnect_delay)
+      else:
+        time.sleep(self.reconnect_delay)
+
+
+class BinlogTransactionConsumer(UpdateStreamConsumer):
+  """Reads the transactions of a keyrange or of some tables in batches.
+
+  This is an UpdateStreamConsumer over stream_key_range, if key_range is
+  set, or over stream_tables: stream_batches yields lists of
+  BinlogTransaction, and every transaction moves the position.
+  """
+
+  def __init__(self, addr, timeout, key_range=None, keyspace_id_type=None,
+               tables=None, charset=None, **consumer_kwargs):
+    if (key_range is None) == (tables is None):
+      raise dbexceptions.ProgrammingError(
+          'exactly one of key_range and tables must be set')
+    super(BinlogTransactionConsumer, self).__init__(addr, timeout,
+                                                    **consumer_kwargs)
+    self.key_range = key_range
+    self.keyspace_id_type = keyspace_id_type
+    self.tables = tables
+    self.charset = charset
+
+  def _open_stream(self):
+    if self.tables is not None:
+      return self.conn.stream_tables(self.position, self.tables, self.charset)
+    return self.conn.stream_key_range(self.position, self.key_range,
+                                      self.keyspace_id_type, self.charset)
+
+  def _ends_transaction(self, event):
+    return True
+
+
+# Maximum number of events buffered per shard by MultiShardUpdateStream.
+DEFAULT_SHARD_EVENT_BUFFER_SIZE = 1000
+
+
+def _shard_master_resolver(topo_client, keyspace_name, shard):
+  db_key = '%s.%s.master:vt' % (keyspace_name, shard)
+  def resolve():
+    host_port_list = topology.get_host_port_by_name(topo_client, db_key)
+    if not host_port_list:
+      topology.refresh_keyspace(topo_client, keyspace_name)
+      raise dbexceptions.OperationalError('no master for', db_key)
+    host, port, _ = host_port_list[0]
+    return '%s:%s' % (host, port)
+  return resolve
+
+
+class MultiShardUpdateStream(object):
+  """Merged update streams of all the shards of a keyspace.
+
+  Each shard master is streamed from by an UpdateStreamConsumer on its
+  own thread. The master address is resolved from the topology at every
+  connection, so streams follow reparents. events yields (shard, event)
+  tuples: the events of a shard keep their order, and across shards the
+  event with the oldest Timestamp among the ones received goes first.
+
+  A shard's position moves past a POS event once the next event is
+  requested, and positions are saved to checkpoint_path like the
+  UpdateStreamConsumer position. Streaming stops with the error of a
+  shard that couldn't reconnect. close stops the shard threads: they
+  don't reconnect once their connection is closed.
+
+  Attributes:
+    positions: dict of shard name to its last committed position.
+  """
+
+  def __init__(self, topo_client, keyspace_name, timeout, positions=None,
+               checkpoint_path=None,
+               checkpoint_interval=DEFAULT_CHECKPOINT_INTERVAL,
+               position_append=_gtid_position,
+               buffer_size=DEFAULT_SHARD_EVENT_BUFFER_SIZE, **consumer_kwargs):
+    self.topo_client = topo_client
+    self.keyspace_name = keyspace_name
+    self.timeout = timeout
+    self.checkpoint_path = checkpoint_path
+    if positions is None and checkpoint_path:
+      positions = read_checkpoint(checkpoint_path)
+    if positions is None:
+      raise dbexceptions.ProgrammingError('no positions to start streaming from')
+    self.positions = dict(positions)
+    self.checkpoint_interval = checkpoint_interval
+    self.position_append = position_append
+    self.buffer_size = buffer_size
+    self.consumer_kwargs = consumer_kwargs
+    self._condition = threading.Condition()
+    # shard -> deque of StreamEvent received and not returned yet.
+    self._buffers = {}
+    self._errors = {}
+    self._consumers = {}
+    self._closed = False
+    self._stop_event = threading.Event()
+    self._last_checkpoint_time = time.time()
+    self._checkpointed_positions = dict(self.positions)
+
+  def get_shard_names(self):
+    ks = topology.get_keyspace(self.keyspace_name)
+    if ks is None:
+      topology.refresh_keyspace(self.topo_client, self.keyspace_name)
+      raise dbexceptions.OperationalError('unknown keyspace', self.keyspace_name)
+    return [shard['Name'] for shard in ks.get_shards('master')]
+
+  def start(self):
+    shards = self.get_shard_names()
+    if not shards:
+      topology.refresh_keyspace(self.topo_client, self.keyspace_name)
+      raise dbexceptions.OperationalError('no master shards in keyspace',
+                                          self.keyspace_name)
+    for shard in shards:
+      if shard not in self.positions:
+        raise dbexceptions.ProgrammingError('no position for shard', shard)
+      consumer = UpdateStreamConsumer(
+          None, self.timeout, position=self.positions[shard],
+          position_append=self.position_append,
+          resolve_addr=_shard_master_resolver(self.topo_client,
+                                              self.keyspace_name, shard),
+          stop_event=self._stop_event, **self.consumer_kwargs)
+      self._consumers[shard] = consumer
+      self._buffers[shard] = collections.deque()
+      thread = threading.Thread(target=self._stream_shard,
+                                args=(shard, consumer),
+                                name='UpdateStream-%s' % shard)
+      thread.daemon = True
+      thread.start()
+
+  def _stream_shard(self, shard, consumer):
+    buf = self._buffers[shard]
+    try:
+      for batch in consumer.stream_batches():
+        with self._condition:
+          while len(buf) >= self.buffer_size and not self._closed:
+            self._condition.wait()
+          if self._closed:
+            return
+          buf.extend(batch)
+          self._condition.notify_all()
+    except Exception as e:
+      logging.warning('update stream of shard %s stopped: %s', shard, e)
+      with self._condition:
+        self._errors[shard] = e
+        self._condition.notify_all()
+
+  def _next_event(self):
+    with self._condition:
+      while True:
+        if self._errors:
+          raise self._errors.values()[0]
+        if self._closed:
+          return None, None
+        shard = None
+        for buf_shard, buf in self._buffers.iteritems():
+          if buf and (shard is None or
+                      buf[0].Timestamp < self._buffers[shard][0].Timestamp):
+            shard = buf_shard
+        if shard is not None:
+          event = self._buffers[shard].popleft()
+          self._condition.notify_all()
+          return shard, event
+        self._condition.wait()
+
+  def events(self):
+    """Yields (shard, StreamEvent) tuples, starting the streams if needed."""
+    if not self._consumers:
+      self.start()
+    while True:
+      shard, event = self._next_event()
+      if event is None:
+        return
+      yield shard, event
+      if event.Category == 'POS':
+        self.positions[shard] = self.position_append(self.positions[shard],
+                                                     event.GTIDField)
+        if self._last_checkpoint_time + self.checkpoint_interval < time.time():
+          self.checkpoint()
+
+  def checkpoint(self):
+    """Writes the positions to checkpoint_path if they changed."""
+    if self.checkpoint_path and self._checkpointed_positions != self.positions:
+      write_checkpoint(self.checkpoint_path, self.positions)
+      self._checkpointed_positions = dict(self.positions)
+    self._last_checkpoint_time = time.time()
+
+  def close(self):
+    self._stop_event.set()
+    with self._condition:
+      self._closed = True
+      self._condition.notify_all()
+    for consumer in self._consumers.itervalues():
+      # The shard thread can drop its connection at the same time.
+      conn = consumer.conn
+      if conn:
+        conn.close()
+    self.checkpoint()
@@ -0,0 +1,203 @@
+# Copyright 2015, Google Inc. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can
+# be found in the LICENSE file.
+
+"""Keyspace id hashing compatible with the Go hash vindex.
+
+go/vt/vtgate/vindexes/hash.go maps an int64 sharding key to a keyspace id
+by encrypting its big-endian representation with 3DES and a null key.
+With a null key 3DES degenerates to a single DES pass, which is what this
+module implements. The optimized cvhash extension (py/cvhash) is used when
+it is installed, otherwise a pure python DES is used.
+"""
+
+import struct
+
+try:
+  # use optimized cvhash, it hashes a whole batch in one call
+  import cvhash
+except ImportError:
+  cvhash = None
+
+
+_uint64 = struct.Struct('!Q')
+_int64 = struct.Struct('!q')
+UINT64_MASK = 0xFFFFFFFFFFFFFFFF
+
+# DES tables, see FIPS 46-3. Bit positions are 1-based from the most
+# significant bit.
+_IP = (58, 50, 42, 34, 26, 18, 10, 2, 60, 52, 44, 36, 28, 20, 12, 4,
+       62, 54, 46, 38, 30, 22, 14, 6, 64, 56, 48, 40, 32, 24, 16, 8,
+       57, 49, 41, 33, 25, 17, 9, 1, 59, 51, 43, 35, 27, 19, 11, 3,
+       61, 53, 45, 37, 29, 21, 13, 5, 63, 55, 47, 39, 31, 23, 15, 7)
+
+_FP = (40, 8, 48, 16, 56, 24, 64, 32, 39, 7, 47, 15, 55, 23, 63, 31,
+       38, 6, 46, 14, 54, 22, 62, 30, 37, 5, 45, 13, 53, 21, 61, 29,
+       36, 4, 44, 12, 52, 20, 60, 28, 35, 3, 43, 11, 51, 19, 59, 27,
+       34, 2, 42, 10, 50, 18, 58, 26, 33, 1, 41, 9, 49, 17, 57, 25)
+
+_P = (16, 7, 20, 21, 29, 12, 28, 17, 1, 15, 23, 26, 5, 18, 31, 10,
+      2, 8, 24, 14, 32, 27, 3, 9, 19, 13, 30, 6, 22, 11, 4, 25)
+
+_PC1 = (57, 49, 41, 33, 25, 17, 9, 1, 58, 50, 42, 34, 26, 18,
+        10, 2, 59, 51, 43, 35, 27, 19, 11, 3, 60, 52, 44, 36,
+        63, 55, 47, 39, 31, 23, 15, 7, 62, 54, 46, 38, 30, 22,
+        14, 6, 61, 53, 45, 37, 29, 21, 13, 5, 28, 20, 12, 4)
+
+_PC2 = (14, 17, 11, 24, 1, 5, 3, 28, 15, 6, 21, 10,
+        23, 19, 12, 4, 26, 8, 16, 7, 27, 20, 13, 2,
+        41, 52, 31, 37, 47, 55, 30, 40, 51, 45, 33, 48,
+        44, 49, 39, 56, 34, 53, 46, 42, 50, 36, 29, 32)
+
+_KEY_SHIFTS = (1, 1, 2, 2, 2, 2, 2, 2, 1, 2, 2, 2, 2, 2, 2, 1)
+
+_SBOXES = (
+    (14, 4, 13, 1, 2, 15, 11, 8, 3, 10, 6, 12, 5, 9, 0, 7,
+     0, 15, 7, 4, 14, 2, 13, 1, 10, 6, 12, 11, 9, 5, 3, 8,
+     4, 1, 14, 8, 13, 6, 2, 11, 15, 12, 9, 7, 3, 10, 5, 0,
+     15, 12, 8, 2, 4, 9, 1, 7, 5, 11, 3, 14, 10, 0, 6, 13),
+    (15, 1, 8, 14, 6, 11, 3, 4, 9, 7, 2, 13, 12, 0, 5, 10,
+     3, 13, 4, 7, 15, 2, 8, 14, 12, 0, 1, 10, 6, 9, 11, 5,
+     0, 14, 7, 11, 10, 4, 13, 1, 5, 8, 12, 6, 9, 3, 2, 15,
+     13, 8, 10, 1, 3, 15, 4, 2, 11, 6, 7, 12, 0, 5, 14, 9),
+    (10, 0, 9, 14, 6, 3, 15, 5, 1, 13, 12, 7, 11, 4, 2, 8,
+     13, 7, 0, 9, 3, 4, 6, 10, 2, 8, 5, 14, 12, 11, 15, 1,
+     13, 6, 4, 9, 8, 15, 3, 0, 11, 1, 2, 12, 5, 10, 14, 7,
+     1, 10, 13, 0, 6, 9, 8, 7, 4, 15, 14, 3, 11, 5, 2, 12),
+    (7, 13, 14, 3, 0, 6, 9, 10, 1, 2, 8, 5, 11, 12, 4, 15,
+     13, 8, 11, 5, 6, 15, 0, 3, 4, 7, 2, 12, 1, 10, 14, 9,
+     10, 6, 9, 0, 12, 11, 7, 13, 15, 1, 3, 14, 5, 2, 8, 4,
+     3, 15, 0, 6, 10, 1, 13, 8, 9, 4, 5, 11, 12, 7, 2, 14),
+    (2, 12, 4, 1, 7, 10, 11, 6, 8, 5, 3, 15, 13, 0, 14, 9,
+     14, 11, 2, 12, 4, 7, 13, 1, 5, 0, 15, 10, 3, 9, 8, 6,
+     4, 2, 1, 11, 10, 13, 7, 8, 15, 9, 12, 5, 6, 3, 0, 14,
+     11, 8, 12, 7, 1, 14, 2, 13, 6, 15, 0, 9, 10, 4, 5, 3),
+    (12, 1, 10, 15, 9, 2, 6, 8, 0, 13, 3, 4, 14, 7, 5, 11,
+     10, 15, 4, 2, 7, 12, 9, 5, 6, 1, 13, 14, 0, 11, 3, 8,
+     9, 14, 15, 5, 2, 8, 12, 3, 7, 0, 4, 10, 1, 13, 11, 6,
+     4, 3, 2, 12, 9, 5, 15, 10, 11, 14, 1, 7, 6, 0, 8, 13),
+    (4, 11, 2, 14, 15, 0, 8, 13, 3, 12, 9, 7, 5, 10, 6, 1,
+     13, 0, 11, 7, 4, 9, 1, 10, 14, 3, 5, 12, 2, 15, 8, 6,
+     1, 4, 11, 13, 12, 3, 7, 14, 10, 15, 6, 8, 0, 5, 9, 2,
+     6, 11, 13, 8, 1, 4, 10, 7, 9, 5, 0, 15, 14, 2, 3, 12),
+    (13, 2, 8, 4, 6, 15, 11, 1, 10, 9, 3, 14, 5, 0, 12, 7,
+     1, 15, 13, 8, 10, 3, 7, 4, 12, 5, 6, 11, 0, 14, 9, 2,
+     7, 11, 4, 1, 9, 12, 14, 2, 0, 6, 10, 13, 15, 3, 5, 8,
+     2, 1, 14, 7, 4, 10, 8, 13, 15, 12, 9, 0, 3, 5, 6, 11),
+)
+
+
+def _permute(value, table, in_bits):
+  out = 0
+  for position in table:
+    out = (out << 1) | ((value >> (in_bits - position)) & 1)
+  return out
+
+
+def _make_byte_tables(table):
+  """Splits a 64-bit permutation into 8 lookup tables of 256 entries.
+
+  The permutation of a block is then the OR of one lookup per input byte.
+  """
+  byte_tables = []
+  for byte_index in xrange(8):
+    shift = 56 - 8 * byte_index
+    byte_tables.append([_permute(byte << shift, table, 64)
+                        for byte in xrange(256)])
+  return byte_tables
+
+
+def _make_sp_tables():
+  """Merges each S-box with the P permutation that follows it."""
+  sp_tables = []
+  for i, sbox in enumerate(_SBOXES):
+    sp_table = []
+    for value in xrange(64):
+      row = ((value >> 4) & 2) | (value & 1)
+      column = (value >> 1) & 15
+      sp_table.append(_permute(sbox[row * 16 + column] << (28 - 4 * i),
+                               _P, 32))
+    sp_tables.append(sp_table)
+  return sp_tables
+
+
+def _make_subkeys(key):
+  cd = _permute(key, _PC1, 64)
+  c, d = cd >> 28, cd & 0xFFFFFFF
+  subkeys = []
+  for shift in _KEY_SHIFTS:
+    c = ((c << shift) | (c >> (28 - shift))) & 0xFFFFFFF
+    d = ((d << shift) | (d >> (28 - shift))) & 0xFFFFFFF
+    k = _permute((c << 28) | d, _PC2, 56)
+    # Split the 48-bit subkey in the 6-bit chunks fed to the S-boxes.
+    subkeys.append(tuple((k >> (42 - 6 * i)) & 0x3F for i in xrange(8)))
+  return subkeys
+
+
+_IP_TABLES = _make_byte_tables(_IP)
+_FP_TABLES = _make_byte_tables(_FP)
+_SP_TABLES = _make_sp_tables()
+_ENCRYPT_SUBKEYS = _make_subkeys(0)
+_DECRYPT_SUBKEYS = list(reversed(_ENCRYPT_SUBKEYS))
+
+
+def _des_block(block, subkeys):
+  ip0, ip1, ip2, ip3, ip4, ip5, ip6, ip7 = _IP_TABLES
+  block = (ip0[block >> 56] | ip1[(block >> 48) & 0xFF] |
+           ip2[(block >> 40) & 0xFF] | ip3[(block >> 32) & 0xFF] |
+           ip4[(block >> 24) & 0xFF] | ip5[(block >> 16) & 0xFF] |
+           ip6[(block >> 8) & 0xFF] | ip7[block & 0xFF])
+  left, right = block >> 32, block & 0xFFFFFFFF
+  sp0, sp1, sp2, sp3, sp4, sp5, sp6, sp7 = _SP_TABLES
+  for k0, k1, k2, k3, k4, k5, k6, k7 in subkeys:
+    # The E expansion: chunk i is bits 4i..4i+5 of the right half with
+    # the bits on both ends wrapped around.
+    x = ((right & 1) << 33) | (right << 1) | (right >> 31)
+    f = (sp0[((x >> 28) & 0x3F) ^ k0] | sp1[((x >> 24) & 0x3F) ^ k1] |
+         sp2[((x >> 20) & 0x3F) ^ k2] | sp3[((x >> 16) & 0x3F) ^ k3] |
+         sp4[((x >> 12) & 0x3F) ^ k4] | sp5[((x >> 8) & 0x3F) ^ k5] |
+         sp6[((x >> 4) & 0x3F) ^ k6] | sp7[(x & 0x3F) ^ k7])
+    left, right = right, left ^ f
+  block = (right << 32) | left
+  fp0, fp1, fp2, fp3, fp4, fp5, fp6, fp7 = _FP_TABLES
+  return (fp0[block >> 56] | fp1[(block >> 48) & 0xFF] |
+          fp2[(block >> 40) & 0xFF] | fp3[(block >> 32) & 0xFF] |
+          fp4[(block >> 24) & 0xFF] | fp5[(block >> 16) & 0xFF] |
+          fp6[(block >> 8) & 0xFF] | fp7[block & 0xFF])
+
+
+def vhash(sharding_key):
+  """Returns the packed keyspace id for an int64 sharding key."""
+  return vhash_many([sharding_key])[0]
+
+
+def vunhash(keyspace_id):
+  """Returns the int64 sharding key for a packed keyspace id."""
+  return vunhash_many([keyspace_id])[0]
+
+
+def vhash_many(sharding_keys):
+  """Returns the packed keyspace ids for a list of int64 sharding keys."""
+  count = len(sharding_keys)
+  packed = struct.pack('!%dQ' % count,
+                       *[sk & UINT64_MASK for sk in sharding_keys])
+  if cvhash is not None:
+    hashed = cvhash.encrypt(packed)
+    return [hashed[i:i + 8] for i in xrange(0, 8 * count, 8)]
+  blocks = struct.unpack('!%dQ' % count, packed)
+  return [_uint64.pack(_des_block(block, _ENCRYPT_SUBKEYS))
+          for block in blocks]
+
+
+def vunhash_many(keyspace_ids):
+  """Returns the int64 sharding keys for a list of packed keyspace ids."""
+  for keyspace_id in keyspace_ids:
+    if len(keyspace_id) != 8:
+      raise ValueError('invalid keyspace id: %r' % keyspace_id)
+  count = len(keyspace_ids)
+  if cvhash is not None:
+    return list(struct.unpack('!%dq' % count,
+                              cvhash.decrypt(''.join(keyspace_ids))))
+  return [_int64.unpack(_uint64.pack(
+      _des_block(_uint64.unpack(keyspace_id)[0], _DECRYPT_SUBKEYS)))[0]
+          for keyspace_id in keyspace_ids]
@@ -0,0 +1,146 @@
+# Copyright 2015, Google Inc. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can
+# be found in the LICENSE file.
+
+"""Client-side vindexes.
+
+These mirror the vindexes of go/vt/vtgate/vindexes, so that clients can
+compute the keyspace ids of their rows the same way vtgate does. Every
+vindex maps a whole list of ids in one call: the hash vindex hashes the
+batch through vhash, and the lookup vindexes resolve the batch with a
+single IN query on their lookup table.
+
+Keyspace ids are returned packed, as 8-byte big-endian strings, which is
+what vtgate expects in keyspace_ids and entity_keyspace_id_map.
+"""
+
+import struct
+
+from vtdb import sql_builder
+from vtdb import vhash
+
+
+_uint64 = struct.Struct('!Q')
+
+
+def _get_number(value):
+  """Returns an id as a long, like getNumber in hash.go."""
+  if isinstance(value, bool) or not isinstance(value, (int, long)):
+    raise ValueError('unexpected type for %r: %s' % (value, type(value)))
+  return value
+
+
+class Hash(object):
+  """Maps int64 ids to keyspace ids by hashing them, see vhash."""
+  cost = 1
+
+  def map(self, cursor, ids):
+    """Returns the packed keyspace id of every id, in order."""
+    return vhash.vhash_many([_get_number(id) for id in ids])
+
+  def verify(self, cursor, id, keyspace_id):
+    return vhash.vhash(_get_number(id)) == keyspace_id
+
+  def reverse_map(self, cursor, keyspace_id):
+    return vhash.vunhash(keyspace_id)
+
+
+class Numeric(object):
+  """Uses int64 ids as their own keyspace ids."""
+  cost = 0
+
+  def map(self, cursor, ids):
+    """Returns the packed keyspace id of every id, in order."""
+    numbers = [_get_number(id) & vhash.UINT64_MASK for id in ids]
+    packed = struct.pack('!%dQ' % len(numbers), *numbers)
+    return [packed[i:i + 8] for i in xrange(0, len(packed), 8)]
+
+  def verify(self, cursor, id, keyspace_id):
+    return _uint64.pack(_get_number(id) & vhash.UINT64_MASK) == keyspace_id
+
+  def reverse_map(self, cursor, keyspace_id):
+    if len(keyspace_id) != 8:
+      raise ValueError('length of keyspace id is not 8: %d' % len(keyspace_id))
+    return _uint64.unpack(keyspace_id)[0]
+
+
+class _Lookup(object):
+  """Base class for the vindexes backed by a lookup table.
+
+  The lookup table maps every id (from_column) to an int64 sharding key
+  (to_column), which is then hashed into the keyspace id. The cursor
+  passed to the methods must be routed to the lookup table.
+  """
+
+  def __init__(self, table, from_column, to_column):
+    self.table = table
+    self.from_column = from_column
+    self.to_column = to_column
+
+  def lookup(self, cursor, ids):
+    """Returns a dict of id to the list of its sharding keys.
+
+    All ids are resolved by a single IN query, ids without a row in the
+    lookup table are not in the result.
+    """
+    ids = list(set(ids))
+    if not ids:
+      return {}
+    in_clause, bind_vars = sql_builder.build_in(self.from_column, ids)
+    query = 'SELECT %s, %s FROM %s WHERE %s' % (
+        self.from_column, self.to_column, self.table, in_clause)
+    cursor.execute(query, bind_vars)
+    sharding_keys = {}
+    for from_value, to_value in cursor.fetchall():
+      sharding_keys.setdefault(from_value, []).append(_get_number(to_value))
+    return sharding_keys
+
+  def verify(self, cursor, id, keyspace_id):
+    query = 'SELECT %s FROM %s WHERE %s = %%(%s)s AND %s = %%(%s)s' % (
+        self.from_column, self.table, self.from_column, self.from_column,
+        self.to_column, self.to_column)
+    bind_vars = {self.from_column: id,
+                 self.to_column: vhash.vunhash(keyspace_id)}
+    cursor.execute(query, bind_vars)
+    return bool(cursor.fetchall())
+
+
+class LookupHash(_Lookup):
+  """Non-unique lookup vindex: an id can map to several keyspace ids."""
+  cost = 20
+
+  def map(self, cursor, ids):
+    """Returns the list of packed keyspace ids of every id, in order."""
+    sharding_keys = self.lookup(cursor, ids)
+    all_sharding_keys = []
+    for keys in sharding_keys.itervalues():
+      all_sharding_keys.extend(keys)
+    keyspace_ids = dict(zip(all_sharding_keys,
+                            vhash.vhash_many(all_sharding_keys)))
+    return [[keyspace_ids[sk] for sk in sharding_keys.get(id, [])]
+            for id in ids]
+
+
+class LookupHashUnique(_Lookup):
+  """Unique lookup vindex: an id maps to at most one keyspace id."""
+  cost = 10
+
+  def map(self, cursor, ids):
+    """Returns the packed keyspace id of every id, in order.
+
+    Ids without a row in the lookup table map to ''.
+
+    Raises:
+      ValueError: if an id has more than one row in the lookup table.
+    """
+    sharding_keys = self.lookup(cursor, ids)
+    unique_keys = {}
+    for id, keys in sharding_keys.iteritems():
+      if len(keys) != 1:
+        raise ValueError('unexpected multiple results from vindex %s: %r' %
+                         (self.table, id))
+      unique_keys[id] = keys[0]
+    found_ids = unique_keys.keys()
+    keyspace_ids = dict(zip(found_ids, vhash.vhash_many(
+        [unique_keys[id] for id in found_ids])))
+    return [keyspace_ids.get(id, '') for id in ids]
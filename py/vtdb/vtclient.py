@@ -3,6 +3,8 @@
 # be found in the LICENSE file.
 
 import logging
+import Queue
+import threading
 import time
 
 from vtdb import cursor
@@ -16,6 +18,10 @@ from vtdb import vtdb_logger
 RECONNECT_DELAY = 0.002 # 2 ms
 BEGIN_RECONNECT_DELAY = 0.2 # 200 ms
 MAX_RETRY_ATTEMPTS = 2
+# Maximum number of idle tablet connections kept per shard.
+DEFAULT_SHARD_POOL_SIZE = 4
+# Maximum number of shards queried at once by MultiShardVtOCCConnection.
+DEFAULT_MULTI_SHARD_WORKERS = 8
 
 
 def get_vt_connection_params_list(topo_client, keyspace, shard, db_type,
@@ -117,14 +123,20 @@ class VtOCCConnection(object):
         self.conn = tablet.TabletConnection(**db_params)
         self.conn.dial()
         self.conn_db_params = db_params
+        topo_utils.mark_end_point_healthy(host_addr)
         return self.conn
       except Exception as e:
         db_exception = e
         logging.warning('db connection failed: %s %s, %s', db_key, host_addr, e)
+        topo_utils.mark_end_point_failed(host_addr)
         # vttablet threw an Operational Error on connect, re-read the keyspace
         if isinstance(e, dbexceptions.OperationalError):
           self.resolve_topology()
 
+    # None of the cached endpoints work, read them again next time. They
+    # are cached under the keyspace ServedFrom redirects to.
+    topo_utils.invalidate_end_points(db_params_list[0]['keyspace'],
+                                     self.shard, self.db_type)
     raise dbexceptions.OperationalError(
       'unable to create vt connection', db_key, host_addr, db_exception)
 
@@ -187,3 +199,249 @@ class VtOCCConnection(object):
   # and re-reads it from the toposerver once per 'n' secs.
   def resolve_topology(self):
     topology.refresh_keyspace(self.topo_client, self.keyspace)
+
+
+class _ShardConnectionPool(object):
+  """Idle tablet connections to the endpoints of one shard.
+
+  Calls take turns over the endpoints, so even a serial caller spreads
+  its queries over all the tablets serving the shard. Idle connections
+  are kept per endpoint, the endpoints that failed recently are tried
+  last.
+  """
+
+  def __init__(self, topo_client, keyspace, shard, db_type, timeout, user,
+               password, encrypted, max_idle):
+    self.topo_client = topo_client
+    self.keyspace = keyspace
+    self.shard = shard
+    self.db_type = db_type
+    self.timeout = timeout
+    self.user = user
+    self.password = password
+    self.encrypted = encrypted
+    self.max_idle = max_idle
+    # 'host:port' -> idle connections to that endpoint
+    self.idle_conns = {}
+    self.idle_count = 0
+    self.turn = 0
+    self.lock = threading.Lock()
+
+  def get(self):
+    db_key = "%s.%s.%s" % (self.keyspace, self.shard, self.db_type)
+    db_params_list = get_vt_connection_params_list(self.topo_client,
+                                                   self.keyspace,
+                                                   self.shard,
+                                                   self.db_type,
+                                                   self.timeout,
+                                                   self.encrypted,
+                                                   self.user,
+                                                   self.password)
+    if not db_params_list:
+      topology.refresh_keyspace(self.topo_client, self.keyspace)
+      raise dbexceptions.OperationalError("empty db params list - no db instance available for key %s" % db_key)
+
+    # Healthy endpoints take turns, in a stable order. The ones that
+    # failed recently keep the order of db_params_list, at the end.
+    healthy = []
+    failed = []
+    for params in db_params_list:
+      if topo_utils.is_end_point_failed(params['addr']):
+        failed.append(params)
+      else:
+        healthy.append(params)
+    healthy.sort(key=lambda params: params['addr'])
+    with self.lock:
+      turn = self.turn
+      self.turn += 1
+      stale = self._drop_stale_locked(
+          set(params['addr'] for params in db_params_list))
+    for conn in stale:
+      conn.close()
+    if healthy:
+      turn %= len(healthy)
+      healthy = healthy[turn:] + healthy[:turn]
+
+    db_exception = None
+    host_addr = None
+    for params in healthy + failed:
+      host_addr = params['addr']
+      with self.lock:
+        conns = self.idle_conns.get(host_addr)
+        if conns:
+          self.idle_count -= 1
+          return conns.pop()
+      try:
+        conn = tablet.TabletConnection(**params.copy())
+        conn.dial()
+        topo_utils.mark_end_point_healthy(host_addr)
+        return conn
+      except Exception as e:
+        db_exception = e
+        logging.warning('db connection failed: %s %s, %s', db_key, host_addr, e)
+        topo_utils.mark_end_point_failed(host_addr)
+
+    topo_utils.invalidate_end_points(db_params_list[0]['keyspace'],
+                                     self.shard, self.db_type)
+    topology.refresh_keyspace(self.topo_client, self.keyspace)
+    raise dbexceptions.OperationalError(
+      'unable to create vt connection', db_key, host_addr, db_exception)
+
+  def put(self, conn):
+    with self.lock:
+      if self.idle_count < self.max_idle:
+        self.idle_conns.setdefault(conn.addr, []).append(conn)
+        self.idle_count += 1
+        return
+    conn.close()
+
+  def close(self):
+    with self.lock:
+      conns = [conn for conn_list in self.idle_conns.itervalues()
+               for conn in conn_list]
+      self.idle_conns = {}
+      self.idle_count = 0
+    for conn in conns:
+      conn.close()
+
+  def _drop_stale_locked(self, addrs):
+    """Removes and returns the idle connections to endpoints not in addrs."""
+    stale = []
+    for addr in self.idle_conns.keys():
+      if addr not in addrs:
+        stale.extend(self.idle_conns.pop(addr))
+    self.idle_count -= len(stale)
+    return stale
+
+
+class ShardResult(object):
+  """Outcome of a query on one shard of MultiShardVtOCCConnection.
+
+  Attributes:
+    result: (results, rowcount, lastrowid, fields) of the query, None if
+    it failed.
+    error: exception raised by the query, None if it succeeded.
+  """
+
+  def __init__(self, result=None, error=None):
+    self.result = result
+    self.error = error
+
+
+class MultiShardVtOCCConnection(object):
+  """Direct tablet access to all the shards of a keyspace.
+
+  Each shard has its own pool of tablet connections, dialed over all
+  its endpoints. Queries run outside of transactions: a connection that
+  fails is thrown away and the query is retried on another one.
+  """
+
+  def __init__(self, topo_client, keyspace, db_type, timeout, user=None,
+               password=None, encrypted=False,
+               pool_size=DEFAULT_SHARD_POOL_SIZE,
+               max_workers=DEFAULT_MULTI_SHARD_WORKERS):
+    self.topo_client = topo_client
+    self.keyspace = keyspace
+    self.db_type = db_type
+    self.timeout = timeout
+    self.user = user
+    self.password = password
+    self.encrypted = encrypted
+    self.pool_size = pool_size
+    self.max_workers = max_workers
+    self.max_attempts = MAX_RETRY_ATTEMPTS
+    self._pools = {}
+    self._pools_lock = threading.Lock()
+
+  def get_shard_names(self):
+    ks = topology.get_keyspace(self.keyspace)
+    if ks is None:
+      raise dbexceptions.ProgrammingError('unknown keyspace', self.keyspace)
+    return [shard['Name'] for shard in ks.get_shards(self.db_type)]
+
+  def _get_pool(self, shard):
+    shard = str(shard)
+    with self._pools_lock:
+      pool = self._pools.get(shard)
+      if pool is None:
+        pool = _ShardConnectionPool(self.topo_client, self.keyspace, shard,
+                                    self.db_type, self.timeout, self.user,
+                                    self.password, self.encrypted,
+                                    self.pool_size)
+        self._pools[shard] = pool
+    return pool
+
+  def _execute(self, shard, sql, bind_variables):
+    sql, bind_variables = dbapi.prepare_query_bind_vars(sql, bind_variables)
+    pool = self._get_pool(shard)
+    attempt = 0
+    while True:
+      conn = pool.get()
+      try:
+        result = conn._execute(sql, bind_variables)
+      except (dbexceptions.RetryError, dbexceptions.FatalError) as e:
+        conn.close()
+        attempt += 1
+        topology.refresh_keyspace(self.topo_client, self.keyspace)
+        if attempt >= self.max_attempts:
+          vtdb_logger.get_logger().vtclient_exception(self.keyspace, shard, self.db_type, e)
+          raise dbexceptions.FatalError(*e.args)
+        time.sleep(RECONNECT_DELAY)
+        continue
+      except dbexceptions.IntegrityError as e:
+        pool.put(conn)
+        vtdb_logger.get_logger().integrity_error(e)
+        raise
+      except Exception:
+        conn.close()
+        raise
+      pool.put(conn)
+      return result
+
+  def execute_on_shards(self, sql, bind_variables, shards=None):
+    """Runs a query on several shards concurrently.
+
+    Args:
+      sql: query, with %(name)s bind variables.
+      bind_variables: dict of bind variables, the same for all shards.
+      shards: names of the shards to run on, all the shards by default.
+
+    Returns:
+      dict of shard name to ShardResult. An error on one shard doesn't
+      affect the others.
+    """
+    if shards is None:
+      shards = self.get_shard_names()
+    shards = [str(shard) for shard in shards]
+    results = {}
+    pending = Queue.Queue()
+    for shard in shards:
+      pending.put(shard)
+
+    def run_queries():
+      while True:
+        try:
+          shard = pending.get_nowait()
+        except Queue.Empty:
+          return
+        try:
+          results[shard] = ShardResult(
+              result=self._execute(shard, sql, bind_variables))
+        except Exception as e:
+          results[shard] = ShardResult(error=e)
+
+    workers = [threading.Thread(target=run_queries)
+               for _ in xrange(min(self.max_workers, len(shards)))]
+    for worker in workers:
+      worker.daemon = True
+      worker.start()
+    for worker in workers:
+      worker.join()
+    return results
+
+  def close(self):
+    with self._pools_lock:
+      pools = self._pools.values()
+      self._pools = {}
+    for pool in pools:
+      pool.close()
@@ -23,6 +23,12 @@ class VtdbLogger(object):
   def topo_keyspace_fetch(self, keyspace_name, topo_rtt):
     logging.info("Fetched keyspace %s from topo_client in %f secs", keyspace_name, topo_rtt)
 
+  # topo_bootstrap_phase is called at the end of each phase of
+  # topology.read_topology, phase being 'keyspace_names', 'keyspaces'
+  # or 'end_points', with the number of items read in that phase.
+  def topo_bootstrap_phase(self, phase, item_count, elapsed):
+    logging.info("Read %d %s from topo_client in %f secs", item_count, phase, elapsed)
+
   # topo_empty_keyspace_list is called when we get an empty list of
   # keyspaces from topo server.
   def topo_empty_keyspace_list(self):
@@ -71,6 +77,35 @@ class VtdbLogger(object):
   def vtgatev2_exception(self, e):
     logging.warning('vtgatev2_exception: %s', e)
 
+  #
+  # vtgate_utils callbacks
+  #
+
+  # vtgate_retry is called before a call that failed with a retryable
+  # error is retried, after sleeping delay_ms.
+  def vtgate_retry(self, keyspace_name, db_type, attempt, num_retries,
+                   delay_ms, e):
+    logging.error('retryable error: %s, retrying in %d ms, attempt %d of %d',
+                  e, delay_ms, attempt, num_retries)
+
+  # retry_budget_exhausted is called when a retryable error is not retried
+  # because the process or keyspace retry budget is empty.
+  def retry_budget_exhausted(self, keyspace_name, db_type, e):
+    logging.warning('retry_budget_exhausted for %s.%s: %s', keyspace_name,
+                    db_type, e)
+
+  # circuit_breaker_tripped is called when the vtgate circuit breaker
+  # opens after failure_count consecutive failed calls.
+  def circuit_breaker_tripped(self, failure_count):
+    logging.warning('circuit_breaker_tripped after %d failures',
+                    failure_count)
+
+  # circuit_breaker_rejected is called when a call fails fast because
+  # the vtgate circuit breaker is open.
+  def circuit_breaker_rejected(self, keyspace_name, db_type):
+    logging.warning('circuit_breaker_rejected for %s.%s', keyspace_name,
+                    db_type)
+
   def log_private_data(self, private_data):
     logging.info("Additional exception data %s", private_data)
 
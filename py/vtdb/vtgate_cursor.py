@@ -4,10 +4,13 @@
 
 import itertools
 import re
+import sys
+import threading
 
 from vtdb import cursor
 from vtdb import dbexceptions
 from vtdb import keyrange_constants
+from vtdb import result_cache
 
 
 write_sql_pattern = re.compile('\s*(insert|update|delete)', re.IGNORECASE)
@@ -27,6 +30,9 @@ class VTGateCursor(object):
   keyranges = None
   _writable = None
   routing = None
+  # Set by DatabaseContext for reads that may be served from its cache.
+  result_cache = None
+  result_cache_ttl = None
 
   def __init__(self, connection, keyspace, tablet_type, keyspace_ids=None, keyranges=None, writable=False):
     self._conn = connection
@@ -79,7 +85,7 @@ class VTGateCursor(object):
       if not self.is_writable():
         raise dbexceptions.DatabaseError('DML on a non-writable cursor', sql)
 
-    self.results, self.rowcount, self.lastrowid, self.description = self._conn._execute(
+    execute = lambda: self._conn._execute(
         sql,
         bind_variables,
         self.keyspace,
@@ -87,9 +93,26 @@ class VTGateCursor(object):
         keyspace_ids=self.keyspace_ids,
         keyranges=self.keyranges,
         not_in_transaction=(not self.is_writable()))
+    if self.result_cache is not None and not write_query:
+      routing = (self.keyspace_ids, self.keyranges)
+      self._execute_cached(execute, routing, sql, bind_variables)
+    else:
+      self.results, self.rowcount, self.lastrowid, self.description = execute()
     self.index = 0
     return self.rowcount
 
+  def _execute_cached(self, execute, routing, sql, bind_variables):
+    key = result_cache.make_key(self.keyspace, self.tablet_type, routing, sql,
+                                bind_variables)
+    result = self.result_cache.get(key)
+    if result is None:
+      result = execute()
+      self.result_cache.set(key, result, self.result_cache_ttl)
+    results, self.rowcount, self.lastrowid, description = result
+    # The cached lists are shared by all the cursors reading them.
+    self.results = list(results)
+    self.description = list(description)
+
   def execute_entity_ids(self, sql, bind_variables, entity_keyspace_id_map, entity_column_name):
     self.rowcount = 0
     self.results = None
@@ -101,7 +124,7 @@ class VTGateCursor(object):
     if write_query:
       raise dbexceptions.DatabaseError('execute_entity_ids is not allowed for write queries')
 
-    self.results, self.rowcount, self.lastrowid, self.description = self._conn._execute_entity_ids(
+    execute = lambda: self._conn._execute_entity_ids(
         sql,
         bind_variables,
         self.keyspace,
@@ -109,6 +132,11 @@ class VTGateCursor(object):
         entity_keyspace_id_map,
         entity_column_name,
         not_in_transaction=(not self.is_writable()))
+    if self.result_cache is not None:
+      routing = (entity_column_name, entity_keyspace_id_map)
+      self._execute_cached(execute, routing, sql, bind_variables)
+    else:
+      self.results, self.rowcount, self.lastrowid, self.description = execute()
     self.index = 0
     return self.rowcount
 
@@ -190,6 +218,42 @@ class VTGateCursor(object):
     return val
 
 
+def _estimated_size(value):
+  """Returns the approximate encoded size of a bind variable value."""
+  if isinstance(value, basestring):
+    return len(value)
+  if isinstance(value, dict):
+    return sum([len(k) + _estimated_size(v) for k, v in value.iteritems()])
+  if isinstance(value, (list, tuple, set, frozenset)):
+    return sum([_estimated_size(v) for v in value])
+  return 8
+
+
+class _BatchCall(object):
+  """Batch RPC running on a background thread."""
+
+  def __init__(self, execute):
+    self._execute = execute
+    self._rowsets = None
+    self._exc_info = None
+    self._thread = threading.Thread(target=self._run)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _run(self):
+    try:
+      self._rowsets = self._execute()
+    except:
+      self._exc_info = sys.exc_info()
+
+  def result(self):
+    """Waits for the RPC, returns its rowsets or raises its error."""
+    self._thread.join()
+    if self._exc_info is not None:
+      raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+    return self._rowsets
+
+
 class BatchVTGateCursor(VTGateCursor):
   """Batch Cursor for VTGate.
 
@@ -198,29 +262,77 @@ class BatchVTGateCursor(VTGateCursor):
   to only execute against one keyspace_id.
   This only supports keyspace_ids right now since that is what
   the underlying vtgate server supports.
+
+  Queries are sent when flush is called, or as soon as max_queries of
+  them, or about max_bytes of SQL and bind variables, are pending. In
+  pipelined mode, a batch is sent on a background thread while the next
+  one is being built; only one batch is in flight at a time, and the
+  connection shouldn't be used for anything else until flush returns.
+  rowsets grows as the replies arrive, and holds the results of all the
+  queries executed since the previous flush once flush returns.
   """
   def __init__(self, connection, keyspace, tablet_type, keyspace_ids=None,
-               writable=False):
+               writable=False, max_queries=None, max_bytes=None,
+               pipelined=False):
     # rowset is [(results, rowcount, lastrowid, fields),]
     self.rowsets = None
     self.query_list = []
     self.bind_vars_list = []
+    # Thresholds of pending queries that trigger a send, None for no limit.
+    self.max_queries = max_queries
+    self.max_bytes = max_bytes
+    self.pipelined = pipelined
+    self._pending_bytes = 0
+    # Set until the first batch after a flush, which resets rowsets.
+    self._new_round = True
+    # _BatchCall of the batch in flight in pipelined mode.
+    self._in_flight = None
     VTGateCursor.__init__(self, connection, keyspace, tablet_type,
                           keyspace_ids=keyspace_ids, writable=writable)
 
   def execute(self, sql, bind_variables=None):
     self.query_list.append(sql)
     self.bind_vars_list.append(bind_variables)
+    if self.max_bytes is not None:
+      self._pending_bytes += len(sql) + _estimated_size(bind_variables or {})
+    if ((self.max_queries is not None and
+         len(self.query_list) >= self.max_queries) or
+        (self.max_bytes is not None and
+         self._pending_bytes >= self.max_bytes)):
+      self._send_batch()
 
   def flush(self):
-    self.rowsets = self._conn._execute_batch(self.query_list,
-                                              self.bind_vars_list,
-                                              self.keyspace,
-                                              self.tablet_type,
-                                              self.keyspace_ids,
-                                              not_in_transaction=(not self.is_writable()))
+    # A round without any query still makes its (empty) batch call.
+    if self.query_list or self._new_round:
+      self._send_batch()
+    self._wait_for_batch()
+    self._new_round = True
+
+  def _send_batch(self):
+    query_list = self.query_list
+    bind_vars_list = self.bind_vars_list
     self.query_list = []
     self.bind_vars_list = []
+    self._pending_bytes = 0
+    if self._new_round:
+      self.rowsets = []
+      self._new_round = False
+
+    execute = lambda: self._conn._execute_batch(
+        query_list, bind_vars_list, self.keyspace, self.tablet_type,
+        self.keyspace_ids, not_in_transaction=(not self.is_writable()))
+    if not self.pipelined:
+      self.rowsets.extend(execute())
+      return
+    self._wait_for_batch()
+    self._in_flight = _BatchCall(execute)
+
+  def _wait_for_batch(self):
+    batch_call = self._in_flight
+    if batch_call is None:
+      return
+    self._in_flight = None
+    self.rowsets.extend(batch_call.result())
 
 
 class StreamVTGateCursor(VTGateCursor):
@@ -1,4 +1,7 @@
-import logging
+import inspect
+import random
+import sys
+import threading
 import time
 
 from vtdb import dbexceptions
@@ -8,6 +11,21 @@ INITIAL_DELAY_MS = 5
 NUM_RETRIES = 3
 MAX_DELAY_MS = 100
 BACKOFF_MULTIPLIER = 2
+# Up to this fraction of the nominal delay is added at random to each sleep,
+# so that clients that failed together do not retry together.
+JITTER_FRACTION = 0.5
+
+# Every request earns RETRY_BUDGET_RATIO retry tokens and every retry spends
+# one, so retries stay below that share of the requests over time. The
+# buckets start full so that an idle process can still ride out a blip.
+RETRY_BUDGET_RATIO = 0.1
+RETRY_BUDGET_MAX_TOKENS = 10
+
+# The circuit breaker opens after this many consecutive calls have failed
+# with a retryable error, and lets a single probe through after the reset
+# timeout.
+CIRCUIT_BREAKER_FAILURE_THRESHOLD = 5
+CIRCUIT_BREAKER_RESET_TIMEOUT_MS = 1000
 
 
 def log_exception(exc, keyspace=None, tablet_type=None):
@@ -30,6 +48,188 @@ def log_exception(exc, keyspace=None, tablet_type=None):
                                      exc)
 
 
+class RetryBudget(object):
+  """Token bucket that caps retries to a fraction of the requests.
+
+  Attributes:
+    ratio: tokens earned by every request.
+    max_tokens: capacity of the bucket.
+    tokens: tokens currently available, one is spent per retry.
+  """
+
+  def __init__(self, ratio=RETRY_BUDGET_RATIO,
+               max_tokens=RETRY_BUDGET_MAX_TOKENS):
+    self.ratio = ratio
+    self.max_tokens = max_tokens
+    self.tokens = float(max_tokens)
+    self.lock = threading.Lock()
+
+  def deposit(self, amount=None):
+    if amount is None:
+      amount = self.ratio
+    with self.lock:
+      self.tokens = min(self.max_tokens, self.tokens + amount)
+
+  def withdraw(self):
+    with self.lock:
+      if self.tokens < 1.0:
+        return False
+      self.tokens -= 1.0
+      return True
+
+
+class CircuitBreaker(object):
+  """Fails calls fast while vtgate keeps rejecting them.
+
+  The breaker is closed while calls succeed. After failure_threshold
+  consecutive failed calls it opens and rejects every call until
+  reset_timeout_ms have passed. It then lets one probe call through
+  (half-open): success closes it again, failure re-opens it.
+  """
+  CLOSED = 'closed'
+  OPEN = 'open'
+  HALF_OPEN = 'half_open'
+
+  def __init__(self, failure_threshold=CIRCUIT_BREAKER_FAILURE_THRESHOLD,
+               reset_timeout_ms=CIRCUIT_BREAKER_RESET_TIMEOUT_MS):
+    self.failure_threshold = failure_threshold
+    self.reset_timeout_ms = reset_timeout_ms
+    self.state = self.CLOSED
+    self.failure_count = 0
+    self.opened_at = None
+    self.lock = threading.Lock()
+
+  def allow_request(self):
+    """Returns (allowed, is_probe) for a new call."""
+    with self.lock:
+      if self.state == self.CLOSED:
+        return True, False
+      if self.state == self.OPEN:
+        if (time.time() - self.opened_at) * 1000 < self.reset_timeout_ms:
+          return False, False
+        self.state = self.HALF_OPEN
+        return True, True
+      # Half-open: a probe is already in flight.
+      return False, False
+
+  def release_probe(self):
+    """Ends a probe call that neither succeeded nor showed overload.
+
+    The breaker goes back to open, and the next call after the reset
+    timeout is the new probe.
+    """
+    with self.lock:
+      if self.state == self.HALF_OPEN:
+        self.state = self.OPEN
+        self.opened_at = time.time()
+
+  def record_success(self):
+    with self.lock:
+      self.state = self.CLOSED
+      self.failure_count = 0
+      self.opened_at = None
+
+  def record_failure(self):
+    with self.lock:
+      self.failure_count += 1
+      if (self.state == self.HALF_OPEN or
+          (self.state == self.CLOSED and
+           self.failure_count >= self.failure_threshold)):
+        self.state = self.OPEN
+        self.opened_at = time.time()
+        tripped = True
+      else:
+        tripped = False
+      failure_count = self.failure_count
+    if tripped:
+      vtdb_logger.get_logger().circuit_breaker_tripped(failure_count)
+
+
+# Process-wide retry state shared by all decorated methods.
+__retry_state_lock = threading.Lock()
+__process_retry_budget = RetryBudget()
+__keyspace_retry_budgets = {}
+__circuit_breaker = CircuitBreaker()
+__retry_budget_params = (RETRY_BUDGET_RATIO, RETRY_BUDGET_MAX_TOKENS)
+
+
+def configure_retry_budget(ratio=RETRY_BUDGET_RATIO,
+                           max_tokens=RETRY_BUDGET_MAX_TOKENS):
+  """Resets the process and keyspace retry budgets with new parameters."""
+  global __process_retry_budget, __keyspace_retry_budgets
+  global __retry_budget_params
+  with __retry_state_lock:
+    __retry_budget_params = (ratio, max_tokens)
+    __process_retry_budget = RetryBudget(ratio, max_tokens)
+    __keyspace_retry_budgets = {}
+
+
+def configure_circuit_breaker(
+    failure_threshold=CIRCUIT_BREAKER_FAILURE_THRESHOLD,
+    reset_timeout_ms=CIRCUIT_BREAKER_RESET_TIMEOUT_MS):
+  """Replaces the circuit breaker with a closed one with new parameters."""
+  global __circuit_breaker
+  __circuit_breaker = CircuitBreaker(failure_threshold, reset_timeout_ms)
+
+
+def get_process_retry_budget():
+  return __process_retry_budget
+
+
+def get_retry_budget(keyspace, tablet_type):
+  """Returns the retry budget for a keyspace and tablet_type."""
+  key = (keyspace, tablet_type)
+  try:
+    return __keyspace_retry_budgets[key]
+  except KeyError:
+    with __retry_state_lock:
+      if key not in __keyspace_retry_budgets:
+        __keyspace_retry_budgets[key] = RetryBudget(*__retry_budget_params)
+      return __keyspace_retry_budgets[key]
+
+
+def get_circuit_breaker():
+  return __circuit_breaker
+
+
+def _withdraw_retry_token(keyspace, tablet_type):
+  keyspace_budget = get_retry_budget(keyspace, tablet_type)
+  if not keyspace_budget.withdraw():
+    return False
+  if not get_process_retry_budget().withdraw():
+    # Give back the keyspace token, the retry is not happening.
+    keyspace_budget.deposit(1.0)
+    return False
+  return True
+
+
+def _jittered_delay_ms(delay):
+  return delay + random.uniform(0, delay * JITTER_FRACTION)
+
+
+def _routing_arg_getter(method, name):
+  """Returns a function extracting the named argument of a method call.
+
+  This lets the retry decorator find the keyspace and tablet_type of the
+  call. If the method has no such argument, the attribute of the same name
+  on the connection is used instead.
+  """
+  try:
+    arg_names = inspect.getargspec(method).args
+  except TypeError:
+    arg_names = []
+  # arg_names includes self, which is not part of args.
+  position = arg_names.index(name) - 1 if name in arg_names else None
+
+  def get_arg(obj, args, kwargs):
+    if name in kwargs:
+      return kwargs[name]
+    if position is not None and position < len(args):
+      return args[position]
+    return getattr(obj, name, None)
+  return get_arg
+
+
 def exponential_backoff_retry(
     retry_exceptions,
     initial_delay_ms=INITIAL_DELAY_MS,
@@ -40,31 +240,141 @@ def exponential_backoff_retry(
 
   Log and raise exception if unsuccessful
   Do not retry while in a session
+  Do not retry when the process or keyspace retry budget is empty
+  Fail fast without calling the method while the circuit breaker is open
 
   retry_exceptions: tuple of exceptions to check
-  initial_delay_ms: initial delay between retries in ms
+  initial_delay_ms: initial delay between retries in ms, jittered
   num_retries: number max number of retries
   backoff_multipler: multiplier for each retry e.g. 2 will double the retry delay
   max_delay_ms: upper bound on retry delay
   """
   def decorator(method):
+    get_keyspace = _routing_arg_getter(method, 'keyspace')
+    get_tablet_type = _routing_arg_getter(method, 'tablet_type')
+
     def wrapper(self, *args, **kwargs):
       attempt = 0
       delay = initial_delay_ms
+      keyspace = get_keyspace(self, args, kwargs)
+      tablet_type = get_tablet_type(self, args, kwargs)
+      logger_object = vtdb_logger.get_logger()
+      circuit_breaker = get_circuit_breaker()
 
+      allowed, is_probe = circuit_breaker.allow_request()
+      if not allowed:
+        logger_object.circuit_breaker_rejected(keyspace, tablet_type)
+        raise dbexceptions.RequestBacklog(
+            'circuit breaker open', keyspace, tablet_type)
+
+      get_retry_budget(keyspace, tablet_type).deposit()
+      get_process_retry_budget().deposit()
       while True:
         try:
-          return method(self, *args, **kwargs)
+          result = method(self, *args, **kwargs)
         except retry_exceptions as e:
           attempt += 1
           if attempt > num_retries or self.session:
+            circuit_breaker.record_failure()
             # In this case it is hard to discern keyspace
             # and tablet_type from exception.
             log_exception(e)
             raise e
-          logging.error("retryable error: %s, retrying in %d ms, attempt %d of %d", e, delay, attempt, num_retries)
-          time.sleep(delay/1000.0)
+          if not _withdraw_retry_token(keyspace, tablet_type):
+            circuit_breaker.record_failure()
+            logger_object.retry_budget_exhausted(keyspace, tablet_type, e)
+            log_exception(e)
+            raise e
+          sleep_ms = _jittered_delay_ms(delay)
+          logger_object.vtgate_retry(keyspace, tablet_type, attempt,
+                                     num_retries, sleep_ms, e)
+          time.sleep(sleep_ms/1000.0)
           delay *= backoff_multiplier
           delay = min(max_delay_ms, delay)
+        except:
+          # Not an overload signal: the breaker state is unchanged, but
+          # a probe must not keep the breaker half-open forever.
+          if is_probe:
+            circuit_breaker.release_probe()
+          raise
+        else:
+          circuit_breaker.record_success()
+          return result
     return wrapper
   return decorator
+
+
+def canonical_value(value):
+  """Returns a hashable value that is equal for equal requests or bind vars.
+
+  Dicts are turned into sorted item tuples and lists into tuples, so the
+  result can be used as a cache key. BSON-encodable objects like
+  keyrange.KeyRange are represented by their encoding.
+  """
+  if isinstance(value, dict):
+    return tuple(sorted((k, canonical_value(v)) for k, v in value.iteritems()))
+  if isinstance(value, (list, tuple, set, frozenset)):
+    if isinstance(value, (set, frozenset)):
+      value = sorted(value)
+    return tuple(canonical_value(v) for v in value)
+  if hasattr(value, 'bson_encode'):
+    return canonical_value(value.bson_encode())
+  return value
+
+
+class _InFlightCall(object):
+  """A call being executed on behalf of all SingleFlight callers."""
+
+  def __init__(self):
+    self.done = threading.Event()
+    self.result = None
+    self.exception = None
+
+
+class SingleFlight(object):
+  """Coalesces identical concurrent calls into one.
+
+  The first caller for a key runs the function. Callers that arrive with
+  the same key while it is running wait for it and share its result or
+  exception. Nothing is kept once the call has returned, so results are
+  never staler than the in-flight window.
+  """
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.calls = {}
+
+  def do(self, key, func):
+    """Runs func, or waits for the in-flight call for key.
+
+    Args:
+      key: hashable identity of the call.
+      func: function without arguments performing the call.
+
+    Returns:
+      Tuple (result, shared), shared being True for callers that did not
+      run func themselves.
+    """
+    with self.lock:
+      call = self.calls.get(key)
+      leader = call is None
+      if leader:
+        call = _InFlightCall()
+        self.calls[key] = call
+
+    if not leader:
+      call.done.wait()
+      if call.exception is not None:
+        raise call.exception
+      return call.result, True
+
+    try:
+      call.result = func()
+    except:
+      call.exception = sys.exc_info()[1]
+      raise
+    finally:
+      with self.lock:
+        del self.calls[key]
+      call.done.set()
+    return call.result, False
@@ -2,10 +2,14 @@
 # Use of this source code is governed by a BSD-style license that can
 # be found in the LICENSE file.
 
+import collections
 from itertools import izip
 import logging
+import os
 import random
 import re
+import struct
+import sys
 
 from net import bsonrpc
 from net import gorpc
@@ -13,6 +17,7 @@ from vtdb import dbapi
 from vtdb import dbexceptions
 from vtdb import field_types
 from vtdb import keyrange
+from vtdb import topology
 from vtdb import vtdb_logger
 from vtdb import vtgate_cursor
 from vtdb import vtgate_utils
@@ -103,6 +108,70 @@ def _create_req_with_keyranges(sql, new_binds, keyspace, tablet_type, keyranges,
   return req
 
 
+# Identical concurrent reads from all connections of the process share one
+# RPC when the connections have coalesce_reads set.
+_read_coalescer = vtgate_utils.SingleFlight()
+
+
+def _canonical_request_key(exec_method, req):
+  """Returns a hashable key that is equal for identical requests."""
+  return (exec_method, vtgate_utils.canonical_value(req))
+
+
+_vtdb_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+def _dml_origin():
+  """Returns 'file:line function' of the first caller outside of vtdb."""
+  frame = sys._getframe(1)
+  while frame is not None:
+    code = frame.f_code
+    if os.path.dirname(os.path.abspath(code.co_filename)) != _vtdb_dir:
+      return '%s:%d %s' % (code.co_filename, frame.f_lineno, code.co_name)
+    frame = frame.f_back
+  return None
+
+
+class _BufferedDML(object):
+  """A DML of a write-behind transaction, waiting to be sent."""
+
+  def __init__(self, sql, bind_variables, keyspace, tablet_type, keyspace_ids):
+    self.sql = sql
+    self.bind_variables = bind_variables
+    self.keyspace = keyspace
+    self.tablet_type = tablet_type
+    self.keyspace_ids = keyspace_ids
+    self.routing = (keyspace, tablet_type, tuple(keyspace_ids))
+    self.shard_name = _dml_shard_name(keyspace, tablet_type, keyspace_ids[0])
+    # Call site of the DML, for error reports.
+    self.origin = _dml_origin()
+
+
+def _dml_shard_name(keyspace_name, tablet_type, keyspace_id):
+  """Returns the shard of a packed keyspace_id in the cached topology.
+
+  This only groups the buffered DMLs, vtgate still routes them by
+  keyspace_id. None if the shard isn't known.
+  """
+  ks = topology.get_keyspace(keyspace_name)
+  if ks is not None and ks.served_from:
+    served_from = ks.served_from.get(tablet_type)
+    if served_from is not None:
+      ks = topology.get_keyspace(served_from)
+  if ks is None:
+    return None
+  try:
+    return ks.keyspace_id_to_shard_name_for_db_type(
+        struct.unpack('!Q', keyspace_id)[0], tablet_type)
+  except (struct.error, ValueError):
+    return None
+
+
+def _add_dml_statements(exc, dmls):
+  """Sets exc.dml_statements to the (sql, call site) of the failed batch."""
+  exc.dml_statements = [(dml.sql, dml.origin) for dml in dmls]
+
+
 # A simple, direct connection to the vttablet query server.
 # This is shard-unaware and only handles the most basic communication.
 # If something goes wrong, this object should be thrown away and a new one instantiated.
@@ -113,9 +182,16 @@ class VTGateConnection(object):
   _stream_result = None
   _stream_result_index = None
 
-  def __init__(self, addr, timeout, user=None, password=None, encrypted=False, keyfile=None, certfile=None):
+  def __init__(self, addr, timeout, user=None, password=None, encrypted=False, keyfile=None, certfile=None, coalesce_reads=False):
     self.addr = addr
     self.timeout = timeout
+    # If set, non-transactional reads identical to one in flight on any
+    # connection wait for its result instead of issuing their own RPC.
+    self.coalesce_reads = coalesce_reads
+    # If set by begin, the DMLs of the transaction routed by keyspace_ids
+    # are buffered in _dml_buffer instead of being sent one by one.
+    self.write_behind = False
+    self._dml_buffer = []
     self.client = bsonrpc.BsonRpcClient(addr, timeout, user, password, encrypted=encrypted, keyfile=keyfile, certfile=certfile)
     self.logger_object = vtdb_logger.get_logger()
 
@@ -148,14 +224,36 @@ class VTGateConnection(object):
       cursorclass = vtgate_cursor.VTGateCursor
     return cursorclass(self, *pargs, **kwargs)
 
-  def begin(self):
+  def begin(self, write_behind=False):
+    """Begins a transaction.
+
+    Args:
+      write_behind: if set, the DMLs of the transaction routed by
+      keyspace_ids don't wait for their reply. They are buffered and sent
+      in batches, before the next statement that isn't buffered and at the
+      latest at commit. Their cursors have a rowcount and lastrowid of None,
+      and their errors are raised by the statement or commit that sends
+      them. The dml_statements attribute of the error lists the
+      (sql, call site) of the statements of the failed batch.
+    """
     try:
       response = self.client.call('VTGate.Begin', None)
       self.session = response.reply
     except gorpc.GoRpcError as e:
       raise convert_exception(e, str(self))
+    self.write_behind = write_behind
+    self._dml_buffer = []
 
   def commit(self):
+    try:
+      self._flush_dml_buffer()
+    except:
+      exc_info = sys.exc_info()
+      try:
+        self.rollback()
+      except dbexceptions.DatabaseError:
+        logging.exception('rollback after a failed write-behind flush')
+      raise exc_info[0], exc_info[1], exc_info[2]
     try:
       session = self.session
       self.client.call('VTGate.Commit', session)
@@ -165,6 +263,7 @@ class VTGateConnection(object):
       self.session = None
 
   def rollback(self):
+    self._dml_buffer = []
     try:
       session = self.session
       self.client.call('VTGate.Rollback', session)
@@ -181,8 +280,71 @@ class VTGateConnection(object):
     if 'Session' in response.reply and response.reply['Session']:
       self.session = response.reply['Session']
 
+  def _buffer_dml(self, sql, bind_variables, keyspace, tablet_type,
+                  keyspace_ids, not_in_transaction):
+    """Buffers a DML of a write-behind transaction, returns False otherwise.
+
+    A DML routed to several keyspace_ids is sent right away, so that
+    vtgate rejects it as it does outside write-behind transactions.
+    """
+    if (not self.write_behind or not self.session or keyspace_ids is None or
+        len(keyspace_ids) != 1 or not_in_transaction or
+        not vtgate_cursor.write_sql_pattern.match(sql)):
+      return False
+    self._dml_buffer.append(_BufferedDML(sql, bind_variables, keyspace,
+                                         tablet_type, keyspace_ids))
+    return True
+
+  def _flush_dml_buffer(self):
+    """Sends the buffered DMLs, one ExecuteBatchKeyspaceIds per shard.
+
+    The DMLs of a shard are sent in the order they were buffered, with
+    the keyspace_ids of all of them. If the topology doesn't know the
+    shard of one of them, the DMLs are sent in order instead, one batch
+    per run of equal routing. The buffer is emptied first: calls in a
+    transaction are not retried, so a failed batch fails the transaction.
+    """
+    dmls = self._dml_buffer
+    if not dmls:
+      return
+    self._dml_buffer = []
+    if all(dml.shard_name is not None for dml in dmls):
+      shard_batches = collections.OrderedDict()
+      for dml in dmls:
+        shard_batches.setdefault(
+            (dml.keyspace, dml.tablet_type, dml.shard_name), []).append(dml)
+      for (keyspace, tablet_type, _), batch in shard_batches.iteritems():
+        keyspace_ids = sorted(set(dml.keyspace_ids[0] for dml in batch))
+        self._send_dml_batch(batch, keyspace, tablet_type, keyspace_ids)
+      return
+    while dmls:
+      first = dmls[0]
+      batch_size = 1
+      while (batch_size < len(dmls) and
+             dmls[batch_size].routing == first.routing):
+        batch_size += 1
+      self._send_dml_batch(dmls[:batch_size], first.keyspace,
+                           first.tablet_type, first.keyspace_ids)
+      del dmls[:batch_size]
+
+  def _send_dml_batch(self, batch, keyspace, tablet_type, keyspace_ids):
+    try:
+      self._execute_batch_req([dml.sql for dml in batch],
+                              [dml.bind_variables for dml in batch],
+                              keyspace, tablet_type, keyspace_ids)
+    except (dbexceptions.Error, dbexceptions.DatabaseError) as e:
+      # DatabaseError doesn't derive from Error, and dbapi raises
+      # InterfaceError, an Error, on bad bind variables.
+      _add_dml_statements(e, batch)
+      raise
+
   @vtgate_utils.exponential_backoff_retry((dbexceptions.RequestBacklog))
   def _execute(self, sql, bind_variables, keyspace, tablet_type, keyspace_ids=None, keyranges=None, not_in_transaction=False):
+    if self._buffer_dml(sql, bind_variables, keyspace, tablet_type,
+                        keyspace_ids, not_in_transaction):
+      return [], None, None, []
+    self._flush_dml_buffer()
+
     exec_method = None
     req = None
     if keyspace_ids is not None:
@@ -196,6 +358,24 @@ class VTGateConnection(object):
 
     self._add_session(req)
 
+    if self._can_coalesce(sql):
+      key = _canonical_request_key(exec_method, req)
+      execute = lambda: self._execute_req(
+          exec_method, req, sql, bind_variables, keyspace, tablet_type,
+          keyspace_ids, keyranges)
+      result, _ = _read_coalescer.do(key, execute)
+      results, rowcount, lastrowid, fields = result
+      # Every caller gets its own lists, they may be mutated.
+      return list(results), rowcount, lastrowid, list(fields)
+    return self._execute_req(exec_method, req, sql, bind_variables, keyspace,
+                             tablet_type, keyspace_ids, keyranges)
+
+  def _can_coalesce(self, sql):
+    return (self.coalesce_reads and not self.session and
+            not vtgate_cursor.write_sql_pattern.match(sql))
+
+  def _execute_req(self, exec_method, req, sql, bind_variables, keyspace,
+                   tablet_type, keyspace_ids, keyranges):
     fields = []
     conversions = []
     results = []
@@ -230,6 +410,7 @@ class VTGateConnection(object):
 
   @vtgate_utils.exponential_backoff_retry((dbexceptions.RequestBacklog))
   def _execute_entity_ids(self, sql, bind_variables, keyspace, tablet_type, entity_keyspace_id_map, entity_column_name, not_in_transaction=False):
+    self._flush_dml_buffer()
     sql, new_binds = dbapi.prepare_query_bind_vars(sql, bind_variables)
     new_binds = field_types.convert_bind_vars(new_binds)
     req = {
@@ -279,6 +460,12 @@ class VTGateConnection(object):
 
   @vtgate_utils.exponential_backoff_retry((dbexceptions.RequestBacklog))
   def _execute_batch(self, sql_list, bind_variables_list, keyspace, tablet_type, keyspace_ids, not_in_transaction=False):
+    self._flush_dml_buffer()
+    return self._execute_batch_req(sql_list, bind_variables_list, keyspace,
+                                   tablet_type, keyspace_ids,
+                                   not_in_transaction=not_in_transaction)
+
+  def _execute_batch_req(self, sql_list, bind_variables_list, keyspace, tablet_type, keyspace_ids, not_in_transaction=False):
     query_list = []
     for sql, bind_vars in zip(sql_list, bind_variables_list):
       sql, bind_vars = dbapi.prepare_query_bind_vars(sql, bind_vars)
@@ -332,6 +519,7 @@ class VTGateConnection(object):
   # (that way we avoid using a member variable here for such a corner case)
   @vtgate_utils.exponential_backoff_retry((dbexceptions.RequestBacklog))
   def _stream_execute(self, sql, bind_variables, keyspace, tablet_type, keyspace_ids=None, keyranges=None, not_in_transaction=False):
+    self._flush_dml_buffer()
     exec_method = None
     req = None
     if keyspace_ids is not None:
@@ -441,7 +629,8 @@ def get_params_for_vtgate_conn(vtgate_addrs, timeout, encrypted=False, user=None
   return db_params_list
 
 
-def connect(vtgate_addrs, timeout, encrypted=False, user=None, password=None):
+def connect(vtgate_addrs, timeout, encrypted=False, user=None, password=None,
+            coalesce_reads=False):
   db_params_list = get_params_for_vtgate_conn(vtgate_addrs, timeout,
                                               encrypted=encrypted, user=user,
                                               password=password)
@@ -455,7 +644,7 @@ def connect(vtgate_addrs, timeout, encrypted=False, user=None, password=None):
     try:
       db_params = params.copy()
       host_addr = db_params['addr']
-      conn = VTGateConnection(**db_params)
+      conn = VTGateConnection(coalesce_reads=coalesce_reads, **db_params)
       conn.dial()
       return conn
     except Exception as e:
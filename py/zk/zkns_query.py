@@ -6,9 +6,13 @@
 # Additionally, config information can be embedded nearby for future updates
 # to the python client.
 
+import bisect
 import collections
 import json
+import logging
 import random
+import threading
+import time
 
 from zk import zkjson
 
@@ -32,38 +36,40 @@ class ZknsAddrs(zkjson.ZkJsonObject):
     self.entries = []
 
 
-def _sorted_by_srv_priority(entries):
-  # Priority is ascending, weight is descending.
-  entries.sort(key=lambda x: (x.priority, -x.weight))
+def _weighted_shuffle(entries):
+  # Entries are drawn in turn with a probability proportional to their
+  # weight: sorting on random() ** (1 / weight) gives the same order in
+  # O(n log n). Entries of weight 0 come last, in random order.
+  keyed_entries = []
+  for entry in entries:
+    if entry.weight > 0:
+      key = random.random() ** (1.0 / entry.weight)
+    else:
+      key = -random.random()
+    keyed_entries.append((key, entry))
+  keyed_entries.sort(key=lambda x: x[0], reverse=True)
+  return [entry for _, entry in keyed_entries]
 
+
+def _group_by_srv_priority(entries):
+  # Returns [(priority, entries)] by ascending priority.
   priority_map = collections.defaultdict(list)
   for entry in entries:
     priority_map[entry.priority].append(entry)
+  return sorted(priority_map.iteritems())
+
 
+def _sorted_by_srv_priority(entries):
+  # Priority is ascending, weights are shuffled within a priority.
   shuffled_entries = []
-  for priority, priority_entries in sorted(priority_map.iteritems()):
+  for priority, priority_entries in _group_by_srv_priority(entries):
     if len(priority_entries) <= 1:
       shuffled_entries.extend(priority_entries)
-      continue
-
-    weight_sum = sum([e.weight for e in priority_entries])
-    # entries with a priority are sorted in descreasing weight
-    while weight_sum > 0 and priority_entries:
-      s = 0
-      n = random.randint(0, weight_sum)
-      for entry in priority_entries:
-        s += entry.weight
-        if s >= n:
-          shuffled_entries.append(entry)
-          priority_entries.remove(entry)
-          break
-
-      weight_sum -= shuffled_entries[-1].weight
-
+    else:
+      shuffled_entries.extend(_weighted_shuffle(priority_entries))
   return shuffled_entries
 
-def _get_addrs(zconn, zk_path):
-  data = zconn.get_data(zk_path)
+def _parse_addrs(data):
   addrs = ZknsAddrs()
   json_addrs = json.loads(data)
   for entry in json_addrs['entries']:
@@ -72,8 +78,10 @@ def _get_addrs(zconn, zk_path):
     addrs.entries.append(addr)
   return addrs
 
-# zkns_name: /zk/cell/vt/ns/path:_port - port is optional
-def lookup_name(zconn, zkns_name):
+def _get_addrs(zconn, zk_path):
+  return _parse_addrs(zconn.get_data(zk_path))
+
+def _split_zkns_name(zkns_name):
   if ':' in zkns_name:
     zk_path, port_name = zkns_name.split(':')
     if not port_name.startswith('_'):
@@ -81,23 +89,145 @@ def lookup_name(zconn, zkns_name):
   else:
     zk_path = zkns_name
     port_name = None
+  return zk_path, port_name
+
+def _get_srv_entries(addrs, zk_path, port_name):
+  srv_entries = []
+  for addr in addrs.entries:
+    if port_name:
+      try:
+        srv_entry = SrvEntry(addr.host, addr.named_port_map[port_name], 0, 0)
+      except KeyError:
+        raise ZknsError('no named port', zk_path, port_name)
+    else:
+      srv_entry = SrvEntry(addr.host, addr.port, 0, 0)
+    srv_entries.append(srv_entry)
+  return srv_entries
+
+# zkns_name: /zk/cell/vt/ns/path:_port - port is optional
+def lookup_name(zconn, zkns_name):
+  zk_path, port_name = _split_zkns_name(zkns_name)
 
   try:
     addrs = _get_addrs(zconn, zk_path)
-    srv_entries = []
-    for addr in addrs.entries:
-      if port_name:
-        try:
-          srv_entry = SrvEntry(addr.host, addr.named_port_map[port_name], 0, 0)
-        except KeyError:
-          raise ZknsError('no named port', zk_path, port_name)
-      else:
-        srv_entry = SrvEntry(addr.host, addr.port, 0, 0)
-      srv_entries.append(srv_entry)
-
+    srv_entries = _get_srv_entries(addrs, zk_path, port_name)
     shuffled_entries = _sorted_by_srv_priority(srv_entries)
     if not shuffled_entries:
       raise ZknsError('no addresses for zk path', zk_path, port_name)
     return shuffled_entries
   except Exception as e:
     raise ZknsError('no addresses for zk path', zk_path, e)
+
+
+class _SrvTable(object):
+  """SrvEntries of a zkns name, grouped by priority.
+
+  The first priority group keeps a cumulative weight table, so picking
+  one of its entries is a binary search.
+  """
+
+  def __init__(self, srv_entries):
+    self.priority_groups = _group_by_srv_priority(srv_entries)
+    first_entries = self.priority_groups[0][1]
+    # Entries all of weight 0 are picked uniformly.
+    if sum(entry.weight for entry in first_entries) > 0:
+      self.first_entries = [entry for entry in first_entries
+                            if entry.weight > 0]
+      weights = [entry.weight for entry in self.first_entries]
+    else:
+      self.first_entries = first_entries
+      weights = [1] * len(first_entries)
+    self.cumulative_weights = []
+    total = 0
+    for weight in weights:
+      total += weight
+      self.cumulative_weights.append(total)
+
+  def pick(self):
+    n = random.random() * self.cumulative_weights[-1]
+    return self.first_entries[
+        bisect.bisect_right(self.cumulative_weights, n)]
+
+  def shuffled_entries(self):
+    shuffled_entries = []
+    for priority, priority_entries in self.priority_groups:
+      if len(priority_entries) <= 1:
+        shuffled_entries.extend(priority_entries)
+      else:
+        shuffled_entries.extend(_weighted_shuffle(priority_entries))
+    return shuffled_entries
+
+
+# Seconds a zkns path is served from the ZknsResolver cache before
+# it is read again.
+ZKNS_REFRESH_INTERVAL = 30
+
+
+class ZknsResolver(object):
+  """Resolves zkns names from a cache of the parsed zk nodes.
+
+  A zk node is read again once it is older than refresh_interval, and
+  only re-parsed if its data changed. If that read fails, the cached
+  addresses keep being served.
+  """
+
+  def __init__(self, zconn, refresh_interval=ZKNS_REFRESH_INTERVAL):
+    self.zconn = zconn
+    self.refresh_interval = refresh_interval
+    # zk_path -> (data, ZknsAddrs, time of the read)
+    self._addrs = {}
+    # (zk_path, port_name) -> (ZknsAddrs, _SrvTable)
+    self._tables = {}
+    self._lock = threading.Lock()
+
+  def _read_addrs(self, zk_path):
+    data = self.zconn.get_data(zk_path)
+    with self._lock:
+      cached = self._addrs.get(zk_path)
+      if cached is not None and cached[0] == data:
+        addrs = cached[1]
+      else:
+        addrs = _parse_addrs(data)
+      self._addrs[zk_path] = (data, addrs, time.time())
+    return addrs
+
+  def _get_addrs(self, zk_path):
+    cached = self._addrs.get(zk_path)
+    if cached is None:
+      return self._read_addrs(zk_path)
+    if cached[2] + self.refresh_interval < time.time():
+      try:
+        return self._read_addrs(zk_path)
+      except Exception as e:
+        logging.warning('zkns: serving cached %s, refresh failed: %s',
+                        zk_path, e)
+    return cached[1]
+
+  def _get_table(self, zkns_name):
+    zk_path, port_name = _split_zkns_name(zkns_name)
+    try:
+      addrs = self._get_addrs(zk_path)
+      cached = self._tables.get((zk_path, port_name))
+      if cached is not None and cached[0] is addrs:
+        return cached[1]
+      srv_entries = _get_srv_entries(addrs, zk_path, port_name)
+      if not srv_entries:
+        raise ZknsError('no addresses for zk path', zk_path, port_name)
+      table = _SrvTable(srv_entries)
+      self._tables[(zk_path, port_name)] = (addrs, table)
+      return table
+    except Exception as e:
+      raise ZknsError('no addresses for zk path', zk_path, e)
+
+  def lookup_name(self, zkns_name):
+    """Same as lookup_name, from the cache."""
+    return self._get_table(zkns_name).shuffled_entries()
+
+  def pick_addr(self, zkns_name):
+    """Returns one SrvEntry of the best priority, picked by weight."""
+    return self._get_table(zkns_name).pick()
+
+  def invalidate(self, zkns_name):
+    zk_path, _ = _split_zkns_name(zkns_name)
+    with self._lock:
+      self._addrs.pop(zk_path, None)
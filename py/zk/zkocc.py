@@ -3,6 +3,7 @@ import logging
 import os
 import random
 import threading
+import time
 
 from net import bsonrpc
 from net import gorpc
@@ -10,6 +11,11 @@ from net import gorpc
 class ZkOccError(Exception):
   pass
 
+# The server answered with an error, for instance an unknown keyspace:
+# the connection is still good and the call shouldn't be retried.
+class ZkOccAppError(ZkOccError):
+  pass
+
 #
 # the ZkNode dict returned by these structures has the following members:
 #
@@ -53,6 +59,8 @@ class SimpleZkOccConnection(object):
                for k, v in kwargs.items())
     try:
       return self.client.call(method, req).reply
+    except gorpc.AppError as e:
+      raise ZkOccAppError('%s %s failed' % (method, req), e)
     except gorpc.GoRpcError as e:
       raise ZkOccError('%s %s failed' % (method, req), e)
 
@@ -81,12 +89,22 @@ class SimpleZkOccConnection(object):
 # A meta-connection that can connect to multiple alternate servers, and will
 # retry a couple times. Calling dial before get/getv/children is optional,
 # and will only do anything at all if authentication is enabled.
+#
+# Calls from different threads run concurrently: each call borrows a
+# SimpleZkOccConnection from a pool spread across the servers, and the
+# lock is only held to update the pool. A server whose call or dial failed
+# is tried last for backend_retry_delay seconds.
 class ZkOccConnection(object):
   max_attempts = 2
   max_dial_attempts = 10
+  # Maximum number of idle SimpleZkOccConnection kept in the pool.
+  pool_size = 4
+  # Seconds during which a failed server is only dialed as a last resort.
+  backend_retry_delay = 30
 
   # addrs is a comma separated list of server:ip pairs.
-  def __init__(self, addrs, local_cell, timeout, user=None, password=None):
+  def __init__(self, addrs, local_cell, timeout, user=None, password=None,
+               pool_size=None):
     self.timeout = timeout
     self.addrs = addrs.split(',')
     self.local_cell = local_cell
@@ -95,9 +113,18 @@ class ZkOccConnection(object):
       raise ValueError("You must provide either both or none of user and password.")
     self.user = user
     self.password = password
+    if pool_size is not None:
+      self.pool_size = pool_size
 
-    self.simple_conn = None
     self.lock = threading.Lock()
+    # idle connections, as (SimpleZkOccConnection, generation) tuples.
+    self._idle_conns = []
+    # close() bumps the generation, older connections are not reused.
+    self._generation = 0
+    # addr -> number of open connections to it.
+    self._conn_counts = {}
+    # addr -> time of its last failure.
+    self._backend_failures = {}
 
   def _resolve_path(self, zk_path):
     # Maps a 'meta-path' to a cell specific path.
@@ -114,49 +141,131 @@ class ZkOccConnection(object):
     return '/'.join(parts)
 
   # addrs is a comma separated list of server:ip pairs.
+  # Idle connections to removed servers, or in excess of a fair share of
+  # the pool for their server, are closed.
   def refresh_addrs(self, addrs):
-    self.addrs = addrs.split(',')
-    if self.simple_conn.client.addr not in self.addrs:
-      self.close()
-
-  def dial(self):
-    if self.simple_conn:
-      self.simple_conn.close()
-
-    addrs = random.sample(self.addrs, min(self.max_dial_attempts, len(self.addrs)))
+    with self.lock:
+      self.addrs = addrs.split(',')
+      for addr in self._backend_failures.keys():
+        if addr not in self.addrs:
+          del self._backend_failures[addr]
+      fair_share = -(-self.pool_size // len(self.addrs))
+      kept = []
+      closed = []
+      for conn, generation in self._idle_conns:
+        addr = conn.client.addr
+        if addr in self.addrs and self._conn_counts[addr] <= fair_share:
+          kept.append((conn, generation))
+        else:
+          self._conn_counts[addr] -= 1
+          closed.append(conn)
+      self._idle_conns = kept
+    for conn in closed:
+      conn.close()
+
+  # _dial_order returns the servers to dial, healthy ones first and
+  # the ones with the fewest connections first among those.
+  def _dial_order(self):
+    now = time.time()
+    healthy = []
+    failed = []
+    for addr in random.sample(self.addrs, len(self.addrs)):
+      failure_time = self._backend_failures.get(addr)
+      if failure_time is None or failure_time + self.backend_retry_delay < now:
+        healthy.append(addr)
+      else:
+        failed.append((failure_time, addr))
+    healthy.sort(key=lambda addr: self._conn_counts.get(addr, 0))
+    failed.sort()
+    addrs = healthy + [addr for _, addr in failed]
+    return addrs[:self.max_dial_attempts]
+
+  def _dial_conn(self):
+    with self.lock:
+      addrs = self._dial_order()
+      generation = self._generation
     for a in addrs:
-      self.simple_conn = SimpleZkOccConnection(a, self.timeout, self.user, self.password)
+      conn = SimpleZkOccConnection(a, self.timeout, self.user, self.password)
       try:
-        self.simple_conn.dial()
-        return
+        conn.dial()
       except:
-        pass
+        self._mark_failed(a)
+        continue
+      with self.lock:
+        self._conn_counts[a] = self._conn_counts.get(a, 0) + 1
+        self._backend_failures.pop(a, None)
+      return conn, generation
 
-    self.simple_conn = None
     raise ZkOccError("Cannot dial to any server, tried: %s" % addrs)
 
+  def _get_conn(self):
+    with self.lock:
+      if self._idle_conns:
+        return self._idle_conns.pop()
+    return self._dial_conn()
+
+  def _put_conn(self, conn, generation):
+    addr = conn.client.addr
+    with self.lock:
+      if (generation == self._generation and addr in self.addrs and
+          len(self._idle_conns) < self.pool_size):
+        self._idle_conns.append((conn, generation))
+        return
+      self._conn_counts[addr] -= 1
+    conn.close()
+
+  # _mark_failed records a failure of addr, and closes the idle
+  # connections to it.
+  def _mark_failed(self, addr):
+    with self.lock:
+      self._backend_failures[addr] = time.time()
+      closed = [conn for conn, _ in self._idle_conns
+                if conn.client.addr == addr]
+      self._idle_conns = [(conn, generation)
+                          for conn, generation in self._idle_conns
+                          if conn.client.addr != addr]
+      self._conn_counts[addr] = self._conn_counts.get(addr, 0) - len(closed)
+    for conn in closed:
+      conn.close()
+
+  def dial(self):
+    self.close()
+    conn, generation = self._dial_conn()
+    self._put_conn(conn, generation)
+
   def close(self):
-    if self.simple_conn:
-      self.simple_conn.close()
-      self.simple_conn = None
+    with self.lock:
+      self._generation += 1
+      closed = [conn for conn, _ in self._idle_conns]
+      self._idle_conns = []
+      for conn in closed:
+        self._conn_counts[conn.client.addr] -= 1
+    for conn in closed:
+      conn.close()
 
   def _call(self, client_method, *args, **kwargs):
-    with self.lock:
-      if not self.simple_conn:
-        self.dial()
-
-      attempt = 0
-      while True:
-        try:
-          return getattr(self.simple_conn, client_method)(*args, **kwargs)
-        except Exception as e:
-          attempt += 1
-          logging.warning('zkocc: %s command failed %u times: %s', client_method, attempt, e)
-          if attempt >= self.max_attempts:
-            raise ZkOccError('zkocc %s command failed %u times: %s' % (client_method, attempt, e))
-
-          # try the next server if there is one, or retry our only server
-          self.dial()
+    attempt = 0
+    while True:
+      conn, generation = self._get_conn()
+      try:
+        result = getattr(conn, client_method)(*args, **kwargs)
+      except ZkOccAppError:
+        self._put_conn(conn, generation)
+        raise
+      except Exception as e:
+        with self.lock:
+          self._conn_counts[conn.client.addr] -= 1
+        conn.close()
+        self._mark_failed(conn.client.addr)
+        attempt += 1
+        logging.warning('zkocc: %s command failed %u times: %s', client_method, attempt, e)
+        if attempt >= self.max_attempts:
+          raise ZkOccError('zkocc %s command failed %u times: %s' % (client_method, attempt, e))
+
+        # try the next server if there is one, or retry our only server
+        continue
+      self._put_conn(conn, generation)
+      return result
 
   # New API.
 
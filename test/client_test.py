@@ -24,9 +24,11 @@ from clientlib_tests import db_class_lookup
 
 from vtdb import database_context
 from vtdb import db_object
+from vtdb import db_object_lookup
 from vtdb import keyrange
 from vtdb import keyrange_constants
 from vtdb import keyspace
+from vtdb import lookup_cache
 from vtdb import dbexceptions
 from vtdb import shard_constants
 from vtdb import vtdb_logger
@@ -250,6 +252,48 @@ class TestUnshardedTable(unittest.TestCase):
       self.assertEqual(len(rows), 0, "wrong number of rows fetched")
     self.all_ids = self.all_ids[:-1]
 
+  def test_threaded_reads_and_writes(self):
+    errors = []
+
+    def read_and_update(id_val):
+      try:
+        with database_context.WriteTransaction(self.dc) as context:
+          db_class_unsharded.VtUnsharded.update_columns(
+              context.get_cursor(), [('id', id_val)],
+              update_column_value_pairs=[('msg', 'thread %d' % id_val)])
+        with database_context.ReadFromMaster(self.dc) as context:
+          rows = db_class_unsharded.VtUnsharded.select_by_id(
+              context.get_cursor(), id_val)
+          self.assertEqual(rows[0].msg, 'thread %d' % id_val)
+        self.assertFalse(self.dc.in_transaction)
+        self.assertEqual(self.dc.vtgate_connection, None)
+      except Exception as e:
+        errors.append(e)
+
+    threads = [threading.Thread(target=read_and_update, args=(id_val,))
+               for id_val in self.all_ids[:10]]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    self.assertEqual(errors, [])
+    self.assertTrue(len(self.dc.connection_pool._idle) <= 10)
+
+  def test_insert_many(self):
+    rows = [{'msg': 'bulk message %d' % x} for x in xrange(7)]
+    with database_context.WriteTransaction(self.dc) as context:
+      ret_ids = db_class_unsharded.VtUnsharded.insert_many(
+          context.get_cursor(), rows, max_rows_per_statement=3)
+    self.assertEqual(len(ret_ids), len(rows))
+    self.all_ids.extend(ret_ids)
+
+    with database_context.ReadFromMaster(self.dc) as context:
+      for ret_id, row in zip(ret_ids, rows):
+        fetched = db_class_unsharded.VtUnsharded.select_by_id(
+            context.get_cursor(), ret_id)
+        self.assertEqual(len(fetched), 1, "wrong number of rows fetched")
+        self.assertEqual(fetched[0].msg, row['msg'], "wrong row fetched")
+
   def test_count(self):
     with database_context.ReadFromMaster(self.dc) as context:
       count = db_class_unsharded.VtUnsharded.get_count(
@@ -361,6 +405,25 @@ class TestRangeSharded(unittest.TestCase):
           where_column_value_pairs)
       self.assertEqual(len(rows), len(self.user_song_map[user_id]), "wrong number of rows fetched")
 
+  def test_insert_many(self):
+    rows = [{'user_id': user_id, 'title': 'Bulk Song'}
+            for user_id in self.user_id_list]
+    with database_context.WriteTransaction(self.dc) as context:
+      song_ids = db_class_sharded.VtSong.insert_many(
+          context.get_cursor(), rows, max_rows_per_statement=4)
+    self.assertEqual(len(song_ids), len(rows))
+
+    with database_context.ReadFromMaster(self.dc) as context:
+      for song_id, row in zip(song_ids, rows):
+        where_column_value_pairs = [('id', song_id),]
+        entity_id_map = dict(where_column_value_pairs)
+        fetched = db_class_sharded.VtSong.select_by_columns(
+            context.get_cursor(entity_id_map=entity_id_map),
+            where_column_value_pairs)
+        self.assertEqual(len(fetched), 1, "wrong number of rows fetched")
+        self.assertEqual(fetched[0].user_id, row['user_id'],
+                         "wrong row fetched")
+
   def test_entity_id_read(self):
     user_id = self.user_id_list[0]
     with database_context.ReadFromMaster(self.dc) as context:
@@ -384,6 +447,67 @@ class TestRangeSharded(unittest.TestCase):
           where_column_value_pairs)
       self.assertEqual(len(rows), 1, "wrong number of rows fetched")
 
+  def test_entity_id_read_with_lookup_cache(self):
+    user_id = self.user_id_list[0]
+    cache = lookup_cache.LookupCache()
+    db_object_lookup.LookupDBObject.lookup_cache = cache
+    try:
+      entity_id_map = {'username': 'user0'}
+      # Master reads bypass the cache.
+      with database_context.ReadFromMaster(self.dc) as context:
+        db_class_sharded.VtUser.select_by_columns(
+            context.get_cursor(entity_id_map=entity_id_map),
+            [('id', user_id),])
+      self.assertEqual(cache.get_stats()['Entries'], 0)
+
+      timeout = 10
+      while True:
+        try:
+          with database_context.ReadFromReplica(self.dc) as context:
+            rows = db_class_sharded.VtUser.select_by_columns(
+                context.get_cursor(entity_id_map=entity_id_map),
+                [('id', user_id),])
+          break
+        except dbexceptions.DatabaseError:
+          timeout = utils.wait_step('lookup row on replica', timeout)
+      self.assertEqual(len(rows), 1, "wrong number of rows fetched")
+      self.assertEqual(cache.get_stats()['Entries'], 1)
+
+      hits = cache.get_stats()['Hits']
+      with database_context.ReadFromReplica(self.dc) as context:
+        rows = db_class_sharded.VtUser.select_by_columns(
+            context.get_cursor(entity_id_map=entity_id_map),
+            [('id', user_id),])
+      self.assertEqual(len(rows), 1, "wrong number of rows fetched")
+      self.assertEqual(cache.get_stats()['Hits'], hits + 1)
+
+      # Writing the lookup rows of the user invalidates its entry.
+      db_class_lookup.VtUsernameLookup.invalidate_lookup_cache(
+          [('user_id', user_id),])
+      self.assertEqual(cache.get_stats()['Entries'], 0)
+    finally:
+      db_object_lookup.LookupDBObject.lookup_cache = None
+
+  def test_entity_lookup_batch_read(self):
+    with database_context.ReadFromMaster(self.dc) as context:
+      context.add_entity_lookups(db_class_sharded.VtSongDetail, 'song_id',
+                                 self.song_id_list)
+      for song_id in self.song_id_list:
+        where_column_value_pairs = [('song_id', song_id),]
+        entity_id_map = dict(where_column_value_pairs)
+        rows = db_class_sharded.VtSongDetail.select_by_columns(
+            context.get_cursor(entity_id_map=entity_id_map),
+            where_column_value_pairs)
+        self.assertEqual(len(rows), 1, "wrong number of rows fetched")
+
+      where_column_value_pairs = (('song_id', self.song_id_list),)
+      entity_id_map = dict(where_column_value_pairs)
+      rows = db_class_sharded.VtSongDetail.select_by_ids(
+          context.get_cursor(entity_id_map=entity_id_map),
+          where_column_value_pairs)
+      self.assertEqual(len(rows), len(self.song_id_list),
+                       "wrong number of rows fetched")
+
   def test_in_clause_read(self):
     with database_context.ReadFromMaster(self.dc) as context:
       user_id_list = [self.user_id_list[0], self.user_id_list[1]]
@@ -591,6 +715,82 @@ class TestRangeSharded(unittest.TestCase):
       self.assertEqual(res_ids, user_id_list)
       self.assertEqual(res_user_ids, user_id_list)
 
+  def test_pipelined_batch_read(self):
+    user_id_list = self.user_id_list[:5]
+    entity_id_map = {'id': user_id_list}
+    with database_context.ReadFromMaster(self.dc) as context:
+      cursor = context.get_cursor(entity_id_map=entity_id_map)(db_class_sharded.VtUser)
+      batch_cursor = db_object.create_batch_cursor_from_cursor(
+          cursor, max_queries=2, pipelined=True)
+      for user_id in user_id_list:
+        q, bv = db_class_sharded.VtUser.create_select_query((('id', user_id),))
+        batch_cursor.execute(q, bv)
+      # Two batches were sent while queries were still being added.
+      self.assertEqual(len(batch_cursor.query_list), 1)
+      batch_cursor.flush()
+      self.assertEqual(len(batch_cursor.rowsets), len(user_id_list))
+      res_ids = [rowset[0][0][0] for rowset in batch_cursor.rowsets]
+      self.assertEqual(res_ids, user_id_list)
+
+  def test_parallel_reads(self):
+    user_id = self.user_id_list[0]
+    where_column_value_pairs = [('user_id', user_id),]
+    entity_id_map = dict(where_column_value_pairs)
+    operations = [
+        lambda context: db_class_sharded.VtUserEmail.select_by_columns(
+            context.get_cursor(entity_id_map=entity_id_map),
+            where_column_value_pairs),
+        lambda context: db_class_sharded.VtSong.select_by_columns(
+            context.get_cursor(entity_id_map=entity_id_map),
+            where_column_value_pairs),
+        lambda context: db_class_unsharded.VtUnsharded.get_count(
+            context.get_cursor(), msg="test message"),
+        lambda context: db_class_sharded.VtUser.select_by_columns(
+            context.get_cursor(entity_id_map={'id': user_id}),
+            [('no_such_column', 1),]),
+    ]
+    results = self.dc.execute_parallel_reads(operations, read_from_master=True)
+    self.assertEqual(len(results), len(operations))
+    self.assertEqual(len(results[0].result), 1)
+    self.assertEqual(len(results[1].result), len(self.user_song_map[user_id]))
+    self.assertEqual(results[2].error, None)
+    # The failed read doesn't affect the others.
+    self.assertEqual(results[3].result, None)
+    self.assertTrue(isinstance(results[3].error, dbexceptions.DatabaseError))
+
+  def test_write_behind_update(self):
+    user_ids = self.user_id_list[:3]
+    with database_context.WriteTransaction(self.dc,
+                                           write_behind=True) as context:
+      for user_id in user_ids:
+        where_column_value_pairs = [('user_id', user_id),]
+        entity_id_map = dict(where_column_value_pairs)
+        update_cols = [('email', 'behind%s@google.com' % user_id),]
+        rowcount = db_class_sharded.VtUserEmail.update_columns(
+            context.get_cursor(entity_id_map=entity_id_map),
+            where_column_value_pairs,
+            update_column_value_pairs=update_cols)
+        # The update is buffered, so its rowcount isn't known yet.
+        self.assertEqual(rowcount, None)
+
+      # Reads in the transaction see the buffered writes.
+      where_column_value_pairs = [('user_id', user_ids[0]),]
+      entity_id_map = dict(where_column_value_pairs)
+      rows = db_class_sharded.VtUserEmail.select_by_columns(
+          context.get_cursor(entity_id_map=entity_id_map),
+          where_column_value_pairs)
+      self.assertEqual(rows[0].email, 'behind%s@google.com' % user_ids[0])
+
+    with database_context.ReadFromMaster(self.dc) as context:
+      for user_id in user_ids:
+        where_column_value_pairs = [('user_id', user_id),]
+        entity_id_map = dict(where_column_value_pairs)
+        rows = db_class_sharded.VtUserEmail.select_by_columns(
+            context.get_cursor(entity_id_map=entity_id_map),
+            where_column_value_pairs)
+        self.assertEqual(len(rows), 1, "wrong number of rows fetched")
+        self.assertEqual(rows[0].email, 'behind%s@google.com' % user_id)
+
   def test_batch_write(self):
     # 1. Create DMLs using DB Classes.
     query_list = []
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+
+import unittest
+import utils
+
+from vtdb import dbapi
+from vtdb import dbexceptions
+
+
+class TestPrepareQueryBindVars(unittest.TestCase):
+
+  def setUp(self):
+    dbapi.clear_prepared_queries()
+
+  def test_prepare(self):
+    query = 'select * from t where a = %(a)s and b in %(b)s and c = %(a)s'
+    for i in xrange(2):
+      self.assertEqual(
+          dbapi.prepare_query_bind_vars(query, {'a': i, 'b': [1, 2], 'x': 3}),
+          ('select * from t where a = :a and b in ::b and c = :a',
+           {'a': i, 'b': [1, 2]}))
+    # The conversion depends on which variables are lists.
+    self.assertEqual(
+        dbapi.prepare_query_bind_vars(query, {'a': (1,), 'b': 2}),
+        ('select * from t where a = ::a and b in :b and c = ::a',
+         {'a': (1,), 'b': 2}))
+    self.assertEqual(len(dbapi._prepared_queries), 1)
+
+  def test_missing_bind_var(self):
+    query = 'select * from t where a = %(a)s and b = %(b)s'
+    dbapi.prepare_query_bind_vars(query, {'a': 1, 'b': 2})
+    self.assertRaises(dbexceptions.InterfaceError,
+                      dbapi.prepare_query_bind_vars, query, {'a': 1})
+
+  def test_eviction(self):
+    max_prepared_queries = dbapi.MAX_PREPARED_QUERIES
+    dbapi.MAX_PREPARED_QUERIES = 8
+    try:
+      for i in xrange(20):
+        dbapi.prepare_query_bind_vars('select %d, %%(a)s' % i, {'a': 1})
+        dbapi.prepare_query_bind_vars('select %(a)s', {'a': 1})
+      self.assertTrue(len(dbapi._prepared_queries) <= 8)
+      self.assertTrue('select %(a)s' in dbapi._prepared_queries)
+    finally:
+      dbapi.MAX_PREPARED_QUERIES = max_prepared_queries
+
+
+if __name__ == '__main__':
+  utils.main()
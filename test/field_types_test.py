@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+import datetime
+import decimal
+import logging
+import timeit
+import unittest
+import utils
+
+from vtdb import field_types
+from vtdb import times
+
+
+def reference_convert_bind_vars(bind_variables):
+  """The isinstance chain convert_bind_vars must stay identical to."""
+  new_vars = {}
+  if bind_variables is None:
+    return new_vars
+  for key, val in bind_variables.iteritems():
+    if hasattr(val, '__sql_literal__'):
+      new_vars[key] = val.__sql_literal__()
+    elif isinstance(val, datetime.datetime):
+      new_vars[key] = times.DateTimeToString(val)
+    elif isinstance(val, datetime.date):
+      new_vars[key] = times.DateToString(val)
+    elif isinstance(val, set):
+      new_vars[key] = sorted(val)
+    elif isinstance(val, tuple):
+      new_vars[key] = list(val)
+    elif isinstance(val, (int, long, float, str, list, field_types.NoneType)):
+      new_vars[key] = val
+    else:
+      new_vars[key] = str(val)
+  return new_vars
+
+
+class Literal(object):
+
+  def __sql_literal__(self):
+    return 'literal'
+
+
+class Plain(object):
+
+  def __str__(self):
+    return 'plain'
+
+
+class OldStyle:
+
+  def __str__(self):
+    return 'old style'
+
+
+class SubclassedInt(int):
+  pass
+
+
+class TestConvertBindVars(unittest.TestCase):
+
+  def test_same_as_reference(self):
+    with_instance_literal = Plain()
+    with_instance_literal.__sql_literal__ = lambda: 'instance literal'
+    old_style_literal = OldStyle()
+    old_style_literal.__sql_literal__ = lambda: 'old style literal'
+    values = [
+        1, 2L, 1.5, 'str', u'unicode', None, True,
+        [3, 1], field_types.List([1]), set([3, 1, 2]), (1, 2),
+        datetime.datetime(2015, 1, 2, 3, 4, 5), datetime.date(2015, 1, 2),
+        decimal.Decimal('1.5'), SubclassedInt(4), Literal(), Plain(),
+        with_instance_literal, OldStyle(), old_style_literal,
+    ]
+    # Twice, to also go through the cached converters.
+    for _ in xrange(2):
+      bind_vars = dict(('v%d' % i, v) for i, v in enumerate(values))
+      self.assertEqual(field_types.convert_bind_vars(bind_vars),
+                       reference_convert_bind_vars(bind_vars))
+      for key, val in bind_vars.iteritems():
+        self.assertEqual(field_types.convert_bind_vars({key: val}),
+                         reference_convert_bind_vars({key: val}))
+    self.assertEqual(field_types.convert_bind_vars(None), {})
+
+  def test_plain_values_are_copied(self):
+    bind_vars = {'a': 1, 'b': 'x'}
+    new_vars = field_types.convert_bind_vars(bind_vars)
+    self.assertEqual(new_vars, bind_vars)
+    self.assertFalse(new_vars is bind_vars)
+
+  def test_benchmark(self):
+    in_list_vars = dict(('id_%d' % i, i) for i in xrange(10000))
+    mixed_vars = dict(in_list_vars)
+    mixed_vars['ids'] = set(xrange(1000))
+    mixed_vars['created'] = datetime.datetime(2015, 1, 2)
+    mixed_vars['name'] = u'name'
+    for name, bind_vars in (('in_list', in_list_vars), ('mixed', mixed_vars)):
+      new = min(timeit.repeat(
+          lambda: field_types.convert_bind_vars(bind_vars), number=10,
+          repeat=3))
+      old = min(timeit.repeat(
+          lambda: reference_convert_bind_vars(bind_vars), number=10,
+          repeat=3))
+      logging.info('convert_bind_vars %s: %.2fms, isinstance chain: %.2fms',
+                   name, new * 100, old * 100)
+
+
+if __name__ == '__main__':
+  utils.main()
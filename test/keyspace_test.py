@@ -208,6 +208,17 @@ class TestKeyspace(unittest.TestCase):
     for keyspace_id in shard_kid_map[sn]:
       self.assertEqual(unsharded_ks.keyspace_id_to_shard_name_for_db_type(keyspace_id, 'master'), '0')
 
+  def test_keyspace_ids_to_shard_names(self):
+    sharded_ks = self._read_keyspace(SHARDED_KEYSPACE)
+    all_kids = shard_kid_map['-80'] + shard_kid_map['80-']
+    self.assertEqual(
+        sharded_ks.keyspace_ids_to_shard_names_for_db_type(all_kids, 'master'),
+        shard_kid_map)
+    unsharded_ks = self._read_keyspace(UNSHARDED_KEYSPACE)
+    self.assertEqual(
+        unsharded_ks.keyspace_ids_to_shard_names_for_db_type(all_kids, 'master'),
+        {'0': all_kids})
+
   def test_get_srv_keyspace_names(self):
     stdout, stderr = utils.run_vtctl(['GetSrvKeyspaceNames', 'test_nj'],
                                      trap_output=True)
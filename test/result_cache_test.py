@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Tests for result_cache and its use by the vtgate cursors."""
+
+import time
+import unittest
+import utils
+
+from vtdb import database_context
+from vtdb import result_cache
+from vtdb import vtgate_cursor
+
+
+class FakeVTGateConnection(object):
+  """Counts the queries and answers them with one row."""
+
+  def __init__(self):
+    self.executed = []
+    self.closed = False
+
+  def _execute(self, sql, bind_variables, keyspace, tablet_type,
+               keyspace_ids=None, keyranges=None, not_in_transaction=False):
+    self.executed.append((sql, tablet_type))
+    return [(len(self.executed),)], 1, 0, [('id', 8)]
+
+  def begin(self):
+    pass
+
+  def commit(self):
+    pass
+
+  def rollback(self):
+    pass
+
+  def is_closed(self):
+    return self.closed
+
+  def close(self):
+    self.closed = True
+
+
+class CachedTable(object):
+  result_cache_ttl = 60
+
+  @classmethod
+  def create_vtgate_cursor(class_, vtgate_conn, tablet_type, is_dml):
+    return vtgate_cursor.VTGateCursor(vtgate_conn, 'test_keyspace',
+                                      tablet_type, keyranges=[''],
+                                      writable=is_dml)
+
+
+class TestLRUResultCache(unittest.TestCase):
+
+  def test_hits_and_misses(self):
+    cache = result_cache.LRUResultCache()
+    self.assertEqual(cache.get('a'), None)
+    cache.set('a', 'value', 60)
+    self.assertEqual(cache.get('a'), 'value')
+    self.assertEqual(cache.get('a'), 'value')
+    stats = cache.get_stats()
+    self.assertEqual(stats['Hits'], 2)
+    self.assertEqual(stats['Misses'], 1)
+    self.assertEqual(stats['Entries'], 1)
+
+  def test_ttl_expiry(self):
+    cache = result_cache.LRUResultCache()
+    cache.set('a', 'value', 0.05)
+    self.assertEqual(cache.get('a'), 'value')
+    time.sleep(0.1)
+    self.assertEqual(cache.get('a'), None)
+    stats = cache.get_stats()
+    self.assertEqual(stats['Expirations'], 1)
+    self.assertEqual(stats['Entries'], 0)
+    self.assertEqual(stats['Size'], 0)
+
+  def test_lru_eviction(self):
+    cache = result_cache.LRUResultCache(max_entries=2)
+    cache.set('a', 'a', 60)
+    cache.set('b', 'b', 60)
+    # Reading 'a' makes 'b' the least recently used entry.
+    cache.get('a')
+    cache.set('c', 'c', 60)
+    self.assertEqual(cache.get('b'), None)
+    self.assertEqual(cache.get('a'), 'a')
+    self.assertEqual(cache.get('c'), 'c')
+    self.assertEqual(cache.evictions, 1)
+
+  def test_byte_bound_eviction(self):
+    value = 'x' * 1000
+    size = result_cache._estimate_size(value)
+    cache = result_cache.LRUResultCache(max_bytes=size * 3)
+    for key in xrange(5):
+      cache.set(key, value, 60)
+    self.assertEqual(cache.size, size * 3)
+    self.assertEqual(cache.evictions, 2)
+    self.assertEqual(cache.get(0), None)
+    self.assertEqual(cache.get(4), value)
+
+  def test_too_large_value_is_not_cached(self):
+    cache = result_cache.LRUResultCache(max_bytes=100)
+    cache.set('a', 'x' * 1000, 60)
+    self.assertEqual(cache.get('a'), None)
+    self.assertEqual(cache.size, 0)
+
+  def test_key_stability(self):
+    bind_vars1 = {'a': 1, 'b': [1, 2], 'c': {'x': 1, 'y': 2}}
+    bind_vars2 = {'c': {'y': 2, 'x': 1}, 'b': [1, 2], 'a': 1}
+    key1 = result_cache.make_key('ks', 'replica', ([1, 2], None), 'select',
+                                 bind_vars1)
+    key2 = result_cache.make_key('ks', 'replica', ([1, 2], None), 'select',
+                                 bind_vars2)
+    self.assertEqual(key1, key2)
+    self.assertNotEqual(
+        key1, result_cache.make_key('ks', 'replica', ([1, 2], None),
+                                    'select', {'a': 2}))
+    self.assertNotEqual(
+        key1, result_cache.make_key('ks', 'rdonly', ([1, 2], None),
+                                    'select', bind_vars1))
+
+
+class TestCachedCursors(unittest.TestCase):
+
+  def setUp(self):
+    self.conn = FakeVTGateConnection()
+    database_context.register_create_vtgate_connection_method(
+        lambda addrs, timeout: self.conn)
+    self.cache = result_cache.LRUResultCache()
+    self.dc = database_context.DatabaseContext(result_cache=self.cache)
+
+  def read(self, operation_class):
+    with operation_class(self.dc) as context:
+      cursor = context.get_cursor()(CachedTable)
+      cursor.execute('select id from t where a = %(a)s', {'a': 1})
+      return cursor.fetchall()
+
+  def test_replica_reads_are_cached(self):
+    rows = self.read(database_context.ReadFromReplica)
+    self.assertEqual(self.read(database_context.ReadFromReplica), rows)
+    self.assertEqual(len(self.conn.executed), 1)
+    self.assertEqual(self.cache.hits, 1)
+
+  def test_cached_result_is_not_shared(self):
+    with database_context.ReadFromReplica(self.dc) as context:
+      cursor = context.get_cursor()(CachedTable)
+      cursor.execute('select id from t where a = %(a)s', {'a': 1})
+      cursor.description.append(('extra', 8))
+      cursor.results.append((0,))
+      other_cursor = context.get_cursor()(CachedTable)
+      other_cursor.execute('select id from t where a = %(a)s', {'a': 1})
+    self.assertEqual(other_cursor.description, [('id', 8)])
+    self.assertEqual(other_cursor.results, [(1,)])
+    self.assertEqual(self.cache.hits, 1)
+
+  def test_master_reads_bypass_cache(self):
+    self.read(database_context.ReadFromMaster)
+    self.read(database_context.ReadFromMaster)
+    self.assertEqual(len(self.conn.executed), 2)
+    self.assertEqual(self.cache.get_stats()['Entries'], 0)
+
+  def test_write_transaction_bypasses_cache(self):
+    self.read(database_context.ReadFromReplica)
+    with database_context.WriteTransaction(self.dc) as context:
+      self.assertFalse(self.dc.use_result_cache(False, CachedTable))
+      cursor = context.get_cursor()(CachedTable)
+      self.assertEqual(cursor.result_cache, None)
+      cursor.execute('select id from t where a = %(a)s', {'a': 1})
+    self.assertEqual(len(self.conn.executed), 2)
+    self.assertEqual(self.cache.hits, 0)
+
+  def test_writable_cursor_bypasses_cache(self):
+    with database_context.ReadFromReplica(self.dc):
+      cursor = self.dc.create_cursor(True, CachedTable)
+      self.assertEqual(cursor.result_cache, None)
+      cursor.execute('select id from t where a = %(a)s', {'a': 1})
+      cursor.execute('select id from t where a = %(a)s', {'a': 1})
+    self.assertEqual(len(self.conn.executed), 2)
+    self.assertEqual(self.cache.get_stats()['Entries'], 0)
+
+  def test_write_queries_bypass_cache(self):
+    cursor = vtgate_cursor.VTGateCursor(self.conn, 'test_keyspace',
+                                        'replica', keyranges=[''],
+                                        writable=True)
+    cursor.result_cache = self.cache
+    cursor.result_cache_ttl = 60
+    cursor.execute('update t set a = 1', {})
+    cursor.execute('update t set a = 1', {})
+    self.assertEqual(len(self.conn.executed), 2)
+    self.assertEqual(self.cache.get_stats()['Entries'], 0)
+
+
+if __name__ == '__main__':
+  utils.main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+import unittest
+import utils
+
+from vtdb import sql_builder
+
+
+class TestQueryTemplates(unittest.TestCase):
+
+  def setUp(self):
+    sql_builder.clear_query_templates()
+
+  def test_select_template(self):
+    where = [('id', 5), ('name', ['a', 'b'])]
+    query, bind_vars = sql_builder.select_by_columns_query(
+        ['id', 'name'], 'vt_user', where, order_by='id', limit=10)
+    self.assertEqual(
+        query, 'SELECT id, name FROM vt_user WHERE id = %(id_1)s AND '
+        'name IN (%(name_2)s,%(name_3)s) ORDER BY id LIMIT %(limit_row_count)s')
+    self.assertEqual(bind_vars, {'id_1': 5, 'name_2': 'a', 'name_3': 'b',
+                                 'limit_row_count': 10})
+    self.assertEqual(len(sql_builder._query_templates), 1)
+
+    # Same shape, different values: the cached text is reused.
+    cached_query, bind_vars = sql_builder.select_by_columns_query(
+        ['id', 'name'], 'vt_user', [('id', 6), ('name', ['c', 'd'])],
+        order_by='id', limit=20)
+    self.assertTrue(cached_query is query)
+    self.assertEqual(bind_vars, {'id_1': 6, 'name_2': 'c', 'name_3': 'd',
+                                 'limit_row_count': 20})
+
+    # A different IN-list length is a different shape.
+    query, bind_vars = sql_builder.select_by_columns_query(
+        ['id', 'name'], 'vt_user', [('id', 6), ('name', ['c'])],
+        order_by='id', limit=20)
+    self.assertEqual(
+        query, 'SELECT id, name FROM vt_user WHERE id = %(id_1)s AND '
+        'name IN (%(name_2)s) ORDER BY id LIMIT %(limit_row_count)s')
+    self.assertEqual(len(sql_builder._query_templates), 2)
+
+  def test_operators_are_not_cached(self):
+    where = [('id', sql_builder.GreaterThanValue(5))]
+    query, bind_vars = sql_builder.select_by_columns_query(
+        ['id'], 'vt_user', where)
+    self.assertEqual(sql_builder._query_templates, {})
+    self.assertEqual(bind_vars.values(), [5])
+
+  def test_update_and_delete_templates(self):
+    for value in (1, 2):
+      query, bind_vars = sql_builder.update_columns_query(
+          'vt_user', [('id', value)], [('name', 'x%d' % value)])
+      self.assertEqual(
+          query, 'UPDATE vt_user SET name = %(update_set_0)s '
+          'WHERE id = %(id_1)s ')
+      self.assertEqual(bind_vars, {'update_set_0': 'x%d' % value,
+                                   'id_1': value})
+      query, bind_vars = sql_builder.delete_by_columns_query(
+          'vt_user', [('id', value)], limit=1)
+      self.assertEqual(
+          query, 'DELETE FROM vt_user WHERE id = %(id_1)s '
+          'LIMIT %(limit_row_count)s')
+      self.assertEqual(bind_vars, {'id_1': value, 'limit_row_count': 1})
+    self.assertEqual(len(sql_builder._query_templates), 2)
+
+  def test_insert_template(self):
+    for value in (1, 2):
+      query, bind_vars = sql_builder.insert_query(
+          'vt_user', ['id', 'name', 'msg'], id=value, name='x')
+      self.assertEqual(
+          query, 'INSERT INTO vt_user (id, name) VALUES (%(id)s, %(name)s)')
+      self.assertEqual(bind_vars, {'id': value, 'name': 'x'})
+    self.assertEqual(len(sql_builder._query_templates), 1)
+
+  def test_insert_many_template(self):
+    for value in (1, 2):
+      query, bind_vars = sql_builder.insert_many_query(
+          'vt_user', ['id', 'name', 'msg'],
+          [{'id': value, 'name': 'x'}, {'id': value + 10, 'name': 'y'}])
+      self.assertEqual(
+          query, 'INSERT INTO vt_user (id, name) VALUES '
+          '(%(id_0)s, %(name_0)s), (%(id_1)s, %(name_1)s)')
+      self.assertEqual(bind_vars, {'id_0': value, 'name_0': 'x',
+                                   'id_1': value + 10, 'name_1': 'y'})
+    self.assertEqual(len(sql_builder._query_templates), 1)
+
+    self.assertRaises(ValueError, sql_builder.insert_many_query,
+                      'vt_user', ['id', 'name'], [{'id': 1}, {'name': 'y'}])
+
+
+if __name__ == '__main__':
+  utils.main()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Tests for the endpoint cache of topo_utils."""
+
+import threading
+import time
+import unittest
+import utils
+
+from vtdb import dbexceptions
+from vtdb import keyspace
+from vtdb import topo_utils
+from vtdb import topology
+from vtdb import vtclient
+
+
+ADDRS = ['tablet1:15001', 'tablet2:15001', 'tablet3:15001']
+
+
+class FakeTopoClient(object):
+  """Serves ADDRS as the endpoints of every shard."""
+
+  def __init__(self, delay=0, fail=False):
+    self.delay = delay
+    self.fail = fail
+    self.calls = []
+
+  def get_end_points(self, cell, keyspace_name, shard, db_type):
+    self.calls.append((keyspace_name, shard, db_type))
+    time.sleep(self.delay)
+    if self.fail:
+      raise Exception('topo server unavailable')
+    entries = []
+    for addr in ADDRS:
+      host, port = addr.split(':')
+      entries.append({'Host': host, 'NamedPortMap': {'vt': int(port)}})
+    return {'Entries': entries}
+
+
+class FakeTopologyCache(object):
+  """Keyspaces of the tests, test_keyspace being served from source."""
+
+  def get_keyspace(self, name):
+    if name == 'test_keyspace':
+      return keyspace.Keyspace(name, {'ServedFrom': {'replica': 'source'}})
+    return keyspace.Keyspace(name, {})
+
+  def request_refresh(self):
+    pass
+
+
+class FailingTabletConnection(object):
+
+  def __init__(self, addr, tablet_type, keyspace, shard, timeout, user=None,
+               password=None, encrypted=False, keyfile=None, certfile=None):
+    self.addr = addr
+
+  def dial(self):
+    raise dbexceptions.OperationalError('cannot dial', self.addr)
+
+  def close(self):
+    pass
+
+
+def get_addrs(topo_client, keyspace_name='other_keyspace', shard='0',
+              db_type='replica'):
+  return [params['addr'] for params in topo_utils.get_db_params_for_tablet_conn(
+      topo_client, keyspace_name, shard, db_type, 10.0, False, None, None)]
+
+
+class TestEndPointsCache(unittest.TestCase):
+
+  def setUp(self):
+    topology.set_topology_cache(FakeTopologyCache())
+    topo_utils.set_end_points_cache_ttl(0.2, 0.1)
+    for keyspace_name in ('other_keyspace', 'source', 'test_keyspace'):
+      topo_utils.invalidate_end_points(keyspace_name, '0', 'replica')
+    for addr in ADDRS:
+      topo_utils.mark_end_point_healthy(addr)
+
+  def tearDown(self):
+    topology.set_topology_cache(None)
+    topo_utils.set_end_points_cache_ttl(5, 1)
+
+  def test_end_points_are_cached(self):
+    topo_client = FakeTopoClient()
+    self.assertEqual(sorted(get_addrs(topo_client)), ADDRS)
+    self.assertEqual(sorted(get_addrs(topo_client)), ADDRS)
+    self.assertEqual(len(topo_client.calls), 1)
+    time.sleep(0.3)
+    get_addrs(topo_client)
+    self.assertEqual(len(topo_client.calls), 2)
+
+  def test_failed_reads_are_cached_for_negative_ttl(self):
+    topo_client = FakeTopoClient(fail=True)
+    self.assertEqual(get_addrs(topo_client), [])
+    self.assertEqual(get_addrs(topo_client), [])
+    self.assertEqual(len(topo_client.calls), 1)
+    time.sleep(0.15)
+    topo_client.fail = False
+    self.assertEqual(sorted(get_addrs(topo_client)), ADDRS)
+    self.assertEqual(len(topo_client.calls), 2)
+
+  def test_concurrent_reads_are_shared(self):
+    topo_client = FakeTopoClient(delay=0.1)
+    results = []
+    threads = [threading.Thread(
+        target=lambda: results.append(sorted(get_addrs(topo_client))))
+               for _ in xrange(5)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(results, [ADDRS] * 5)
+    self.assertEqual(len(topo_client.calls), 1)
+
+  def test_failed_end_points_are_last(self):
+    topo_client = FakeTopoClient()
+    topo_utils.mark_end_point_failed(ADDRS[2])
+    time.sleep(0.01)
+    topo_utils.mark_end_point_failed(ADDRS[0])
+    for _ in xrange(10):
+      # Oldest failure first, after the healthy endpoint.
+      self.assertEqual(get_addrs(topo_client),
+                       [ADDRS[1], ADDRS[2], ADDRS[0]])
+    topo_utils.mark_end_point_healthy(ADDRS[0])
+    self.assertEqual(get_addrs(topo_client)[-1], ADDRS[2])
+
+  def test_served_from_keyspace_is_invalidated(self):
+    topo_client = FakeTopoClient()
+    get_addrs(topo_client, keyspace_name='test_keyspace')
+    self.assertEqual(topo_client.calls, [('source', '0', 'replica')])
+
+    saved_tablet_connection = vtclient.tablet.TabletConnection
+    vtclient.tablet.TabletConnection = FailingTabletConnection
+    try:
+      conn = vtclient.VtOCCConnection(topo_client, 'test_keyspace', '0',
+                                      'replica', 10.0)
+      with self.assertRaises(dbexceptions.OperationalError):
+        conn.connect()
+    finally:
+      vtclient.tablet.TabletConnection = saved_tablet_connection
+    # No endpoint could be dialed, so they are read again.
+    get_addrs(topo_client, keyspace_name='test_keyspace')
+    self.assertEqual(len(topo_client.calls), 2)
+
+
+if __name__ == '__main__':
+  utils.main()
@@ -344,6 +344,70 @@ class TestUpdateStream(unittest.TestCase):
       expected_id += 1
       data = master_conn.stream_next()
 
+  def test_stream_batches(self):
+    start_position = _get_master_current_position()
+    self._exec_vt_txn(self._populate_vt_a(15))
+    self._exec_vt_txn(['delete from vt_a'])
+    checkpoint_path = os.path.join(environment.tmproot, 'update_stream.ckpt')
+    consumer = update_stream_service.UpdateStreamConsumer(
+        master_host, 30, position=start_position,
+        checkpoint_path=checkpoint_path, batch_size=10,
+        position_append=mysql_flavor().position_append)
+    dml_count = 0
+    pos_count = 0
+    for batch in consumer.stream_batches():
+      self.assertTrue(len(batch) <= 10)
+      for event in batch:
+        if event.Category == 'DML':
+          dml_count += len(event.PkRows)
+        elif event.Category == 'POS':
+          pos_count += 1
+      if pos_count == 2:
+        break
+    self.assertEqual(dml_count, 30)
+    consumer.commit()
+    consumer.close()
+    self.assertTrue(mysql_flavor().position_after(
+        update_stream_service.read_checkpoint(checkpoint_path),
+        start_position))
+
+  def test_multi_shard_stream(self):
+    start_position = _get_master_current_position()
+    self._exec_vt_txn(self._populate_vt_a(5))
+    stream = update_stream_service.MultiShardUpdateStream(
+        self.vtgate_client, 'test_keyspace', 30,
+        positions={'0': start_position},
+        position_append=mysql_flavor().position_append)
+    dml_count = 0
+    try:
+      for shard, event in stream.events():
+        self.assertEqual(shard, '0')
+        if event.Category == 'DML':
+          dml_count += len(event.PkRows)
+        elif event.Category == 'POS':
+          break
+    finally:
+      stream.close()
+    self.assertEqual(dml_count, 5)
+
+  def test_stream_tables(self):
+    start_position = _get_master_current_position()
+    self._exec_vt_txn(self._populate_vt_insert_test)
+    self._exec_vt_txn(self._populate_vt_a(5))
+    master_conn = self._get_master_stream_conn()
+    master_conn.dial()
+    try:
+      # The vt_insert_test transaction is filtered out by the tablet.
+      for transaction in master_conn.stream_tables(start_position, ['vt_a']):
+        dmls = [statement.sql for statement in transaction.statements
+                if statement.category == update_stream_service.BL_DML]
+        self.assertEqual(len(dmls), 5)
+        for sql in dmls:
+          self.assertTrue('vt_a' in sql, sql)
+        break
+    finally:
+      master_conn.close()
+
   def test_database_filter(self):
     start_position = _get_master_current_position()
     master_tablet.mquery('other_database', _create_vt_insert_test)
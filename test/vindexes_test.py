@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+import struct
+import unittest
+import utils
+
+from vtdb import vhash
+from vtdb import vindexes
+
+pack_kid = struct.Struct('!Q').pack
+
+# Keyspace ids computed by go/vt/vtgate/vindexes/hash.go.
+hash_vectors = {
+    1: '166b40b44aba4bd6',
+    2: '06e7ea22ce92708f',
+    3: '4eb190c9a2fa169c',
+    4: 'd2fd8867d50d2dfe',
+    5: '70bb023c810ca87a',
+    6: 'f098480ac4c4be71',
+}
+
+
+class FakeLookupCursor(object):
+  """Answers IN queries on a lookup table from a list of rows."""
+
+  def __init__(self, rows):
+    self.rows = rows
+    self.queries = []
+    self.results = []
+
+  def execute(self, sql, bind_variables):
+    self.queries.append((sql, bind_variables))
+    values = set(bind_variables.values())
+    self.results = [row for row in self.rows if row[0] in values]
+
+  def fetchall(self):
+    return self.results
+
+
+class TestVindexes(unittest.TestCase):
+
+  def test_hash_matches_go(self):
+    ids = sorted(hash_vectors)
+    ksids = vindexes.Hash().map(None, ids)
+    self.assertEqual([ksid.encode('hex') for ksid in ksids],
+                     [hash_vectors[i] for i in ids])
+
+  def test_hash_round_trip(self):
+    ids = [0, -1, 1 << 62, -(1 << 63), (1 << 63) - 1] + range(1000)
+    ksids = vindexes.Hash().map(None, ids)
+    self.assertEqual(vhash.vunhash_many(ksids), ids)
+    self.assertTrue(vindexes.Hash().verify(None, 1000, vhash.vhash(1000)))
+    self.assertEqual(vindexes.Hash().reverse_map(None, vhash.vhash(-5)), -5)
+
+  def test_pure_python_hash(self):
+    ids = range(-50, 50)
+    cvhash = vhash.cvhash
+    vhash.cvhash = None
+    try:
+      ksids = vhash.vhash_many(ids)
+    finally:
+      vhash.cvhash = cvhash
+    self.assertEqual(ksids, vhash.vhash_many(ids))
+    self.assertEqual(ksids[51].encode('hex'), hash_vectors[1])
+
+  def test_hash_rejects_non_int(self):
+    self.assertRaises(ValueError, vindexes.Hash().map, None, ['1'])
+    self.assertRaises(ValueError, vhash.vunhash, 'short')
+
+  def test_numeric(self):
+    numeric = vindexes.Numeric()
+    self.assertEqual(numeric.map(None, [1, 2, -1]),
+                     [pack_kid(1), pack_kid(2), pack_kid((1 << 64) - 1)])
+    self.assertEqual(numeric.reverse_map(None, pack_kid(42)), 42)
+
+  def test_lookup_hash(self):
+    cursor = FakeLookupCursor([(10, 1), (10, 2), (11, 3)])
+    lookup = vindexes.LookupHash('user_idx', 'name', 'user_id')
+    ksids = lookup.map(cursor, [10, 11, 12])
+    self.assertEqual(len(cursor.queries), 1)
+    self.assertEqual(ksids, [[vhash.vhash(1), vhash.vhash(2)],
+                             [vhash.vhash(3)],
+                             []])
+
+  def test_lookup_hash_unique(self):
+    cursor = FakeLookupCursor([(10, 1), (11, 3)])
+    lookup = vindexes.LookupHashUnique('user_idx', 'name', 'user_id')
+    self.assertEqual(lookup.map(cursor, [11, 12, 10]),
+                     [vhash.vhash(3), '', vhash.vhash(1)])
+    self.assertEqual(len(cursor.queries), 1)
+    cursor.rows.append((10, 2))
+    self.assertRaises(ValueError, lookup.map, cursor, [10])
+
+
+if __name__ == '__main__':
+  utils.main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Tests for the tablet connection pools of vtclient."""
+
+import unittest
+import utils
+
+from vtdb import dbexceptions
+from vtdb import topo_utils
+from vtdb import vtclient
+
+
+ADDRS = ['tablet1:15001', 'tablet2:15001', 'tablet3:15001']
+
+
+class FakeTabletConnection(object):
+  dialed = []
+  executed = []
+  unreachable = set()
+
+  def __init__(self, addr, tablet_type, keyspace, shard, timeout, user=None,
+               password=None, encrypted=False, keyfile=None, certfile=None):
+    self.addr = addr
+
+  def dial(self):
+    if self.addr in self.unreachable:
+      raise dbexceptions.OperationalError('cannot dial', self.addr)
+    self.dialed.append(self.addr)
+
+  def close(self):
+    pass
+
+  def _execute(self, sql, bind_variables):
+    self.executed.append(self.addr)
+    return [], 0, 0, []
+
+
+def fake_connection_params_list(topo_client, keyspace, shard, db_type,
+                                timeout, encrypted, user, password):
+  return [dict(addr=addr, tablet_type=db_type, keyspace=keyspace,
+               shard=shard, timeout=timeout, encrypted=encrypted, user=user,
+               password=password) for addr in ADDRS]
+
+
+class TestShardConnectionPool(unittest.TestCase):
+  def setUp(self):
+    self.saved = (vtclient.get_vt_connection_params_list,
+                  vtclient.tablet.TabletConnection)
+    vtclient.get_vt_connection_params_list = fake_connection_params_list
+    vtclient.tablet.TabletConnection = FakeTabletConnection
+    FakeTabletConnection.dialed = []
+    FakeTabletConnection.executed = []
+    FakeTabletConnection.unreachable = set()
+    for addr in ADDRS:
+      topo_utils.mark_end_point_healthy(addr)
+    self.conn = vtclient.MultiShardVtOCCConnection(
+        None, 'test_keyspace', 'replica', 10.0, pool_size=4)
+
+  def tearDown(self):
+    self.conn.close()
+    (vtclient.get_vt_connection_params_list,
+     vtclient.tablet.TabletConnection) = self.saved
+
+  def test_serial_queries_spread_over_tablets(self):
+    for _ in xrange(6):
+      self.conn._execute('0', 'select 1 from dual', {})
+    self.assertEqual(FakeTabletConnection.executed, ADDRS + ADDRS)
+    # One connection per tablet is kept and reused.
+    self.assertEqual(sorted(FakeTabletConnection.dialed), ADDRS)
+
+  def test_unreachable_tablet_is_skipped(self):
+    FakeTabletConnection.unreachable.add(ADDRS[0])
+    for _ in xrange(4):
+      self.conn._execute('0', 'select 1 from dual', {})
+    self.assertTrue(topo_utils.is_end_point_failed(ADDRS[0]))
+    self.assertEqual(sorted(set(FakeTabletConnection.executed)), ADDRS[1:])
+
+  def test_idle_connections_are_bounded(self):
+    pool = self.conn._get_pool('0')
+    conns = [pool.get() for _ in xrange(6)]
+    for conn in conns:
+      pool.put(conn)
+    self.assertEqual(pool.idle_count, 4)
+    self.assertEqual(
+        sum(len(conn_list) for conn_list in pool.idle_conns.itervalues()), 4)
+
+
+if __name__ == '__main__':
+  utils.main()
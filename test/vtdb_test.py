@@ -266,6 +266,22 @@ class TestTabletFunctions(unittest.TestCase):
       self.fail("Write failed with error %s %s" % (str(e),
                                                    traceback.print_exc()))
 
+  def test_multi_shard_connection(self):
+    do_write(10)
+    vtgate_client = zkocc.ZkOccConnection(utils.vtgate.addr(), "test_nj", 30.0)
+    conn = vtclient.MultiShardVtOCCConnection(vtgate_client, 'test_keyspace',
+                                              'master', 10.0)
+    try:
+      shard_results = conn.execute_on_shards(
+          "select count(*) from vt_insert_test", {})
+      self.assertEqual(sorted(shard_results), sorted(shard_names))
+      for shard_result in shard_results.itervalues():
+        self.assertEqual(shard_result.error, None)
+      self.assertEqual(
+          shard_results[shard_names[0]].result[0], [(10,)])
+    finally:
+      conn.close()
+
   def test_batch_write(self):
     try:
       master_conn = get_connection(db_type='master', shard_index=self.shard_index)
@@ -723,6 +739,57 @@ class TestTopoReResolve(unittest.TestCase):
     self.assertEqual(after_tablet_conn_error - before_topo_rtt, 1, "One additional round-trips to topo server")
     self.replica_tablet.start_vttablet()
 
+  def test_parallel_read_topology(self):
+    expected = topology.read_topology(self.vtgate_client)
+    topo_clients = [zkocc.ZkOccConnection(utils.vtgate.addr(), "test_nj", 30.0)
+                    for _ in xrange(3)]
+    try:
+      self.assertEqual(
+          topology.read_topology(self.vtgate_client, topo_clients=topo_clients),
+          expected)
+    finally:
+      for topo_client in topo_clients:
+        topo_client.close()
+
+  def test_topology_snapshot(self):
+    snapshot_path = os.path.join(environment.tmproot, 'topology_snapshot')
+    snapshot_client = topology.TopologySnapshotClient(self.vtgate_client,
+                                                      snapshot_path)
+    expected = topology.read_topology(snapshot_client)
+    snapshot_client.save()
+
+    # A zkocc client that can't dial is served from the snapshot.
+    dead_client = zkocc.ZkOccConnection('localhost:1', "test_nj", 1.0)
+    snapshot_client = topology.TopologySnapshotClient(dead_client,
+                                                      snapshot_path)
+    self.assertNotEqual(snapshot_client.snapshot_time, None)
+    self.assertEqual(topology.read_topology(snapshot_client), expected)
+
+  def test_topology_cache(self):
+    topology_cache = topology.TopologyCache(self.vtgate_client, cell='test_nj',
+                                            min_refresh_interval=0.1)
+    self.assertTrue(topology_cache.refresh())
+    snapshot = topology_cache.get_snapshot()
+    self.assertEqual(snapshot.version, 1)
+    self.assertTrue('test_keyspace' in snapshot.keyspaces)
+
+    # Unchanged data keeps the snapshot.
+    self.assertFalse(topology_cache.refresh())
+    self.assertTrue(topology_cache.get_snapshot() is snapshot)
+    self.assertEqual(topology_cache.get_stats()['Refreshes'], 2)
+
+    # With a cache, refresh_keyspace doesn't go to the topo server.
+    topology.set_topology_cache(topology_cache)
+    try:
+      self.assertTrue(topology.get_keyspace('test_keyspace') is
+                      snapshot.keyspaces['test_keyspace'])
+      before_topo_rtt = vtdb_logger.get_logger().get_topo_rtt()
+      time.sleep(self.keyspace_fetch_throttle)
+      topology.refresh_keyspace(self.vtgate_client, 'test_keyspace')
+      self.assertEqual(vtdb_logger.get_logger().get_topo_rtt(), before_topo_rtt)
+    finally:
+      topology.set_topology_cache(None)
+
 
 if __name__ == '__main__':
   utils.main()
@@ -3,11 +3,13 @@
 
 """Tests for vtgate_utils."""
 
+import threading
 import unittest
 import time
 import utils
 import exceptions
 
+from vtdb import dbexceptions
 from vtdb import vtgate_utils
 from vtdb import vtgatev2
 
@@ -39,6 +41,10 @@ class FakeVtGateConnection(vtgatev2.VTGateConnection):
       raise exc_to_raise
 
 class TestVtgateUtils(unittest.TestCase):
+  def setUp(self):
+    vtgate_utils.configure_retry_budget()
+    vtgate_utils.configure_circuit_breaker()
+
   def test_retry_exception(self):
     fake_conn = FakeVtGateConnection()
     with self.assertRaises(SomeException):
@@ -75,6 +81,106 @@ class TestVtgateUtils(unittest.TestCase):
     fake_conn.method(None)
     self.assertEquals(len(fake_conn.invoked_intervals), 1)
 
+  def test_no_retries_when_budget_exhausted(self):
+    vtgate_utils.configure_retry_budget(ratio=0.0, max_tokens=2)
+    fake_conn = FakeVtGateConnection()
+    with self.assertRaises(SomeException):
+      fake_conn.method(SomeException("an exception"))
+    self.assertEquals(len(fake_conn.invoked_intervals), 3)
+    fake_conn.invoked_intervals = []
+    with self.assertRaises(SomeException):
+      fake_conn.method(SomeException("an exception"))
+    self.assertEquals(len(fake_conn.invoked_intervals), 1)
+
+  def test_retry_budget_is_per_keyspace(self):
+    vtgate_utils.configure_retry_budget(ratio=0.0, max_tokens=1)
+    vtgate_utils.get_process_retry_budget().max_tokens = 10
+    vtgate_utils.get_process_retry_budget().tokens = 10
+    fake_conn = FakeVtGateConnection()
+    with self.assertRaises(SomeException):
+      fake_conn.method(SomeException("an exception"))
+    self.assertEquals(len(fake_conn.invoked_intervals), 2)
+    other_conn = FakeVtGateConnection()
+    other_conn.keyspace = "other_keyspace"
+    with self.assertRaises(SomeException):
+      other_conn.method(SomeException("an exception"))
+    self.assertEquals(len(other_conn.invoked_intervals), 2)
+
+  def test_circuit_breaker_fails_fast(self):
+    vtgate_utils.configure_circuit_breaker(failure_threshold=2,
+                                           reset_timeout_ms=50)
+    fake_conn = FakeVtGateConnection()
+    for _ in xrange(2):
+      with self.assertRaises(SomeException):
+        fake_conn.method(SomeException("an exception"))
+    fake_conn.invoked_intervals = []
+    with self.assertRaises(dbexceptions.RequestBacklog):
+      fake_conn.method(None)
+    self.assertEquals(len(fake_conn.invoked_intervals), 0)
+
+    # After the reset timeout a probe goes through and closes the breaker.
+    time.sleep(0.1)
+    fake_conn.method(None)
+    fake_conn.method(None)
+    self.assertEquals(len(fake_conn.invoked_intervals), 2)
+
+  def test_circuit_breaker_ignores_non_retryable_errors(self):
+    vtgate_utils.configure_circuit_breaker(failure_threshold=2,
+                                           reset_timeout_ms=50)
+    fake_conn = FakeVtGateConnection()
+    with self.assertRaises(SomeException):
+      fake_conn.method(SomeException("an exception"))
+    with self.assertRaises(dbexceptions.IntegrityError):
+      fake_conn.method(dbexceptions.IntegrityError("duplicate key"))
+    breaker = vtgate_utils.get_circuit_breaker()
+    self.assertEquals(breaker.failure_count, 1)
+    self.assertEquals(breaker.state, vtgate_utils.CircuitBreaker.CLOSED)
+
+  def test_circuit_breaker_failed_probe_reopens(self):
+    vtgate_utils.configure_circuit_breaker(failure_threshold=1,
+                                           reset_timeout_ms=50)
+    fake_conn = FakeVtGateConnection()
+    with self.assertRaises(SomeException):
+      fake_conn.method(SomeException("an exception"))
+    time.sleep(0.1)
+    with self.assertRaises(dbexceptions.IntegrityError):
+      fake_conn.method(dbexceptions.IntegrityError("duplicate key"))
+    breaker = vtgate_utils.get_circuit_breaker()
+    self.assertEquals(breaker.state, vtgate_utils.CircuitBreaker.OPEN)
+
+    # The probe slot was released: the next probe comes after the reset
+    # timeout.
+    with self.assertRaises(dbexceptions.RequestBacklog):
+      fake_conn.method(None)
+    time.sleep(0.1)
+    fake_conn.method(None)
+    self.assertEquals(breaker.state, vtgate_utils.CircuitBreaker.CLOSED)
+
+  def test_single_flight_shares_in_flight_call(self):
+    group = vtgate_utils.SingleFlight()
+    calls = []
+    results = []
+
+    def slow_call():
+      calls.append(1)
+      time.sleep(0.1)
+      return 'result'
+
+    def worker():
+      results.append(group.do('key', slow_call))
+
+    threads = [threading.Thread(target=worker) for _ in xrange(5)]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    self.assertEquals(len(calls), 1)
+    self.assertEquals(sorted(results),
+                      [('result', False)] + [('result', True)] * 4)
+    # Nothing is kept once the call returned.
+    self.assertEquals(group.do('key', lambda: 'new result'),
+                      ('new result', False))
+
 
 if __name__ == '__main__':
   utils.main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Tests for the zkns_query resolution and its ZknsResolver cache."""
+
+import collections
+import json
+import time
+import unittest
+import utils
+
+from zk import zkns_query
+
+
+def make_data(hosts):
+  return json.dumps({'entries': [
+      {'uid': i, 'host': host, 'port': 8000 + i,
+       'named_port_map': {'_vtocc': 9000 + i}}
+      for i, host in enumerate(hosts)]})
+
+
+class FakeZkConn(object):
+  """Serves data for every path, or fails when data is None."""
+
+  def __init__(self, data):
+    self.data = data
+    self.reads = 0
+
+  def get_data(self, path):
+    self.reads += 1
+    if self.data is None:
+      raise Exception('zk unavailable')
+    return self.data
+
+
+def entry(host, priority=0, weight=0):
+  return zkns_query.SrvEntry(host, 8000, priority, weight)
+
+
+class TestSrvEntryOrder(unittest.TestCase):
+
+  def test_weighted_shuffle_distribution(self):
+    entries = [entry('light', weight=1), entry('heavy', weight=3)]
+    firsts = collections.Counter(
+        zkns_query._weighted_shuffle(entries)[0].host for _ in xrange(10000))
+    # heavy comes first with probability 3/4.
+    self.assertTrue(7000 < firsts['heavy'] < 8000, firsts)
+
+  def test_weight_zero_entries_last(self):
+    entries = [entry('zero1'), entry('a', weight=1), entry('zero2'),
+               entry('b', weight=5)]
+    for _ in xrange(100):
+      hosts = [e.host for e in zkns_query._weighted_shuffle(entries)]
+      self.assertEqual(sorted(hosts[:2]), ['a', 'b'])
+      self.assertEqual(sorted(hosts[2:]), ['zero1', 'zero2'])
+
+  def test_priorities_are_ascending(self):
+    entries = [entry('p2', priority=2), entry('p0a', weight=1),
+               entry('p1', priority=1), entry('p0b', weight=1)]
+    hosts = [e.host for e in zkns_query._sorted_by_srv_priority(entries)]
+    self.assertEqual(sorted(hosts[:2]), ['p0a', 'p0b'])
+    self.assertEqual(hosts[2:], ['p1', 'p2'])
+
+  def test_pick_only_best_priority_by_weight(self):
+    table = zkns_query._SrvTable([
+        entry('light', weight=1), entry('heavy', weight=3),
+        entry('zero'), entry('backup', priority=1, weight=10)])
+    picks = collections.Counter(table.pick().host for _ in xrange(10000))
+    self.assertEqual(sorted(picks), ['heavy', 'light'])
+    self.assertTrue(7000 < picks['heavy'] < 8000, picks)
+
+  def test_pick_uniform_without_weights(self):
+    table = zkns_query._SrvTable([entry('a'), entry('b')])
+    picks = collections.Counter(table.pick().host for _ in xrange(10000))
+    self.assertTrue(4500 < picks['a'] < 5500, picks)
+
+
+class TestZknsResolver(unittest.TestCase):
+
+  def test_lookup_and_pick(self):
+    resolver = zkns_query.ZknsResolver(FakeZkConn(make_data(['h0', 'h1'])))
+    entries = resolver.lookup_name('/zk/test/vt/ns/ks:_vtocc')
+    self.assertEqual(sorted((e.host, e.port) for e in entries),
+                     [('h0', 9000), ('h1', 9001)])
+    for _ in xrange(20):
+      picked = resolver.pick_addr('/zk/test/vt/ns/ks')
+      self.assertTrue(picked in [('h0', 8000, 0, 0), ('h1', 8001, 0, 0)])
+
+  def test_unchanged_data_is_not_parsed_again(self):
+    zconn = FakeZkConn(make_data(['h0', 'h1']))
+    resolver = zkns_query.ZknsResolver(zconn, refresh_interval=0)
+    table = resolver._get_table('/zk/test/vt/ns/ks')
+    time.sleep(0.01)
+    self.assertTrue(resolver._get_table('/zk/test/vt/ns/ks') is table)
+    self.assertEqual(zconn.reads, 2)
+
+    zconn.data = make_data(['h2'])
+    time.sleep(0.01)
+    self.assertEqual(
+        [e.host for e in resolver.lookup_name('/zk/test/vt/ns/ks')], ['h2'])
+
+  def test_cached_data_served_when_refresh_fails(self):
+    zconn = FakeZkConn(make_data(['h0']))
+    resolver = zkns_query.ZknsResolver(zconn, refresh_interval=0)
+    resolver.lookup_name('/zk/test/vt/ns/ks')
+    zconn.data = None
+    time.sleep(0.01)
+    self.assertEqual(
+        [e.host for e in resolver.lookup_name('/zk/test/vt/ns/ks')], ['h0'])
+    self.assertEqual(zconn.reads, 2)
+
+    # Without cached data, the failure is reported.
+    resolver.invalidate('/zk/test/vt/ns/ks')
+    with self.assertRaises(zkns_query.ZknsError):
+      resolver.lookup_name('/zk/test/vt/ns/ks')
+
+
+if __name__ == '__main__':
+  utils.main()
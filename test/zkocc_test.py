@@ -5,6 +5,7 @@ import logging
 import os
 import re
 import tempfile
+import threading
 import time
 import unittest
 
@@ -66,6 +67,29 @@ class TopoOccTest(unittest.TestCase):
     self.assertEqual(err, "KeyspaceNames[0] = test_keyspace1\n" +
                           "KeyspaceNames[1] = test_keyspace2\n")
 
+  def test_concurrent_connection(self):
+    utils.run_vtctl('CreateKeyspace test_keyspace')
+    t = tablet.Tablet(tablet_uid=1, cell="nj")
+    t.init_tablet("master", "test_keyspace", "0")
+    t.update_addrs()
+    utils.run_vtctl(['RebuildKeyspaceGraph', 'test_keyspace'], auto_log=True)
+
+    # A dead server in the list is failed over, and then skipped.
+    conn = zkocc.ZkOccConnection('localhost:1,' + utils.vtgate.addr(),
+                                 'test_nj', 5.0, pool_size=2)
+    results = []
+    def read():
+      for _ in xrange(10):
+        results.append(conn.get_srv_keyspace_names('local'))
+    threads = [threading.Thread(target=read) for _ in xrange(4)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(results, [['test_keyspace']] * 40)
+    self.assertTrue(len(conn._idle_conns) <= 2)
+    conn.close()
+
   def test_get_srv_keyspace(self):
     utils.run_vtctl('CreateKeyspace test_keyspace')
     t = tablet.Tablet(tablet_uid=1, cell="nj")